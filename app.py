@@ -1,13 +1,32 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 import google.generativeai as genai
+import openai
+from google.generativeai import caching as genai_caching
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
 import os
-import requests
+import random
+import re
 from datetime import datetime
 import logging
 import json
+import click
+import bisect
+import hashlib
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from cachetools import LRUCache, TTLCache
 
 load_dotenv()
+# after load_dotenv: these read their tuning knobs from the environment on import
+from resilience import (CIRCUIT_BREAKERS, GEMINI_KEY_MISSING, AdmissionController, CircuitBreaker, CircuitOpen,
+                        GeminiKeyPool, LatencyWindow, Overloaded, ProviderPool, SingleFlight, UpstreamClient)
+from stores import ConversationStore, CropKnowledgeStore, MandiPriceStore, MspMirror
+
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "dev-secret")
 
@@ -16,10 +35,17 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('agrobot')
 
 # Gemini config
+GEMINI_MODEL_NAME = "gemini-2.5-pro"
+# "flat" sends each request as one System:/User:/Assistant: text prompt;
+# "session" keeps native ChatSessions per stored conversation (see ChatSessionPool)
+GEMINI_CHAT_MODE = os.getenv("GEMINI_CHAT_MODE", "flat").lower()
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-if GOOGLE_API_KEY:
-    genai.configure(api_key=GOOGLE_API_KEY)
-    model = genai.GenerativeModel("gemini-2.5-pro")
+# several keys pool their quotas (see GeminiKeyPool); the first is the default client
+GOOGLE_API_KEYS = [k.strip() for k in os.getenv("GOOGLE_API_KEYS", "").split(",") if k.strip()] \
+    or ([GOOGLE_API_KEY] if GOOGLE_API_KEY else [])
+if GOOGLE_API_KEYS:
+    genai.configure(api_key=GOOGLE_API_KEYS[0])
+    model = genai.GenerativeModel(GEMINI_MODEL_NAME)
 else:
     model = None
 
@@ -51,392 +77,2795 @@ CLIMATE_ZONES = {
 
 
 # ---------- Helpers ----------
+LANGUAGE_PROMPTS = {
+    "tamil": "நீங்கள் AgroAI உதவியாளர். எந்த மொழியில் கேள்வி கேட்டாலும், பதில்களை தமிழில் அளிக்கவும்.",
+    "hindi": "आप AgroAI सहायक हैं। प्रश्न किसी भी भाषा में हो, उत्तर हमेशा हिंदी में दें।",
+    "telugu": "మీరు AgroAI సహాయకుడు. వినియోగదారు ఏ భాషలో అడిగినా, సమాధానాలు ఎప్పుడూ తెలుగులో ఇవ్వండి.",
+    "kannada": "ನೀವು AgroAI ಸಹಾಯಕರು. ಯಾವ ಭಾಷೆಯಲ್ಲಾದರೂ ಪ್ರಶ್ನೆ ಬಂದರೂ, ಉತ್ತರವನ್ನು ಕನ್ನಡದಲ್ಲಿ ನೀಡಿ.",
+    "malayalam": "നിങ്ങൾ AgroAI സഹായി ആണ്. ചോദ്യം ഏത് ഭാഷയിലായാലും മറുപടി മലയാളത്തിലായിരിക്കും.",
+    "marathi": "तुम्ही AgroAI सहाय्यक आहात. कोणत्याही भाषेत प्रश्न असला तरी उत्तर मराठीत द्या.",
+    "gujarati": "તમે AgroAI સહાયક છો. પ્રશ્ન કોઈપણ ભાષામાં હોય, ઉત્તર હંમેશા ગુજરાતીમાં આપો.",
+    "bengali": "আপনি AgroAI সহকারী। প্রশ্ন যেকোনো ভাষায় হলেও উত্তর বাংলায় দিন।",
+    "punjabi": "ਤੁਸੀਂ AgroAI ਸਹਾਇਕ ਹੋ। ਸਵਾਲ ਕਿਸੇ ਵੀ ਭਾਸ਼ਾ ਵਿੱਚ ਹੋਵੇ, ਉੱਤਰ ਪੰਜਾਬੀ ਵਿੱਚ ਦਿਓ।",
+    "odia": "ଆପଣ AgroAI ସହାୟକ। ପ୍ରଶ୍ନ କେହି ଭାଷାରେ ହେଉ, ଉତ୍ତର ଓଡ଼ିଆରେ ଦିଅନ୍ତୁ।",
+    "assamese": "আপুনি AgroAI সহায়ক। যিকোনো ভাষাত প্ৰশ্ন হ’লেও উত্তৰ অসমীয়া দিব।",
+    "urdu": "آپ AgroAI معاون ہیں۔ سوال کسی بھی زبان میں ہو، جواب ہمیشہ اردو میں دیں۔",
+}
+
+
 def build_system_prompt(language_code):
     """Create a system instruction forcing Gemini to reply in selected language."""
     lc = (language_code or "english").lower()
 
-    lang_prompts = {
-        "tamil": "நீங்கள் AgroAI உதவியாளர். எந்த மொழியில் கேள்வி கேட்டாலும், பதில்களை தமிழில் அளிக்கவும்.",
-        "hindi": "आप AgroAI सहायक हैं। प्रश्न किसी भी भाषा में हो, उत्तर हमेशा हिंदी में दें।",
-        "telugu": "మీరు AgroAI సహాయకుడు. వినియోగదారు ఏ భాషలో అడిగినా, సమాధానాలు ఎప్పుడూ తెలుగులో ఇవ్వండి.",
-        "kannada": "ನೀವು AgroAI ಸಹಾಯಕರು. ಯಾವ ಭಾಷೆಯಲ್ಲಾದರೂ ಪ್ರಶ್ನೆ ಬಂದರೂ, ಉತ್ತರವನ್ನು ಕನ್ನಡದಲ್ಲಿ ನೀಡಿ.",
-        "malayalam": "നിങ്ങൾ AgroAI സഹായി ആണ്. ചോദ്യം ഏത് ഭാഷയിലായാലും മറുപടി മലയാളത്തിലായിരിക്കും.",
-        "marathi": "तुम्ही AgroAI सहाय्यक आहात. कोणत्याही भाषेत प्रश्न असला तरी उत्तर मराठीत द्या.",
-        "gujarati": "તમે AgroAI સહાયક છો. પ્રશ્ન કોઈપણ ભાષામાં હોય, ઉત્તર હંમેશા ગુજરાતીમાં આપો.",
-        "bengali": "আপনি AgroAI সহকারী। প্রশ্ন যেকোনো ভাষায় হলেও উত্তর বাংলায় দিন।",
-        "punjabi": "ਤੁਸੀਂ AgroAI ਸਹਾਇਕ ਹੋ। ਸਵਾਲ ਕਿਸੇ ਵੀ ਭਾਸ਼ਾ ਵਿੱਚ ਹੋਵੇ, ਉੱਤਰ ਪੰਜਾਬੀ ਵਿੱਚ ਦਿਓ।",
-        "odia": "ଆପଣ AgroAI ସହାୟକ। ପ୍ରଶ୍ନ କେହି ଭାଷାରେ ହେଉ, ଉତ୍ତର ଓଡ଼ିଆରେ ଦିଅନ୍ତୁ।",
-        "assamese": "আপুনি AgroAI সহায়ক। যিকোনো ভাষাত প্ৰশ্ন হ’লেও উত্তৰ অসমীয়া দিব।",
-        "urdu": "آپ AgroAI معاون ہیں۔ سوال کسی بھی زبان میں ہو، جواب ہمیشہ اردو میں دیں۔",
-    }
-
-    if lc in lang_prompts:
-        return lang_prompts[lc]
+    if lc in LANGUAGE_PROMPTS:
+        return LANGUAGE_PROMPTS[lc]
     return "You are AgroAI, an expert agricultural assistant. No matter the input, always respond in English."
 
 
-def call_gemini_chat(messages, language="english"):
+def build_gemini_prompt(messages, language="english"):
+    """Flatten a role/content message list into the plaintext prompt sent to Gemini."""
+    system_prompt = build_system_prompt(language)
+
+    # Build a plaintext conversation for older API usage
+    convo_lines = [f"System: {system_prompt}"]
+    convo_lines.extend(prompt_lines(messages))
+    return "\n".join(convo_lines)
+
+
+def prompt_lines(messages):
+    """One "System:/User:/Assistant:" line per message."""
+    lines = []
+    for m in messages:
+        role_raw = (m.get('role') or 'user').lower()
+        content = m.get('content', '')
+        if role_raw == 'system':
+            # include any explicit system guidance the client provided
+            lines.append(f"System: {content}")
+        elif role_raw in ('assistant', 'bot'):
+            lines.append(f"Assistant: {content}")
+        else:
+            lines.append(f"User: {content}")
+    return lines
+
+
+ADVICE_DEGRADED = "The AI advisor is temporarily unavailable."
+
+
+def generate_reply(messages, language="english", route="chat"):
+    """Reply text from the first healthy LLM provider (see ProviderPool); raises if every provider fails.
+
+    Concurrent calls with an identical prompt on the same route share one call (GEMINI_FLIGHT),
+    and only that one is admitted through LLM_ADMISSION: waiting followers hold no slot.
+    """
+    convo = build_gemini_prompt(messages, language)
+    key = hashlib.sha256(f"{ROUTER.classify(route, messages)}\0{convo}".encode('utf-8')).hexdigest()
+    return GEMINI_FLIGHT.do(key, LLM.generate, messages, language, route)
+
+
+async def agenerate_reply(messages, language="english", route="chat"):
+    """Async twin of generate_reply, coalesced the same way on the event loop."""
+    convo = build_gemini_prompt(messages, language)
+    key = hashlib.sha256(f"{ROUTER.classify(route, messages)}\0{convo}".encode('utf-8')).hexdigest()
+    return await GEMINI_FLIGHT.ado(key, LLM.agenerate, messages, language, route)
+
+
+def gemini_reply(messages, language="english", route="chat"):
+    """Send conversation to Gemini and return the reply text; raises on upstream errors.
+
+    `route` picks the model and latency budget (see ModelRouter).
+    """
+    convo = build_gemini_prompt(messages, language)
+    model_name, budget = ROUTER.pick(route, messages)
+    return _generate_text(messages, language, convo, model_name, budget)
+
+
+def _generate_text(messages, language, convo, model_name, budget):
+    def send(key):
+        target, prompt = prefix_cached_request(messages, language, convo, model_name, key)
+        with ROUTER.timed(model_name):
+            return target.generate_content(prompt, request_options={"timeout": budget})
+
+    resp = GEMINI_KEYS.call(model_name, estimate_tokens(convo) + GEMINI_REPLY_TOKENS, send)
+    return getattr(resp, 'text', str(resp)).strip()
+
+
+def iter_gemini_reply(messages, language="english", route="chat"):
+    """Yield reply text chunks from the first healthy LLM provider; raises on upstream errors."""
+    return LLM.stream(messages, language, route)
+
+
+def gemini_stream(messages, language="english", route="chat"):
+    """Yield reply text chunks as Gemini streams them; raises on upstream errors."""
+    convo = build_gemini_prompt(messages, language)
+    model_name, budget = ROUTER.pick(route, messages)
+
+    def open_stream(key):
+        target, prompt = prefix_cached_request(messages, language, convo, model_name, key)
+        with ROUTER.timed(model_name):
+            yield from target.generate_content(prompt, stream=True, request_options={"timeout": budget})
+
+    for chunk in GEMINI_KEYS.stream(model_name, estimate_tokens(convo) + GEMINI_REPLY_TOKENS, open_stream):
+        try:
+            text = chunk.text
+        except ValueError:
+            # chunk without text parts (e.g. safety / finish metadata only)
+            continue
+        if text:
+            yield text
+
+
+def is_error_reply(answer):
+    """True for the error strings call_gemini_chat returns in place of a reply (and degraded advice)."""
+    return answer == GEMINI_KEY_MISSING or answer.startswith(("Error from Gemini:", "Server busy:", ADVICE_DEGRADED))
+
+
+def call_gemini_chat(messages, language="english", route="chat"):
     """Send conversation to Gemini and enforce response language.
 
     messages: list of dicts with keys 'role' and 'content'. Role may be 'system','user','assistant'.
     This function will prepend a language system prompt and then include any provided system message.
     Returns a string reply or an error message.
     """
-    if model is None:
-        return "Gemini API key missing. Please configure GOOGLE_API_KEY in .env."
+    if not LLM.available():
+        return GEMINI_KEY_MISSING
 
     try:
-        system_prompt = build_system_prompt(language)
+        return generate_reply(messages, language, route)
+    except Overloaded:
+        raise
+    except Exception as e:
+        logger.exception('Gemini chat error')
+        return f"Error from Gemini: {e}"
 
-        # Build a plaintext conversation for older API usage
-        convo_lines = [f"System: {system_prompt}"]
 
-        for m in messages:
-            role_raw = (m.get('role') or 'user').lower()
-            content = m.get('content', '')
-            if role_raw == 'system':
-                # include any explicit system guidance the client provided
-                convo_lines.append(f"System: {content}")
-            elif role_raw in ('assistant', 'bot'):
-                convo_lines.append(f"Assistant: {content}")
-            else:
-                convo_lines.append(f"User: {content}")
+def sse_event(event, payload):
+    """Format one Server-Sent Events frame with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+# ---------- Model routing ----------
+# Structured and short tasks (JSON enrichment, summaries, quick questions) go to the fast
+# model; long reasoning questions stay on pro. If pro's recent p95 latency passes
+# PRO_P95_FALLBACK_SECONDS, chat traffic falls back to the fast model until it recovers:
+# one chat request every PRO_PROBE_SECONDS still goes to pro as a probe, and samples older
+# than PRO_LATENCY_MAX_AGE are forgotten, so pro is judged on fresh latencies only.
+# Pinned routes (the offline advice matrix, whose artifact records its model) never fall back.
+GEMINI_FAST_MODEL_NAME = os.getenv("GEMINI_FAST_MODEL", "gemini-2.5-flash")
+MODEL_ROUTES = {
+    "chat": os.getenv("GEMINI_CHAT_MODEL", GEMINI_MODEL_NAME),
+    "chat_short": GEMINI_FAST_MODEL_NAME,
+    "enrich": GEMINI_FAST_MODEL_NAME,
+    "summary": GEMINI_FAST_MODEL_NAME,
+    "matrix": os.getenv("ADVICE_MATRIX_MODEL", GEMINI_MODEL_NAME),
+}
+PINNED_ROUTES = ("matrix",)
+# per-request latency budgets (seconds), passed to the SDK as the call timeout
+LATENCY_BUDGETS = {"chat": 60.0, "chat_short": 20.0, "enrich": 12.0, "summary": 20.0, "matrix": 60.0}
+PRO_P95_FALLBACK_SECONDS = float(os.getenv("PRO_P95_FALLBACK_SECONDS", "25"))
+PRO_PROBE_SECONDS = float(os.getenv("PRO_PROBE_SECONDS", "30"))
+PRO_LATENCY_MAX_AGE = float(os.getenv("PRO_LATENCY_MAX_AGE", "300"))
+CHAT_SHORT_CHARS = int(os.getenv("CHAT_SHORT_CHARS", "120"))
+REASONING_HINTS = ("why", "how", "explain", "plan", "compare", "schedule", "diagnose", "difference", "step")
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_model(name):
+    """GenerativeModel for `name`; the default pro model is the module-level `model`."""
+    if name == GEMINI_MODEL_NAME:
+        return model
+    with _models_lock:
+        if name not in _models:
+            _models[name] = genai.GenerativeModel(name)
+        return _models[name]
+
+
+class ModelRouter:
+    """Pick a model and latency budget per route, with p95-based fallback off pro."""
+
+    def __init__(self, routes, budgets, pro_name, fast_name, p95_threshold, min_samples=20, pinned=()):
+        self.routes = routes
+        self.pinned = pinned
+        self.budgets = budgets
+        self.pro_name = pro_name
+        self.fast_name = fast_name
+        self.p95_threshold = p95_threshold
+        self.min_samples = min_samples
+        self.windows = {}
+        self._lock = threading.Lock()
+        self.picks = {}
+        self.fallbacks = 0
+        self.probes = 0
+        self._next_probe = 0.0
+
+    def classify(self, route, messages):
+        """Narrow the generic chat route to chat_short for short, simple questions."""
+        if route != "chat" or not messages:
+            return route
+        last = messages[-1].get('content', '') if (messages[-1].get('role') or 'user').lower() == 'user' else ''
+        text = normalize_text(last)
+        if last and len(last) <= CHAT_SHORT_CHARS and not any(h in text.split() for h in REASONING_HINTS):
+            return "chat_short"
+        return route
+
+    def pick(self, route, messages=None):
+        route = self.classify(route, messages)
+        name = self.routes.get(route, self.routes["chat"])
+        budget = self.budgets.get(route, self.budgets["chat"])
+        if (route not in self.pinned and name == self.pro_name and self.p95(name) > self.p95_threshold
+                and not self._probe()):
+            name, budget = self.fast_name, self.budgets["chat_short"]
+            with self._lock:
+                self.fallbacks += 1
+        with self._lock:
+            self.picks[(route, name)] = self.picks.get((route, name), 0) + 1
+        return name, budget
+
+    def _probe(self):
+        """True for one request per PRO_PROBE_SECONDS while in fallback: it goes to pro anyway."""
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_probe:
+                return False
+            self._next_probe = now + PRO_PROBE_SECONDS
+            self.probes += 1
+            return True
+
+    def window(self, name):
+        with self._lock:
+            if name not in self.windows:
+                self.windows[name] = LatencyWindow(max_age=PRO_LATENCY_MAX_AGE)
+            return self.windows[name]
+
+    def p95(self, name):
+        w = self.window(name)
+        return w.percentile(0.95) if w.recent() >= self.min_samples else 0.0
+
+    @contextmanager
+    def timed(self, name):
+        """Record the wall time of the wrapped call (successful or not) against `name`."""
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            self.window(name).add(time.monotonic() - t0)
+
+    def stats(self):
+        with self._lock:
+            windows = dict(self.windows)
+            picks = {f"{route}->{name}": n for (route, name), n in self.picks.items()}
+            fallbacks, probes = self.fallbacks, self.probes
+        return {
+            "routes": dict(self.routes),
+            "picks": picks,
+            "pro_fallbacks": fallbacks,
+            "pro_probes": probes,
+            "latency": {name: {"calls": w.count, "p50": round(w.percentile(0.5), 3), "p95": round(w.percentile(0.95), 3)}
+                        for name, w in windows.items()},
+        }
+
+
+ROUTER = ModelRouter(MODEL_ROUTES, LATENCY_BUDGETS, GEMINI_MODEL_NAME, GEMINI_FAST_MODEL_NAME, PRO_P95_FALLBACK_SECONDS,
+                     pinned=PINNED_ROUTES)
+
+
+# ---------- Circuit breakers ----------
+# One breaker per upstream (each LLM provider, data.gov.in; see resilience.CircuitBreaker).
+# While one is open, callers get CircuitOpen at once and serve cached, stale or degraded
+# content. LLM calls are judged against their route's LATENCY_BUDGETS entry rather than
+# LLM_BREAKER_SLOW_SECONDS, and the background data.gov.in jobs (MSP sync, mandi ingest),
+# whose pages are large and slow by design, have their own breaker so they never trip
+# the one searches rely on.
+LLM_BREAKER_SLOW_SECONDS = float(os.getenv("LLM_BREAKER_SLOW_SECONDS", str(max(LATENCY_BUDGETS.values()))))
+DATA_GOV_BREAKER_SLOW_SECONDS = float(os.getenv("DATA_GOV_BREAKER_SLOW_SECONDS", "8"))
+DATA_GOV_SYNC_BREAKER_SLOW_SECONDS = float(os.getenv("DATA_GOV_SYNC_BREAKER_SLOW_SECONDS", "60"))
 
-        convo = "\n".join(convo_lines)
+DATA_GOV_BREAKER = CircuitBreaker("data.gov.in", DATA_GOV_BREAKER_SLOW_SECONDS)
+DATA_GOV_SYNC_BREAKER = CircuitBreaker("data.gov.in sync", DATA_GOV_SYNC_BREAKER_SLOW_SECONDS)
 
-        resp = model.generate_content(convo)
+
+# ---------- LLM admission control ----------
+# Every LLM call is admitted here first: at most LLM_MAX_CONCURRENT in flight, at most
+# LLM_RATE_PER_MIN started per minute (token bucket, LLM_BURST deep), and at most
+# LLM_MAX_QUEUE callers waiting, each for no longer than LLM_MAX_WAIT seconds. Anyone
+# who cannot be admitted gets Overloaded, which the views turn into a fast 429 (quota)
+# or 503 (capacity) with Retry-After, instead of piling up on Gemini.
+LLM_MAX_CONCURRENT = int(os.getenv("LLM_MAX_CONCURRENT", "16"))
+LLM_RATE_PER_MIN = float(os.getenv("LLM_RATE_PER_MIN", "300"))
+LLM_BURST = int(os.getenv("LLM_BURST", "20"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "64"))
+LLM_MAX_WAIT = float(os.getenv("LLM_MAX_WAIT", "10"))
+
+LLM_ADMISSION = AdmissionController(LLM_MAX_CONCURRENT, LLM_RATE_PER_MIN, LLM_BURST, LLM_MAX_QUEUE, LLM_MAX_WAIT)
+
+
+@app.errorhandler(Overloaded)
+def llm_overloaded(e):
+    resp = jsonify({"error": f"Server busy: {e}. Please retry in {e.retry_after} s.", "retry_after": e.retry_after})
+    resp.status_code = e.status
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp
+
+
+# ---------- Gemini key pool ----------
+# GOOGLE_API_KEYS (comma separated; keys from separate projects have separate quotas)
+# spreads Gemini calls over several keys (see resilience.GeminiKeyPool), each counted
+# against these per-model RPM/TPM quotas. A key that gets a 429 is backed off
+# GEMINI_KEY_BACKOFF seconds, doubling per repeat. The first key is the default client
+# that `model` and get_model use.
+GEMINI_QUOTAS = {
+    GEMINI_MODEL_NAME: (int(os.getenv("GEMINI_PRO_RPM", "150")), int(os.getenv("GEMINI_PRO_TPM", "2000000"))),
+    GEMINI_FAST_MODEL_NAME: (int(os.getenv("GEMINI_FLASH_RPM", "1000")), int(os.getenv("GEMINI_FLASH_TPM", "1000000"))),
+}
+GEMINI_REPLY_TOKENS = int(os.getenv("GEMINI_REPLY_TOKENS", "1000"))  # reserved per call until usage is known
+GEMINI_KEY_BACKOFF = float(os.getenv("GEMINI_KEY_BACKOFF", "30"))
+GEMINI_KEY_MAX_BACKOFF = 300.0
+
+GEMINI_KEYS = GeminiKeyPool(GOOGLE_API_KEYS, GEMINI_QUOTAS, get_model, GEMINI_KEY_BACKOFF, GEMINI_KEY_MAX_BACKOFF)
+
+
+# ---------- LLM providers ----------
+# Gemini is the primary provider; when OPENAI_API_KEY is set the bundled openai (0.28)
+# client is a second one. resilience.ProviderPool routes each call to the healthiest of
+# them and fails over to the next; with LLM_HEDGE=1 a second request is also fired when
+# the first has not answered by its route's p90 latency, and whichever answers first wins.
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+
+
+class GeminiProvider:
+    name = "gemini"
+
+    def available(self):
+        return model is not None
+
+    def generate(self, messages, language, route):
+        return gemini_reply(messages, language, route)
+
+    def stream(self, messages, language, route):
+        return gemini_stream(messages, language, route)
+
+    async def agenerate(self, messages, language, route):
+        convo = build_gemini_prompt(messages, language)
+        model_name, budget = ROUTER.pick(route, messages)
+
+        async def send(key):
+            target, prompt = prefix_cached_request(messages, language, convo, model_name, key)
+            with ROUTER.timed(model_name):
+                return await target.generate_content_async(prompt, request_options={"timeout": budget})
+
+        resp = await GEMINI_KEYS.acall(model_name, estimate_tokens(convo) + GEMINI_REPLY_TOKENS, send)
         return getattr(resp, 'text', str(resp)).strip()
-    except Exception as e:
-        logger.exception('Gemini chat error')
-        return f"Error from Gemini: {e}"
 
 
-# ---------- Routes ----------
-@app.route('/')
-def home():
-    try:
-        return render_template('index.html', soil_types=SOIL_TYPES, climate_zones=CLIMATE_ZONES)
-    except Exception as e:
-        logger.exception('Error rendering index')
-        return ("An internal error occurred while rendering the main page. "
-                "Check server logs for details."), 500
+class OpenAIProvider:
+    """Chat completions through the openai 0.28 client (ChatCompletion.create / acreate)."""
 
+    name = "openai"
 
-@app.route('/market')
-def market_page():
-    try:
-        return render_template('market.html', soil_types=SOIL_TYPES, climate_zones=CLIMATE_ZONES)
-    except Exception as e:
-        logger.exception('Error rendering market page')
-        return ("Internal error rendering market page."), 500
+    def __init__(self, api_key, model_name):
+        self.api_key = api_key
+        self.model_name = model_name
 
+    def available(self):
+        return bool(self.api_key)
 
-@app.route('/login')
-def login_page():
-    try:
-        return render_template('login.html')
-    except Exception as e:
-        logger.exception('Error rendering login page')
-        return ("Internal error rendering login page."), 500
+    def _request(self, messages, language, route, **extra):
+        chat = [{"role": "system", "content": build_system_prompt(language)}]
+        for m in messages:
+            role = (m.get('role') or 'user').lower()
+            chat.append({"role": "assistant" if role in ('assistant', 'bot') else role if role == 'system' else "user",
+                         "content": m.get('content', '')})
+        budget = LATENCY_BUDGETS.get(ROUTER.classify(route, messages), LATENCY_BUDGETS["chat"])
+        return dict(model=self.model_name, messages=chat, api_key=self.api_key, request_timeout=budget, **extra)
 
+    def generate(self, messages, language, route):
+        resp = openai.ChatCompletion.create(**self._request(messages, language, route))
+        return (resp["choices"][0]["message"].get("content") or "").strip()
 
-@app.route('/register')
-def register_page():
-    try:
-        return render_template('register.html')
-    except Exception as e:
-        logger.exception('Error rendering register page')
-        return ("Internal error rendering register page."), 500
+    def stream(self, messages, language, route):
+        for chunk in openai.ChatCompletion.create(**self._request(messages, language, route, stream=True)):
+            text = chunk["choices"][0].get("delta", {}).get("content")
+            if text:
+                yield text
 
+    async def agenerate(self, messages, language, route):
+        resp = await openai.ChatCompletion.acreate(**self._request(messages, language, route))
+        return (resp["choices"][0]["message"].get("content") or "").strip()
 
-@app.route('/get_advice', methods=['POST'])
-def get_advice():
-    data = request.get_json() or {}
-    soil = data.get("soil_type")
-    climate = data.get("climate")
-    language = data.get("language", "english")
-    messages = data.get("messages", [])
 
-    if not messages:
-        q = data.get("query", "")
-        messages = [{"role": "user", "content": f"Soil: {soil}\nClimate: {climate}\nQuery: {q}"}]
+LLM = ProviderPool([GeminiProvider(), OpenAIProvider(OPENAI_API_KEY, OPENAI_MODEL)], ROUTER, LLM_ADMISSION,
+                   LLM_BREAKER_SLOW_SECONDS, hedge=LLM_HEDGE)
 
-    answer = call_gemini_chat(messages, language)
-    ts = datetime.utcnow().isoformat() + "Z"
-    return jsonify({"response": answer, "timestamp": ts})
 
+# ---------- Request coalescing ----------
+GEMINI_FLIGHT = SingleFlight('gemini')
+DATA_GOV_FLIGHT = SingleFlight('data.gov.in')
 
-# ---------- Real-Time Market Price (INR/kg) ----------
-import os
 
-DATA_GOV_API_KEY = os.getenv("DATA_GOV_API_KEY")        # get this from https://data.gov.in/ (register -> API key)
-DATA_GOV_RESOURCE_ID = os.getenv("DATA_GOV_RESOURCE_ID")  # dataset resource id (open dataset page -> API -> copy resource_id)
-# Example dataset page (Agmarknet daily prices) on data.gov.in: "Current daily price of various commodities from various markets (Mandi)". :contentReference[oaicite:3]{index=3}
+def fetch_json(url, params=None, timeout=10, breaker=None):
+    """GET a data.gov.in URL and return (status_code, parsed JSON or None).
 
-def query_data_gov_price(product):
-    """
-    Query data.gov.in Agmarknet dataset for the latest record matching `product`.
-    Returns a dict like: {'source':'DATA_GOV', 'price_per_kg': float, 'unit': 'INR/kg', 'market': '...', 'date': 'YYYY-MM-DD'}
-    or None if not available / on error.
+    `timeout` is the overall deadline, retries included (see UpstreamClient).
+    Identical concurrent fetches are coalesced into one request via DATA_GOV_FLIGHT.
+    Raises CircuitOpen without a request while `breaker` (DATA_GOV_BREAKER) is open.
     """
-    if not DATA_GOV_API_KEY or not DATA_GOV_RESOURCE_ID:
-        return None
+    breaker = breaker or DATA_GOV_BREAKER
+    key = breaker.name + " " + url + "?" + json.dumps(sorted((params or {}).items()))
+    return DATA_GOV_FLIGHT.do(key, _fetch_json, url, params, timeout, breaker)
+
 
+def _fetch_json(url, params, timeout, breaker):
+    breaker.check()
+    t0 = time.monotonic()
     try:
-        # Build request params. data.gov.in API accepts filters like filters[commodity]=<name>
-        base = f"https://api.data.gov.in/resource/{DATA_GOV_RESOURCE_ID}"
-        params = {
-            "api-key": DATA_GOV_API_KEY,
-            "format": "json",
-            # using commodity filter (field name on resource may vary; try common keys)
-            "filters[commodity]": product,
-            "limit": 5,
-            "offset": 0,
-            # sort by date descending if supported
-            "sort[price_date]": "desc"
-        }
+        r = UPSTREAM.get(url, params=params, deadline=timeout)
+        data = r.json() if r.status_code == 200 else None
+    except Exception:
+        breaker.record(False, time.monotonic() - t0)
+        raise
+    # a 4xx is our request's fault, not a sign the upstream is unhealthy
+    breaker.record(r.status_code < 500 and r.status_code != 429, time.monotonic() - t0)
+    return r.status_code, data
 
-        r = requests.get(base, params=params, timeout=12)
-        if r.status_code != 200:
-            # try without filters key name (some datasets use 'commodity' or 'Commodity')
-            # fallback: try simple search endpoint with q param
-            alt_params = {
-                "api-key": DATA_GOV_API_KEY,
-                "format": "json",
-                "q": product,
-                "limit": 5
-            }
-            r = requests.get(base, params=alt_params, timeout=12)
-            if r.status_code != 200:
-                return None
 
-        payload = r.json()
-        records = payload.get("records") or payload.get("result") or payload.get("data") or []
-        if not records:
+# ---------- Upstream HTTP client ----------
+# One pooled requests.Session for every outbound HTTP call, so searches reuse warm
+# keep-alive connections to api.data.gov.in instead of paying TCP+TLS setup each time.
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "32"))
+UPSTREAM_HOST_LIMIT = int(os.getenv("UPSTREAM_HOST_LIMIT", "16"))
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_BACKOFF = 0.25
+UPSTREAM_BACKOFF_MAX = 2.0
+
+UPSTREAM = UpstreamClient(UPSTREAM_POOL_SIZE, UPSTREAM_HOST_LIMIT, UPSTREAM_RETRIES,
+                          UPSTREAM_BACKOFF, UPSTREAM_BACKOFF_MAX)
+
+
+# ---------- Prefix (context) caching ----------
+# Prompts start with the language instruction from build_system_prompt plus, for the chat
+# UI, the soil/climate context message. When such a prefix is at least the model's minimum
+# cacheable size (PREFIX_CACHE_MIN_TOKENS), PrefixCache registers it once as provider-side
+# cached content and reuses it by handle, refreshing before expiry. Our stock prefixes are
+# far below the minimum and are never sent to the provider; long client system messages
+# can qualify. Registration and refresh run on a background worker, never on the request:
+# until a handle is ready (or after the provider refused) requests send the plain prompt.
+PREFIX_CACHE_ENABLED = os.getenv("GEMINI_PREFIX_CACHE", "1") == "1"
+PREFIX_CACHE_TTL = int(os.getenv("GEMINI_PREFIX_CACHE_TTL", "3600"))
+PREFIX_CACHE_REFRESH_MARGIN = 300
+PREFIX_CACHE_RETRY_SECONDS = 600
+# provider minimum for explicit context caching, in tokens
+PREFIX_CACHE_MIN_TOKENS = {
+    GEMINI_MODEL_NAME: int(os.getenv("GEMINI_PRO_CACHE_MIN_TOKENS", "4096")),
+    GEMINI_FAST_MODEL_NAME: int(os.getenv("GEMINI_FLASH_CACHE_MIN_TOKENS", "1024")),
+}
+
+
+class GeminiCacheProvider:
+    """Prefix-cache provider backed by Gemini CachedContent.
+
+    PrefixCache only needs create / refresh / model, so a local stub with the same three
+    methods can stand in for it.
+    """
+
+    def create(self, model_name, instruction, ttl):
+        # cached contents live on the default client, so creating one counts against the first key
+        with GEMINI_KEYS.reserve(model_name, estimate_tokens(instruction), primary_only=True):
+            return genai_caching.CachedContent.create(model=model_name, system_instruction=instruction, ttl=ttl)
+
+    def refresh(self, handle, ttl):
+        handle.update(ttl=ttl)
+
+    def model(self, handle):
+        return genai.GenerativeModel.from_cached_content(handle)
+
+
+class PrefixCache:
+    """Registry of cached prompt prefixes keyed by (model name, instruction text)."""
+
+    def __init__(self, provider, ttl, refresh_margin, retry_seconds, enabled=True, min_tokens=None):
+        self.provider = provider
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.retry_seconds = retry_seconds
+        self.enabled = enabled
+        self.min_tokens = min_tokens or {}
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._retry_at = {}
+        self._unsupported = set()
+        self._pending = set()
+        self._worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefix-cache')
+        self.counters = {"hits": 0, "misses": 0, "refreshes": 0, "failures": 0,
+                         "fallbacks": 0, "too_small": 0, "tokens_saved": 0}
+
+    def model_for(self, model_name, instruction):
+        """Return a model bound to the cached `instruction`, or None to send the prompt uncached.
+
+        Never blocks on the provider: a missing or expiring handle is (re)registered in the background.
+        """
+        if not self.enabled:
+            return None
+        tokens = estimate_tokens(instruction)
+        if tokens < self.min_tokens.get(model_name, max(self.min_tokens.values(), default=0)):
+            with self._lock:
+                self.counters["too_small"] += 1
             return None
+        key = hashlib.sha256(f"{model_name}\0{instruction}".encode('utf-8')).hexdigest()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry["expires"] > now:
+                if entry["expires"] - now <= self.refresh_margin:
+                    self._schedule(key, model_name, instruction)
+                self.counters["hits"] += 1
+                self.counters["tokens_saved"] += entry["tokens"]
+                return entry["model"]
+            self.counters["fallbacks"] += 1
+            if key not in self._unsupported and self._retry_at.get(key, 0) <= now:
+                self._schedule(key, model_name, instruction)
+            return None
+
+    def _schedule(self, key, model_name, instruction):
+        # caller holds self._lock
+        if key not in self._pending:
+            self._pending.add(key)
+            self._worker.submit(self._register, key, model_name, instruction)
 
-        # pick the most recent record that has a numeric price
-        # dataset fields vary; look for modal_price / modalprice / min_price / max_price etc.
-        price = None
-        unit = "INR/kg"
-        market = None
-        date = None
-
-        for rec in records:
-            # find common fields robustly
-            # some datasets use 'modal_price', 'Modal Price', 'modalprice', etc.
-            # We'll try a set of likely keys
-            # Also record may include price_unit or quoted unit (e.g., 'Quintal' or 'kg')
-            lower_keys = {k.lower(): k for k in rec.keys()}
-            def get_field(possible):
-                for p in possible:
-                    k = lower_keys.get(p.lower())
-                    if k and rec.get(k) not in (None, "", "NA"):
-                        return rec.get(k)
-                return None
-
-            modal = get_field(["modal_price", "modalprice", "modal price", "modal"])
-            minp  = get_field(["min_price", "minprice", "min price"])
-            maxp  = get_field(["max_price", "maxprice", "max price"])
-            unit_field = get_field(["price_unit", "unit", "priceunit"])
-            date = get_field(["price_date", "date", "recorded_date", "trade_date"]) or date
-            market = get_field(["market", "market_name", "marketname", "marketplace"]) or market
-
-            chosen = modal or ( (float(minp)+float(maxp))/2 if minp and maxp else None ) or minp or maxp
-            if chosen:
-                # try convert to float (strip commas, rupee symbols)
-                s = str(chosen).replace(",", "").replace("Rs.", "").replace("₹", "").strip()
+    def _register(self, key, model_name, instruction):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        try:
+            if entry and entry["expires"] > now:
                 try:
-                    price_value = float(s)
+                    self.provider.refresh(entry["handle"], self.ttl)
+                    with self._lock:
+                        entry["expires"] = now + self.ttl
+                        self.counters["refreshes"] += 1
+                    return
                 except Exception:
-                    # price may be non-numeric, skip
-                    price_value = None
-                if price_value:
-                    # determine unit: if unit_field contains 'Quintal' -> convert to per kg
-                    u = (unit_field or "").lower() if unit_field else ""
-                    if "quintal" in u:
-                        # price is per quintal (100 kg)
-                        price_per_kg = round(price_value / 100.0, 2)
-                        unit = "INR/kg"
-                    elif "kg" in u or "kilogram" in u:
-                        price_per_kg = round(price_value, 2)
-                        unit = "INR/kg"
-                    elif "ton" in u or "tonne" in u:
-                        # per tonne -> divide by 1000
-                        price_per_kg = round(price_value / 1000.0, 2)
-                        unit = "INR/kg"
-                    else:
-                        # unknown unit: many Agmarknet records are per Quintal, assume quintal if no unit and value large (>100)
-                        if price_value > 1000:
-                            price_per_kg = round(price_value / 100.0, 2)
-                        else:
-                            price_per_kg = round(price_value, 2)
-                    return {
-                        "source": "DATA_GOV",
-                        "price_per_kg": price_per_kg,
-                        "raw_price": price_value,
-                        "raw_unit": unit_field or "unknown",
-                        "unit": unit,
-                        "market": market,
-                        "date": date
-                    }
-        return None
-    except Exception as e:
-        # don't crash server on any errors
-        print("DATA_GOV query error:", e)
-        return None
+                    logger.warning('prefix cache refresh failed; re-registering', exc_info=True)
+            handle = self.provider.create(model_name, instruction, self.ttl)
+            entry = {"handle": handle, "model": self.provider.model(handle),
+                     "expires": now + self.ttl, "tokens": estimate_tokens(instruction)}
+            with self._lock:
+                self._entries[key] = entry
+                self.counters["misses"] += 1
+        except Exception as e:
+            with self._lock:
+                self._entries.pop(key, None)
+                self.counters["failures"] += 1
+                if isinstance(e, google_exceptions.InvalidArgument):
+                    # e.g. below the minimum cacheable token count: retrying will not help
+                    self._unsupported.add(key)
+                else:
+                    self._retry_at[key] = now + self.retry_seconds
+            logger.warning('prefix cache registration failed, prompts stay uncached: %s', e)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
 
-@app.route('/market_online', methods=['GET'])
-def msp_rate():
-    crop = request.args.get('product', '').strip().lower()
-    if not crop:
-        return jsonify({'error': 'Please provide a crop name'})
+    def stats(self):
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["fallbacks"]
+            return dict(self.counters, entries=len(self._entries), unsupported=len(self._unsupported),
+                        pending=len(self._pending),
+                        hit_rate=round(self.counters["hits"] / lookups, 4) if lookups else 0.0)
 
-    API_KEY = os.getenv("DATA_GOV_API_KEY")
-    RESOURCE_ID = "6f655085-856d-4246-a516-5d6b3bebb990"
-    url = f"https://api.data.gov.in/resource/{RESOURCE_ID}?api-key={API_KEY}&format=json&limit=100"
 
-    def quintal_to_kg(price_quintal):
-        """Convert ₹ per quintal to ₹ per kg (1 quintal = 100 kg)."""
-        try:
-            return round(float(price_quintal) / 100.0, 2)
-        except (TypeError, ValueError):
-            return None
+PREFIX_CACHE = PrefixCache(GeminiCacheProvider(), PREFIX_CACHE_TTL, PREFIX_CACHE_REFRESH_MARGIN,
+                           PREFIX_CACHE_RETRY_SECONDS, enabled=PREFIX_CACHE_ENABLED,
+                           min_tokens=PREFIX_CACHE_MIN_TOKENS)
 
-    # Static short information for well-known crops
-    product_info = {
-        "wheat": {
-            "desc": "Wheat is a staple cereal grain widely used in breads and rotis.",
-            "benefits": "Rich in fiber and protein; aids digestion and heart health.",
-            "calories": "3.4 kcal/g"
-        },
-        "rice": {
-            "desc": "Rice is a key energy food and staple in most Indian diets.",
-            "benefits": "Provides quick energy and essential carbohydrates.",
-            "calories": "3.6 kcal/g"
-        },
-        "gram": {
-            "desc": "Gram (chickpea) is a protein-rich legume used in various dishes.",
-            "benefits": "Supports muscle growth and balances blood sugar.",
-            "calories": "3.8 kcal/g"
-        },
-        "mustard": {
-            "desc": "Mustard seeds are used for spice, oil extraction, and condiments.",
-            "benefits": "Boosts metabolism and contains anti-inflammatory compounds.",
-            "calories": "5.0 kcal/g"
-        },
-        "barley": {
-            "desc": "Barley is a nutrient-dense cereal known for its earthy flavor.",
-            "benefits": "Lowers cholesterol and promotes gut health.",
-            "calories": "3.5 kcal/g"
-        }
-    }
 
+def prefix_cached_request(messages, language, convo, model_name, key=None):
+    """Return (model, prompt) for a flat request, using a cached prefix when one is available.
+
+    The prefix is the language instruction plus the leading client system messages
+    (not rolling summaries, which are per conversation). Cached prefixes belong to the
+    primary key's project, so calls placed on another pooled `key` send the full prompt.
+    """
+    if key is not None and not key.primary:
+        return key.model(model_name), convo
+    head = 0
+    while head < len(messages) and (messages[head].get('role') or '').lower() == 'system' \
+            and not messages[head].get('summary'):
+        head += 1
+    instruction = "\n".join([f"System: {build_system_prompt(language)}"] + prompt_lines(messages[:head]))
+    cached_model = PREFIX_CACHE.model_for(model_name, instruction)
+    if cached_model is None:
+        return get_model(model_name), convo
+    return cached_model, "\n".join(prompt_lines(messages[head:]))
+
+
+# ---------- Advice response cache ----------
+class ResponseCache:
+    """Thread-safe TTL + LRU cache with hit/miss counters."""
+
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+
+    def discard(self, key):
+        """Drop `key`; returns whether it was cached."""
+        with self._lock:
+            return self._cache.pop(key, None) is not None
+
+    def discard_if(self, predicate):
+        """Drop every entry whose key satisfies `predicate`; returns how many were dropped."""
+        with self._lock:
+            stale = [k for k in list(self._cache.keys()) if predicate(k)]
+            for k in stale:
+                self._cache.pop(k, None)
+            return len(stale)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._cache),
+                "maxsize": self._cache.maxsize,
+                "ttl": self._cache.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+ADVICE_CACHE = ResponseCache(
+    maxsize=int(os.getenv("ADVICE_CACHE_SIZE", "2048")),
+    ttl=int(os.getenv("ADVICE_CACHE_TTL", str(6 * 3600))),
+)
+
+
+def normalize_text(text):
+    """Lowercase and collapse whitespace so trivially different inputs share a cache key."""
+    return " ".join(str(text or "").lower().split())
+
+
+def advice_cache_key(soil, climate, language, messages):
+    """Canonical key for an advice request: (soil, climate, language, normalized message list)."""
+    canonical = [
+        normalize_text(soil),
+        normalize_text(climate),
+        normalize_text(language or "english"),
+    ]
+    for m in messages:
+        role = (m.get('role') or 'user').lower()
+        if role == 'bot':
+            role = 'assistant'
+        canonical.append([role, normalize_text(m.get('content', ''))])
+    # hash so long conversations don't make the key itself the memory hog
+    return hashlib.sha256(json.dumps(canonical, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def cached_gemini_chat(soil, climate, language, messages, conv_id=None):
+    """call_gemini_chat with ADVICE_CACHE in front; only successful replies are cached.
+
+    On a miss the conversation is fitted into the context budget first (see fit_context),
+    or, in session mode, continued on its live ChatSession.
+    Returns (answer, context_stats); context_stats is None when nothing was sent upstream.
+    """
+    if not LLM.available():
+        return GEMINI_KEY_MISSING, None
+
+    key = advice_cache_key(soil, climate, language, messages)
+    cached = ADVICE_CACHE.get(key)
+    if cached is not None:
+        return cached, None
+    if not LLM.routable():
+        return degraded_advice(soil, climate, language), None
+
+    stats = None
     try:
-        response = requests.get(url, timeout=10)
-        data = response.json()
-        records = data.get("records", [])
-
-        match = next(
-            (r for r in records if crop in r.get("rabi_crop_wise", "").lower()),
-            None
-        )
-
-        if not match:
-            # No government data found. Try to enrich via Gemini if available.
-            if model is not None:
-                prompt_msgs = [
-                    {"role": "system", "content": "You are AgroAI, an expert agricultural assistant focused on South India and Tamil Nadu. When asked about an agricultural product, provide a concise JSON object with keys: desc, benefits, calories_per_g, estimated_price_per_kg, storage, common_uses. Respond only with valid JSON."},
-                    {"role": "user", "content": f"Provide JSON for the product '{crop}' with fields: desc, benefits, calories_per_g, estimated_price_per_kg, storage, common_uses. If you don't know the price, provide an approximate estimate for Tamil Nadu in INR per kg."}
-                ]
-                gresp = call_gemini_chat(prompt_msgs, language='english')
-                # try parse JSON
+        answer = None
+        if GEMINI_CHAT_MODE == 'session' and conv_id and model is not None:
+            with LLM_ADMISSION.admit():
                 try:
-                    parsed = json.loads(gresp)
-                    desc = parsed.get('desc', '')
-                    benefits = parsed.get('benefits', '')
-                    calories = parsed.get('calories_per_g', parsed.get('calories', ''))
-                    est_price = parsed.get('estimated_price_per_kg')
-                    price_str = f"₹{est_price}/kg" if est_price else ''
-                    details = f"Short Description: {desc}\nHealth Benefits: {benefits}\nCalories per gram: {calories}\nPrice (est): {price_str}\nStorage: {parsed.get('storage','')}\nCommon uses: {parsed.get('common_uses','')}"
-                    return jsonify({"results": [{"title": f"{crop.title()} — Estimated Details","description": details,"price_in_inr_per_kg": price_str,"source": "Gemini (estimated)"}]})
+                    with LLM.breakers["gemini"].guard(LATENCY_BUDGETS["chat"]):
+                        answer, stats = CHAT_SESSIONS.reply(conv_id, messages, language)
+                except Overloaded as e:
+                    # the default key is out of quota; the stateless path can use another key
+                    logger.info('Gemini chat session skipped: %s', e)
                 except Exception:
-                    # fallback: return raw text received
-                    return jsonify({"results": [{"title": f"{crop.title()} — Info","description": gresp, "source": "Gemini (raw)"}]})
-            else:
-                return jsonify({
-                    "results": [{
-                        "title": f"No MSP data found for '{crop}'.",
-                        "description": "Try common Rabi crops like Wheat, Gram, Barley, Mustard, etc.",
-                        "source": "data.gov.in"
-                    }]
-                })
+                    # the stateless path below can still fail over to another provider
+                    logger.exception('Gemini chat session error')
+        if answer is None:
+            prompt_messages, stats = fit_context(messages, language, conv_id)
+            answer = generate_reply(prompt_messages, language)
+    except Overloaded:
+        raise
+    except CircuitOpen:
+        return degraded_advice(soil, climate, language), stats
+    except Exception as e:
+        logger.exception('Gemini chat error')
+        return f"Error from Gemini: {e}", stats
+    if answer:
+        ADVICE_CACHE.put(key, answer)
+    return answer, stats
 
-        msp_2025 = match.get("_2025_26___msp")
-        msp_per_kg = quintal_to_kg(msp_2025)
-
-        info = product_info.get(crop, None)
-        # If government data exists but product_info is minimal/missing, try to enrich via Gemini
-        if (not info or not info.get('desc')) and model is not None:
-            prompt_msgs = [
-                {"role": "system", "content": "You are AgroAI, an expert agricultural assistant focused on South India and Tamil Nadu. Provide concise JSON with fields: desc, benefits, calories_per_g, storage, common_uses."},
-                {"role": "user", "content": f"Provide JSON for the product '{crop}' with keys desc, benefits, calories_per_g, storage, common_uses. Keep it short."}
-            ]
-            gresp = call_gemini_chat(prompt_msgs, language='english')
-            try:
-                parsed = json.loads(gresp)
-                info = {
-                    'desc': parsed.get('desc', 'An agricultural product.'),
-                    'benefits': parsed.get('benefits', ''),
-                    'calories': parsed.get('calories_per_g', parsed.get('calories', ''))
-                }
-            except Exception:
-                # leave info as fallback
-                if not info:
-                    info = {
-                        'desc': 'An agricultural product widely cultivated across India.',
-                        'benefits': 'Provides essential nutrients and supports human health.',
-                        'calories': 'Varies between 3–5 kcal/g'
-                    }
-
-        # Build response description
-        desc_lines = []
-        if msp_2025:
-            desc_lines.append(f"MSP: ₹{msp_2025}/quintal (₹{msp_per_kg}/kg)")
-        if info:
-            desc_lines.append(f"Short Description: {info.get('desc','')}")
-            desc_lines.append(f"Health Benefits: {info.get('benefits','')}")
-            desc_lines.append(f"Calories per gram: {info.get('calories','')}")
-
-        return jsonify({
-            "results": [{
-                "title": f"{match.get('rabi_crop_wise', crop).title()} — MSP (2025-26)",
-                "description": "\n".join(desc_lines),
-                "price_in_inr_per_kg": (f"₹{msp_per_kg}/kg" if msp_per_kg else ''),
-                "source": "Government of India (Rajya Sabha)"
-            }]
-        })
 
-    except Exception as e:
-        logger.exception('DATA_GOV fetch failed')
-        # Try to fall back to Gemini for estimated product details if available
-        if model is not None:
-            try:
-                prompt_msgs = [
-                    {"role": "system", "content": "You are AgroAI, an expert agricultural assistant focused on South India and Tamil Nadu. When asked about an agricultural product, provide a concise text reply with lines: MSP (if known), Short Description, Health Benefits, Calories per gram, Price (estimate in ₹/kg). Keep replies short and human-readable."},
-                    {"role": "user", "content": f"Provide details for the product '{crop}' with MSP if known, plus a short description, health benefits, calories per gram, and an estimated price in INR per kg for Tamil Nadu."}
-                ]
-                gresp = call_gemini_chat(prompt_msgs, language='english')
-                # ensure simple output formatting similar to expected gov output
-                # If Gemini returns JSON or raw text, just place it in description
-                return jsonify({"results": [{"title": f"{crop.title()} — Estimated Details","description": str(gresp),"price_in_inr_per_kg": "","source": "Gemini (fallback)"}]})
-            except Exception:
-                logger.exception('Gemini fallback failed')
-                return jsonify({"error": "Failed to fetch MSP data and Gemini fallback failed. Please try again later."})
-        else:
-            return jsonify({"error": "Failed to fetch MSP data (network error). Please try again later."})
+# ---------- Conversation store ----------
+# Clients send only the new user turn plus a conversation_id; the server rebuilds the
+# context from the message log (see stores.ConversationStore).
+CONVERSATION_DB = os.getenv("CONVERSATION_DB", os.path.join(app.root_path, "agrobot.db"))
+
+
+def soil_climate_context(soil, climate):
+    """The soil/climate system message the chat UI pins to the start of a conversation."""
+    return f"Soil: {soil} | Climate: {climate}\nPlease always answer user queries taking into account these soil and climate conditions."
+
+
+CONVERSATIONS = ConversationStore(CONVERSATION_DB)
+
+
+class InvalidRequest(ValueError):
+    """The request body is malformed; answered with a JSON 400."""
+
+
+@app.errorhandler(InvalidRequest)
+def invalid_request(e):
+    return jsonify({"error": str(e)}), 400
+
+
+def seed_messages(data):
+    """The client-held `messages` of a new conversation as (role, content) pairs; raises InvalidRequest."""
+    seed = data.get("messages") or []
+    if not isinstance(seed, list):
+        raise InvalidRequest("messages must be a list")
+    pairs = []
+    for i, m in enumerate(seed):
+        if not isinstance(m, dict) or not isinstance(m.get('content'), str):
+            raise InvalidRequest(f"messages[{i}] needs a string content")
+        if not isinstance(m.get('role') or 'user', str):
+            raise InvalidRequest(f"messages[{i}].role must be a string")
+        pairs.append(((m.get('role') or 'user').lower(), m['content']))
+    return pairs
+
+
+def advice_context(data):
+    """Resolve an advice request into (messages, conversation_id, turn).
+
+    Requests carrying `message` (the new user turn) are stored server-side: the turn is
+    appended to `conversation_id` (created if missing, seeded with the soil/climate
+    context or any `messages` the client still holds) and the full history is read back.
+    `turn` records that write for drop_advice_turn. Requests without `message` keep the
+    stateless full-history contract and get (messages, None, None).
+    """
+    text = data.get("message")
+    if text is None:
+        return advice_messages(data), None, None
+    if not isinstance(text, str):
+        raise InvalidRequest("message must be a string")
+
+    conv_id = data.get("conversation_id")
+    if conv_id is not None and not isinstance(conv_id, str):
+        raise InvalidRequest("conversation_id must be a string")
+    created = not conv_id or not CONVERSATIONS.exists(conv_id)
+    if created:
+        soil, climate = data.get("soil_type"), data.get("climate")
+        # validated up front and written in one transaction: a bad seed leaves nothing behind
+        seed = seed_messages(data)
+        if soil and climate and not any(role == 'system' for role, _ in seed):
+            seed.insert(0, ('system', soil_climate_context(soil, climate)))
+        conv_id = CONVERSATIONS.create(soil, climate, data.get("language", "english"), seed)
+
+    message_id = CONVERSATIONS.append(conv_id, 'user', text)
+    return CONVERSATIONS.messages(conv_id), conv_id, (conv_id, message_id, created)
+
+
+def drop_advice_turn(turn):
+    """Undo advice_context's write for a request shed as Overloaded.
+
+    The client is told to retry, so the turn (or the conversation it just created) must
+    not stay behind: the retry would store it a second time.
+    """
+    if turn:
+        CONVERSATIONS.discard(*turn)
+
+
+def advice_response(answer, conv_id, context_stats=None):
+    """Record the assistant turn (for stored conversations) and build the /get_advice payload."""
+    payload = {"response": answer, "timestamp": datetime.utcnow().isoformat() + "Z"}
+    if context_stats:
+        payload["context"] = context_stats
+    if conv_id:
+        if not is_error_reply(answer):
+            CONVERSATIONS.append(conv_id, 'assistant', answer)
+        payload["conversation_id"] = conv_id
+    return payload
+
+
+# ---------- Context window ----------
+# Long chats are fitted into a per-request token budget: the language system prompt and
+# any client system messages are always kept, the most recent turns are sent verbatim,
+# and older turns are folded into a rolling summary. The summary is extended in batches
+# of SUMMARY_REFRESH_TURNS so most requests reuse it instead of regenerating it.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "8000"))
+CONTEXT_KEEP_TURNS = int(os.getenv("CONTEXT_KEEP_TURNS", "4"))
+SUMMARY_REFRESH_TURNS = int(os.getenv("SUMMARY_REFRESH_TURNS", "6"))
+SUMMARY_TOKEN_RESERVE = 400
+
+SUMMARY_PROMPT = ("You maintain a running summary of a conversation between a farmer and AgroAI. "
+                  "Merge the previous summary with the new turns into one concise summary (max 200 words). "
+                  "Keep crops, soil and climate details, quantities, prices, decisions and open questions. "
+                  "Reply with the summary text only.")
+
+_summaries = TTLCache(maxsize=int(os.getenv("SUMMARY_CACHE_SIZE", "4096")), ttl=24 * 3600)
+_summaries_lock = threading.Lock()
+CONTEXT_STATS = {"requests_fitted": 0, "summaries_generated": 0, "summaries_reused": 0,
+                 "summary_failures": 0, "tokens_dropped": 0}
+
+
+def estimate_tokens(text):
+    """Rough Gemini token count (~4 characters per token); avoids a count_tokens round trip."""
+    return (len(text or "") + 3) // 4
+
+
+def _turns_digest(turns):
+    return hashlib.sha256(json.dumps([[m.get('role'), m.get('content')] for m in turns],
+                                     ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def _thread_key(turns, language, thread_key):
+    if thread_key:
+        return thread_key
+    # stateless clients: a conversation is identified by its opening turn
+    return _turns_digest(turns[:1]) + ":" + normalize_text(language)
+
+
+def summarize_turns(previous, turns):
+    """Fold `turns` into the `previous` summary text with one Gemini call."""
+    lines = [f"Previous summary: {previous or '(none)'}", "", "New turns:"]
+    for m in turns:
+        role = "Assistant" if (m.get('role') or '').lower() in ('assistant', 'bot') else "User"
+        lines.append(f"{role}: {m.get('content', '')}")
+    return generate_reply([{"role": "system", "content": SUMMARY_PROMPT},
+                           {"role": "user", "content": "\n".join(lines)}], route="summary")
+
+
+def fit_context(messages, language="english", thread_key=None):
+    """Fit `messages` into CONTEXT_TOKEN_BUDGET. Returns (prompt_messages, stats).
+
+    stats: tokens_in (estimated tokens sent), tokens_dropped (turn tokens replaced by the
+    summary or truncated), turns_summarized, summary_reused, summary_regenerated.
+    """
+    system_msgs = [m for m in messages if (m.get('role') or '').lower() == 'system']
+    turns = [m for m in messages if (m.get('role') or '').lower() != 'system']
+    fixed = estimate_tokens(build_system_prompt(language)) + sum(estimate_tokens(m.get('content')) for m in system_msgs)
+    sizes = [estimate_tokens(m.get('content')) for m in turns]
+    stats = {"tokens_in": fixed + sum(sizes), "tokens_dropped": 0, "turns_summarized": 0,
+             "summary_reused": False, "summary_regenerated": False}
+
+    with _summaries_lock:
+        CONTEXT_STATS["requests_fitted"] += 1
+    if stats["tokens_in"] <= CONTEXT_TOKEN_BUDGET:
+        return messages, stats
+
+    # smallest cut such that turns[cut:] (plus room for the summary) fits; the last
+    # CONTEXT_KEEP_TURNS turns (at least the new one) are kept verbatim even past the budget
+    room = CONTEXT_TOKEN_BUDGET - fixed - SUMMARY_TOKEN_RESERVE
+    cut, tail = len(turns), 0
+    while cut > 0 and tail + sizes[cut - 1] <= room:
+        cut -= 1
+        tail += sizes[cut]
+    cut = max(0, min(cut, len(turns) - max(1, CONTEXT_KEEP_TURNS)))
+
+    key = _thread_key(turns, language, thread_key)
+    with _summaries_lock:
+        state = _summaries.get(key)
+    if state and (state["covered"] > len(turns) or state["digest"] != _turns_digest(turns[:state["covered"]])):
+        state = None  # history was edited or belongs to another thread
+    covered, summary = (state["covered"], state["text"]) if state else (0, "")
+
+    if cut <= covered:
+        stats["summary_reused"] = True
+    else:
+        # summarize SUMMARY_REFRESH_TURNS past the minimum so the next few requests can reuse it
+        new_cut = max(cut, min(cut + SUMMARY_REFRESH_TURNS, len(turns) - CONTEXT_KEEP_TURNS))
+        try:
+            summary = summarize_turns(summary, turns[covered:new_cut])
+            covered = new_cut
+            stats["summary_regenerated"] = True
+            with _summaries_lock:
+                _summaries[key] = {"covered": covered, "digest": _turns_digest(turns[:covered]), "text": summary}
+        except Exception:
+            logger.exception('Context summary failed; truncating history instead')
+            with _summaries_lock:
+                CONTEXT_STATS["summary_failures"] += 1
+            summary, covered = "", cut
+
+    prompt = list(system_msgs)
+    if summary:
+        # flagged so the prefix cache never treats a per-conversation summary as shared context
+        prompt.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}", "summary": True})
+    prompt.extend(turns[covered:])
+
+    stats["turns_summarized"] = covered
+    stats["tokens_dropped"] = sum(sizes[:covered])
+    stats["tokens_in"] = fixed + estimate_tokens(prompt[len(system_msgs)]["content"]) * bool(summary) + sum(sizes[covered:])
+    with _summaries_lock:
+        CONTEXT_STATS["tokens_dropped"] += stats["tokens_dropped"]
+        if stats["summary_regenerated"]:
+            CONTEXT_STATS["summaries_generated"] += 1
+        elif stats["summary_reused"] and summary:
+            CONTEXT_STATS["summaries_reused"] += 1
+    logger.info('context fitted: %s', stats)
+    return prompt, stats
+
+
+# ---------- Native chat sessions ----------
+# In GEMINI_CHAT_MODE=session, stored conversations are served from live ChatSessions that
+# carry the language prompt and soil/climate context as a real system_instruction and
+# keep prior turns as native user/model contents, so a follow-up only hands the SDK
+# the new message instead of re-flattening the whole history into one text prompt.
+CHAT_POOL_MAX_SESSIONS = int(os.getenv("CHAT_POOL_MAX_SESSIONS", "500"))
+CHAT_POOL_MAX_BYTES = int(os.getenv("CHAT_POOL_MAX_BYTES", str(64 * 1024 * 1024)))
+CHAT_POOL_IDLE_SECONDS = int(os.getenv("CHAT_POOL_IDLE_SECONDS", "1800"))
+
+
+def session_model(system_instruction):
+    return genai.GenerativeModel(MODEL_ROUTES["chat"], system_instruction=system_instruction)
+
+
+def to_gemini_history(turns):
+    """Convert user/assistant turns to Gemini contents, merging consecutive same-role turns."""
+    history = []
+    for m in turns:
+        role = "model" if (m.get('role') or '').lower() in ('assistant', 'bot') else "user"
+        if history and history[-1]["role"] == role:
+            history[-1]["parts"][0] += "\n\n" + m.get('content', '')
+        else:
+            history.append({"role": role, "parts": [m.get('content', '')]})
+    return history
+
+
+def _utf8_len(text):
+    return len((text or "").encode('utf-8'))
+
+
+class ChatSessionPool:
+    """Live Gemini ChatSessions keyed by conversation id.
+
+    Bounded by session count and by an approximate byte budget (system instruction plus
+    history text per session); least recently used and idle sessions are evicted first.
+    A session is rebuilt from the conversation store whenever it is missing, out of step
+    with the stored history, or has outgrown CONTEXT_TOKEN_BUDGET.
+    """
+
+    class _Entry:
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.chat = None
+            self.system = None
+            self.turns = 0  # stored (non-system) turns this session has seen
+            self.bytes = 0
+            self.last_used = time.monotonic()
+
+    def __init__(self, max_sessions, max_bytes, idle_seconds):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.counters = {"created": 0, "reused": 0, "rebuilt": 0, "evicted": 0}
+
+    def reply(self, conv_id, messages, language="english"):
+        """Send the last (user) message on the conversation's session. Returns (text, stats)."""
+        entry = self._checkout(conv_id)
+        try:
+            with entry.lock:
+                new_turn, stats = self._prepare(entry, conv_id, messages, language)
+                with self._quota(entry, new_turn), ROUTER.timed(MODEL_ROUTES["chat"]):
+                    resp = entry.chat.send_message(new_turn)
+                text = getattr(resp, 'text', str(resp)).strip()
+                self._record(entry, new_turn, text)
+        except Overloaded:
+            raise  # no quota on the default key; the session itself is fine
+        except Exception:
+            entry.chat = None
+            raise
+        finally:
+            self._enforce()
+        return text, stats
+
+    def stream(self, conv_id, messages, language="english"):
+        """Like reply, but yields text chunks; the stats dict is yielded first."""
+        entry = self._checkout(conv_id)
+        parts = []
+        try:
+            with entry.lock:
+                new_turn, stats = self._prepare(entry, conv_id, messages, language)
+                # quota is taken before the stats go out, so a caller can still switch paths
+                with self._quota(entry, new_turn):
+                    yield stats
+                    for chunk in entry.chat.send_message(new_turn, stream=True):
+                        try:
+                            text = chunk.text
+                        except ValueError:
+                            continue
+                        if text:
+                            parts.append(text)
+                            yield text
+                self._record(entry, new_turn, "".join(parts))
+        except Overloaded:
+            raise  # no quota on the default key; the session itself is fine
+        except Exception:
+            entry.chat = None
+            raise
+        finally:
+            self._enforce()
+
+    def _prepare(self, entry, conv_id, messages, language):
+        """Make sure `entry` holds a session in step with `messages`; caller holds entry.lock."""
+        system_msgs = [m for m in messages if (m.get('role') or '').lower() == 'system']
+        turns = [m for m in messages if (m.get('role') or '').lower() != 'system']
+        system = "\n\n".join([build_system_prompt(language)] + [m.get('content', '') for m in system_msgs])
+
+        stats = {"session": "reused"}
+        stale = (entry.chat is None or entry.system != system or entry.turns != len(turns) - 1
+                 or entry.bytes // 4 > CONTEXT_TOKEN_BUDGET)
+        if stale:
+            stats = self._rebuild(entry, conv_id, messages, language, system)
+            stats["session"] = "created" if stats.pop("first") else "rebuilt"
+        with self._lock:
+            self.counters[stats["session"]] += 1
+        return turns[-1].get('content', ''), stats
+
+    def _rebuild(self, entry, conv_id, messages, language, system):
+        first = entry.chat is None and entry.system is None
+        fitted, stats = fit_context(messages, language, conv_id)
+        fitted_system = [m for m in fitted if (m.get('role') or '').lower() == 'system']
+        fitted_turns = [m for m in fitted if (m.get('role') or '').lower() != 'system'][:-1]
+        instruction = "\n\n".join([build_system_prompt(language)] + [m.get('content', '') for m in fitted_system])
+
+        entry.chat = session_model(instruction).start_chat(history=to_gemini_history(fitted_turns))
+        entry.system = system
+        entry.turns = len([m for m in messages if (m.get('role') or '').lower() != 'system']) - 1
+        entry.bytes = _utf8_len(instruction) + sum(_utf8_len(m.get('content')) for m in fitted_turns)
+        stats["first"] = first
+        return stats
+
+    def _quota(self, entry, new_turn):
+        # sessions live on the default client, so their calls count against the first key
+        tokens = entry.bytes // 4 + estimate_tokens(new_turn) + GEMINI_REPLY_TOKENS
+        return GEMINI_KEYS.reserve(MODEL_ROUTES["chat"], tokens, primary_only=True)
+
+    def _record(self, entry, sent, received):
+        entry.turns += 2
+        entry.bytes += _utf8_len(sent) + _utf8_len(received)
+        entry.last_used = time.monotonic()
+
+    def _checkout(self, conv_id):
+        with self._lock:
+            entry = self._entries.get(conv_id)
+            if entry is None:
+                entry = self._entries[conv_id] = self._Entry()
+            self._entries.move_to_end(conv_id)
+            entry.last_used = time.monotonic()
+        self._enforce()
+        return entry
+
+    def _enforce(self):
+        """Evict idle sessions, then LRU sessions until count and byte budgets hold."""
+        now = time.monotonic()
+        with self._lock:
+            for conv_id, entry in list(self._entries.items()):
+                if now - entry.last_used > self.idle_seconds and not entry.lock.locked():
+                    del self._entries[conv_id]
+                    self.counters["evicted"] += 1
+            total = sum(e.bytes for e in self._entries.values())
+            for conv_id, entry in list(self._entries.items()):
+                if len(self._entries) <= self.max_sessions and total <= self.max_bytes:
+                    break
+                if entry.lock.locked():
+                    continue
+                del self._entries[conv_id]
+                total -= entry.bytes
+                self.counters["evicted"] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, sessions=len(self._entries),
+                        bytes=sum(e.bytes for e in self._entries.values()),
+                        max_sessions=self.max_sessions, max_bytes=self.max_bytes)
+
+
+CHAT_SESSIONS = ChatSessionPool(CHAT_POOL_MAX_SESSIONS, CHAT_POOL_MAX_BYTES, CHAT_POOL_IDLE_SECONDS)
+
+
+# ---------- Precomputed advice matrix ----------
+# The index page offers a fixed set of soils, climates and languages, so the first
+# "what should I grow?" of a conversation has one answer per combination. Those answers
+# are generated offline by `flask build-advice-matrix` (bounded concurrency, request
+# rate throttling, resumable) into a versioned JSON-lines artifact, which is loaded once
+# at startup and served by /get_advice without a Gemini call.
+ADVICE_MATRIX_VERSION = 1
+ADVICE_MATRIX_PATH = os.getenv(
+    "ADVICE_MATRIX_PATH", os.path.join(app.root_path, "data", f"advice_matrix.v{ADVICE_MATRIX_VERSION}.jsonl"))
+ADVICE_LANGUAGES = ["english"] + list(LANGUAGE_PROMPTS)
+DEFAULT_ADVICE_QUERY = "What should I grow?"
+# first questions that mean the same thing as DEFAULT_ADVICE_QUERY
+DEFAULT_ADVICE_QUERIES = {
+    "what should i grow", "what should i grow here", "what can i grow", "what to grow",
+    "what crops should i grow", "which crops should i grow", "which crop should i grow",
+    "what crop should i grow", "which crops are suitable", "what crops are suitable",
+    "suggest crops", "suggest crops to grow", "best crops", "best crops to grow",
+}
+
+
+def advice_matrix_fingerprint():
+    """Changes whenever the prompts or model behind the matrix change; stale artifacts are ignored."""
+    parts = [MODEL_ROUTES["matrix"], DEFAULT_ADVICE_QUERY, soil_climate_context("{soil}", "{climate}")]
+    parts += [build_system_prompt(lang) for lang in ADVICE_LANGUAGES]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def matrix_cell_key(soil, climate, language):
+    return f"{soil}|{climate}|{language}"
+
+
+def matrix_prompt(soil, climate):
+    return [{"role": "system", "content": soil_climate_context(soil, climate)},
+            {"role": "user", "content": DEFAULT_ADVICE_QUERY}]
+
+
+class AdviceMatrix:
+    """Precomputed default answers, one JSON line per soil/climate/language cell.
+
+    The first line is a header ({"version", "fingerprint", "model"}); the rest are
+    {"key", "answer"}. Appending one line per finished cell is what makes the generator
+    resumable; a torn last line from an interrupted run is skipped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fingerprint = advice_matrix_fingerprint()
+        self._answers = {}
+        self.hits = 0
+        self.load()
+
+    def load(self):
+        answers = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                header = json.loads(f.readline() or "{}")
+                if header.get("version") != ADVICE_MATRIX_VERSION or header.get("fingerprint") != self.fingerprint:
+                    logger.warning('Advice matrix %s is stale (prompts or model changed); not serving it', self.path)
+                else:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue
+                        answers[entry["key"]] = entry["answer"]
+        except FileNotFoundError:
+            pass
+        self._answers = answers
+        return answers
+
+    def get(self, soil, climate, language):
+        answer = self._answers.get(matrix_cell_key(soil, climate, language))
+        if answer is not None:
+            self.hits += 1
+        return answer
+
+    def stats(self):
+        total = len(SOIL_TYPES) * len(CLIMATE_ZONES) * len(ADVICE_LANGUAGES)
+        return {"path": self.path, "version": ADVICE_MATRIX_VERSION, "cells": len(self._answers),
+                "total_cells": total, "hits": self.hits}
+
+
+ADVICE_MATRIX = AdviceMatrix(ADVICE_MATRIX_PATH)
+
+
+def default_advice_cell(data, messages):
+    """(soil, climate, language) when `messages` is just the default first question, else None."""
+    soil, climate = data.get("soil_type"), data.get("climate")
+    language = (data.get("language") or "english").lower()
+    if soil not in SOIL_TYPES or climate not in CLIMATE_ZONES or language not in ADVICE_LANGUAGES:
+        return None
+    turns = [m for m in messages if (m.get("role") or "user").lower() != "system"]
+    if len(turns) != 1 or (turns[0].get("role") or "user").lower() != "user":
+        return None
+    text = turns[0].get("content", "")
+    # the stateless form wraps the question: "Soil: ...\nClimate: ...\nQuery: <q>"
+    if "\nQuery:" in text:
+        text = text.split("\nQuery:", 1)[1]
+    if normalize_text(re.sub(r"[?!.,]", " ", text)) not in DEFAULT_ADVICE_QUERIES:
+        return None
+    return soil, climate, language
+
+
+def precomputed_advice(data, messages):
+    cell = default_advice_cell(data, messages)
+    return ADVICE_MATRIX.get(*cell) if cell else None
+
+
+def degraded_advice(soil, climate, language="english"):
+    """What /get_advice says while every LLM breaker is open: the precomputed answer for
+    this soil/climate when there is one, else the soil and climate notes."""
+    language = (language or "english").lower()
+    general = None
+    if soil in SOIL_TYPES and climate in CLIMATE_ZONES:
+        general = ADVICE_MATRIX.get(soil, climate, language if language in ADVICE_LANGUAGES else "english")
+    if general:
+        return f"{ADVICE_DEGRADED} General guidance for {soil} soil in a {climate} climate:\n\n{general}"
+    notes = [f"{ADVICE_DEGRADED} Please try again in a few minutes."]
+    if soil in SOIL_TYPES:
+        notes.append(f"Soil ({soil}): {SOIL_TYPES[soil]}.")
+    if climate in CLIMATE_ZONES:
+        notes.append(f"Climate ({climate}): {CLIMATE_ZONES[climate]}.")
+    return "\n".join(notes)
+
+
+class RateLimiter:
+    """Spaces calls at least 60/rpm seconds apart across threads."""
+
+    def __init__(self, rpm):
+        self.interval = 60.0 / rpm if rpm > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+
+@app.cli.command('build-advice-matrix')
+@click.option('--concurrency', default=4, show_default=True, help='Gemini calls in flight.')
+@click.option('--rpm', default=30, show_default=True, help='Maximum Gemini requests per minute (0 = unthrottled).')
+@click.option('--retries', default=3, show_default=True, help='Attempts per cell before leaving it for the next run.')
+@click.option('--limit', default=0, help='Stop after this many new cells (0 = all).')
+def build_advice_matrix_command(concurrency, rpm, retries, limit):
+    """Generate the default answer for every soil x climate x language, resuming a previous run."""
+    if model is None:
+        print(GEMINI_KEY_MISSING)
+        return
+    done = ADVICE_MATRIX.load()
+    if not done:
+        # new artifact (or stale one): start it with a fresh header
+        os.makedirs(os.path.dirname(ADVICE_MATRIX_PATH) or ".", exist_ok=True)
+        with open(ADVICE_MATRIX_PATH, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"version": ADVICE_MATRIX_VERSION, "fingerprint": ADVICE_MATRIX.fingerprint,
+                                "model": MODEL_ROUTES["matrix"],
+                                "created_at": datetime.utcnow().isoformat() + "Z"}) + "\n")
+    cells = [(s, c, l) for s in SOIL_TYPES for c in CLIMATE_ZONES for l in ADVICE_LANGUAGES
+             if matrix_cell_key(s, c, l) not in done]
+    if limit:
+        cells = cells[:limit]
+    print(f"{len(done)} cells already built, generating {len(cells)}")
+    limiter = RateLimiter(rpm)
+    write_lock = threading.Lock()
+
+    def build(cell):
+        soil, climate, language = cell
+        for attempt in range(retries):
+            limiter.wait()
+            try:
+                # Gemini only, on the pinned matrix route: the artifact's header and fingerprint name its model
+                answer = gemini_reply(matrix_prompt(soil, climate), language, route="matrix").strip()
+            except Exception as e:
+                logger.warning('Advice matrix cell %s failed (attempt %d): %s', cell, attempt + 1, e)
+                time.sleep(min(60, 2 ** attempt + random.random()))
+                continue
+            if not answer:
+                continue
+            with write_lock, open(ADVICE_MATRIX_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"key": matrix_cell_key(soil, climate, language), "answer": answer},
+                                   ensure_ascii=False) + "\n")
+            return True
+        return False
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        built = sum(pool.map(build, cells))
+    ADVICE_MATRIX.load()
+    print(f"Built {built} cells ({len(cells) - built} failed; rerun to retry) -> {ADVICE_MATRIX_PATH}")
+
+
+# ---------- Routes ----------
+@app.route('/')
+def home():
+    try:
+        return render_template('index.html', soil_types=SOIL_TYPES, climate_zones=CLIMATE_ZONES)
+    except Exception as e:
+        logger.exception('Error rendering index')
+        return ("An internal error occurred while rendering the main page. "
+                "Check server logs for details."), 500
+
+
+@app.route('/market')
+def market_page():
+    try:
+        return render_template('market.html', soil_types=SOIL_TYPES, climate_zones=CLIMATE_ZONES)
+    except Exception as e:
+        logger.exception('Error rendering market page')
+        return ("Internal error rendering market page."), 500
+
+
+@app.route('/login')
+def login_page():
+    try:
+        return render_template('login.html')
+    except Exception as e:
+        logger.exception('Error rendering login page')
+        return ("Internal error rendering login page."), 500
+
+
+@app.route('/register')
+def register_page():
+    try:
+        return render_template('register.html')
+    except Exception as e:
+        logger.exception('Error rendering register page')
+        return ("Internal error rendering register page."), 500
+
+
+def advice_messages(data):
+    """Return the message list for an advice request, building one from soil/climate/query if absent."""
+    messages = data.get("messages", [])
+    if not messages:
+        q = data.get("query", "")
+        messages = [{"role": "user", "content": f"Soil: {data.get('soil_type')}\nClimate: {data.get('climate')}\nQuery: {q}"}]
+    return messages
+
+
+@app.route('/get_advice', methods=['POST'])
+def get_advice():
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        return get_advice_stream()
+
+    data = request.get_json() or {}
+    language = data.get("language", "english")
+    messages, conv_id, turn = advice_context(data)
+
+    answer = precomputed_advice(data, messages)
+    if answer is not None:
+        return jsonify(advice_response(answer, conv_id))
+    try:
+        answer, stats = cached_gemini_chat(data.get("soil_type"), data.get("climate"), language, messages, conv_id)
+    except Overloaded:
+        drop_advice_turn(turn)
+        raise
+    return jsonify(advice_response(answer, conv_id, stats))
+
+
+@app.route('/get_advice/stream', methods=['POST'])
+def get_advice_stream():
+    """Stream the advice reply as Server-Sent Events.
+
+    Emits `chunk` events ({"text": ...}) as Gemini generates, then one `done` event
+    with the full response and timestamp (same shape as /get_advice).
+    Cached replies are sent as a single chunk.
+    """
+    data = request.get_json() or {}
+    language = data.get("language", "english")
+    messages, conv_id, turn = advice_context(data)
+    key = advice_cache_key(data.get("soil_type"), data.get("climate"), language, messages)
+
+    ready = precomputed_advice(data, messages)
+    if ready is None and not LLM.available():
+        ready = GEMINI_KEY_MISSING
+    if ready is None:
+        ready = ADVICE_CACHE.get(key)
+    if ready is None and not LLM.routable():
+        ready = degraded_advice(data.get("soil_type"), data.get("climate"), language)
+    # an LLM call follows: admit it before any headers go out, so overload is a real
+    # 429/503 with Retry-After (llm_overloaded); the generator releases the slot
+    slot = [False]
+    if ready is None:
+        try:
+            LLM_ADMISSION.acquire()
+        except Overloaded:
+            drop_advice_turn(turn)
+            raise
+        slot[0] = True
+
+    def release_unused():
+        # the client went away before the stream started
+        if slot[0]:
+            slot[0] = False
+            LLM_ADMISSION.release(0.0)
+
+    def generate():
+        stats = None
+        if ready is not None:
+            parts = [ready]
+            yield sse_event("chunk", {"text": ready})
+        else:
+            parts = []
+            slot[0] = False
+            with LLM_ADMISSION.holding():
+                try:
+                    chunks = None
+                    if (GEMINI_CHAT_MODE == 'session' and conv_id and model is not None
+                            and LLM.breakers["gemini"].routable()):
+                        try:
+                            chunks = CHAT_SESSIONS.stream(conv_id, messages, language)
+                            stats = next(chunks)
+                        except Overloaded as e:
+                            # the default key is out of quota; the stateless path can use another key
+                            logger.info('Gemini chat session skipped: %s', e)
+                            chunks = None
+                    if chunks is None:
+                        prompt_messages, stats = fit_context(messages, language, conv_id)
+                        chunks = iter_gemini_reply(prompt_messages, language)
+                    for text in chunks:
+                        parts.append(text)
+                        yield sse_event("chunk", {"text": text})
+                    answer = "".join(parts).strip()
+                    # an empty stream (e.g. a safety block) must not become a cached answer
+                    if answer and not is_error_reply(answer):
+                        ADVICE_CACHE.put(key, answer)
+                except Overloaded as e:
+                    # headers are already sent: report it in-band, after whatever was streamed
+                    drop_advice_turn(turn)
+                    busy = f"Server busy: {e}. Please retry in {e.retry_after} s."
+                    parts = [busy]
+                    yield sse_event("chunk", {"text": busy})
+                except CircuitOpen:
+                    degraded = degraded_advice(data.get("soil_type"), data.get("climate"), language)
+                    parts.append(degraded)
+                    yield sse_event("chunk", {"text": degraded})
+                except Exception as e:
+                    logger.exception('Gemini stream error')
+                    err = f"Error from Gemini: {e}"
+                    parts.append(err)
+                    yield sse_event("chunk", {"text": err})
+        yield sse_event("done", advice_response("".join(parts).strip(), conv_id, stats))
+
+    resp = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    resp.call_on_close(release_unused)
+    return resp
+
+
+def health_status():
+    """Upstream breaker states; "degraded" while any breaker is not closed."""
+    breakers = {name: b.stats() for name, b in CIRCUIT_BREAKERS.items()}
+    degraded = any(b["state"] != CircuitBreaker.CLOSED for b in breakers.values())
+    return {
+        "status": "degraded" if degraded else "ok",
+        "llm": "ok" if LLM.routable() else "unavailable" if LLM.available() else "not_configured",
+        "msp_mirror_ready": MSP_MIRROR.ready,
+        "breakers": breakers,
+    }
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify(health_status())
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Process-local counters for the caches and upstream layers."""
+    return jsonify({
+        "advice_cache": ADVICE_CACHE.stats(),
+        "advice_matrix": ADVICE_MATRIX.stats(),
+        "context": dict(CONTEXT_STATS),
+        "single_flight": {f.name: f.stats() for f in (GEMINI_FLIGHT, DATA_GOV_FLIGHT)},
+        "chat_sessions": CHAT_SESSIONS.stats(),
+        "prefix_cache": PREFIX_CACHE.stats(),
+        "router": ROUTER.stats(),
+        "llm_providers": LLM.stats(),
+        "llm_admission": LLM_ADMISSION.stats(),
+        "gemini_keys": GEMINI_KEYS.stats(),
+        "circuit_breakers": {name: b.stats() for name, b in CIRCUIT_BREAKERS.items()},
+        "msp_last_good": {k: v for k, v in MSP_LAST_GOOD.items() if k != "records"},
+        "msp_mirror": MSP_MIRROR.stats(),
+        "upstream_http": UPSTREAM.stats(),
+        "mandi_prices": MANDI_STORE.stats(),
+        "crop_knowledge": CROP_KNOWLEDGE.stats(),
+        "speculation": speculation_stats(),
+        "msp_miss_cache": MSP_MISS_CACHE.stats(),
+        "crop_synonyms": CROP_SYNONYMS.stats(),
+        "extraction_schemas": {rid: schema.describe() for rid, schema in list(_schemas.items())},
+    })
+
+
+# ---------- Real-Time Market Price (INR/kg) ----------
+import os
+
+DATA_GOV_API_KEY = os.getenv("DATA_GOV_API_KEY")        # get this from https://data.gov.in/ (register -> API key)
+DATA_GOV_RESOURCE_ID = os.getenv("DATA_GOV_RESOURCE_ID")  # dataset resource id (open dataset page -> API -> copy resource_id)
+DATA_GOV_BASE_URL = os.getenv("DATA_GOV_BASE_URL", "https://api.data.gov.in").rstrip("/")  # override to point at a local fake upstream
+# Example dataset page (Agmarknet daily prices) on data.gov.in: "Current daily price of various commodities from various markets (Mandi)". :contentReference[oaicite:3]{index=3}
+
+# ---------- data.gov.in field extraction ----------
+# data.gov.in resources spell their columns differently (modal_price, "Modal Price", ...)
+# and quote prices per quintal, kg or tonne. Instead of probing every spelling on every
+# record, the column mapping and unit convention are inferred once per resource from a
+# sample, cached, and compiled into an extractor that is run over whole batches.
+FIELD_CANDIDATES = {
+    "modal": ("modal_price", "modalprice", "modal price", "modal"),
+    "min": ("min_price", "minprice", "min price"),
+    "max": ("max_price", "maxprice", "max price"),
+    "unit": ("price_unit", "unit", "priceunit"),
+    "date": ("price_date", "date", "recorded_date", "trade_date", "arrival_date"),
+    "market": ("market", "market_name", "marketname", "marketplace"),
+    "commodity": ("commodity", "commodity_name"),
+    "state": ("state", "state_name"),
+    "district": ("district", "district_name"),
+    "variety": ("variety",),
+}
+SCHEMA_SAMPLE_SIZE = 50
+MISSING = (None, "", "NA")
+
+# divide a quoted price by this to get INR/kg
+UNIT_DIVISORS = {"quintal": 100.0, "qtl": 100.0, "kilogram": 1.0, "kg": 1.0, "tonne": 1000.0, "ton": 1000.0}
+
+
+def unit_divisor(unit):
+    """INR/<unit> -> INR/kg divisor, or None when the unit is not recognised."""
+    u = (unit or "").lower()
+    for name, divisor in UNIT_DIVISORS.items():
+        if name in u:
+            return divisor
+    return None
+
+
+def to_price(value):
+    try:
+        return float(value)  # the common case: a plain numeric string
+    except (TypeError, ValueError):
+        pass
+    if value in MISSING:
+        return None
+    try:
+        return float(str(value).replace(",", "").replace("Rs.", "").replace("₹", "").strip())
+    except ValueError:
+        return None
+
+
+class ExtractionSchema:
+    """Column mapping + unit convention for one resource, compiled into a batch extractor."""
+
+    def __init__(self, resource_id, columns, default_divisor):
+        self.resource_id = resource_id
+        self.columns = columns
+        self.default_divisor = default_divisor
+        self.extract = self._compile()
+
+    @classmethod
+    def infer(cls, resource_id, records):
+        sample = records[:SCHEMA_SAMPLE_SIZE]
+        # lower-cased key (also with spaces as underscores: "Market Name" -> "market_name")
+        # -> actual key, over the whole sample in case early records are sparse
+        keys = {}
+        for rec in sample:
+            for k, v in rec.items():
+                if v not in MISSING:
+                    keys.setdefault(k.lower(), k)
+                    keys.setdefault(k.lower().replace(" ", "_"), k)
+        columns = {field: next((keys[c] for c in candidates if c in keys), None)
+                   for field, candidates in FIELD_CANDIDATES.items()}
+        # records without a recognisable unit: Agmarknet quotes per quintal, which shows as
+        # large prices, so judge the convention from the median unit-less price
+        default_divisor = 1.0
+        price_key = columns["modal"] or columns["min"] or columns["max"]
+        unit_key = columns["unit"]
+        if price_key:
+            prices = sorted(p for p in (to_price(r.get(price_key)) for r in sample
+                                        if not (unit_key and unit_divisor(r.get(unit_key)))) if p)
+            if prices and prices[len(prices) // 2] > 1000:
+                default_divisor = 100.0
+        return cls(resource_id, columns, default_divisor)
+
+    def fits(self, records):
+        """False once the resource stops carrying the price column we compiled for."""
+        key = self.columns["modal"] or self.columns["min"] or self.columns["max"]
+        return key is not None and any(key in rec for rec in records[:SCHEMA_SAMPLE_SIZE])
+
+    def _compile(self):
+        c = self.columns
+        modal_k, min_k, max_k, unit_k = c["modal"], c["min"], c["max"], c["unit"]
+        # absent columns read a key no record has, so the loop below stays branch-free
+        market_k, date_k, commodity_k, state_k, district_k, variety_k = (
+            c[f] or "\0missing" for f in ("market", "date", "commodity", "state", "district", "variety"))
+        modal_k, min_k, max_k = (k or "\0missing" for k in (modal_k, min_k, max_k))
+        default = self.default_divisor
+        divisors = {None: default}
+
+        def extract(records):
+            """Rows (prices in INR/kg) for every record in `records` that carries a price."""
+            rows = []
+            append = rows.append
+            for rec in records:
+                get = rec.get
+                modal = to_price(get(modal_k))
+                lo = to_price(get(min_k))
+                hi = to_price(get(max_k))
+                price = modal or ((lo + hi) / 2 if lo and hi else None) or lo or hi
+                if not price:
+                    continue
+                raw_unit = get(unit_k) if unit_k else None
+                divisor = divisors.get(raw_unit)
+                if divisor is None:
+                    divisor = divisors[raw_unit] = unit_divisor(raw_unit) or default
+                append({
+                    "market": get(market_k), "date": get(date_k), "commodity": get(commodity_k),
+                    "state": get(state_k), "district": get(district_k), "variety": get(variety_k),
+                    "raw_price": price, "raw_unit": raw_unit,
+                    "price_per_kg": round(price / divisor, 2),
+                    "modal_per_kg": round(modal / divisor, 2) if modal else None,
+                    "min_per_kg": round(lo / divisor, 2) if lo else None,
+                    "max_per_kg": round(hi / divisor, 2) if hi else None,
+                })
+            return rows
+
+        return extract
+
+    def describe(self):
+        return {"columns": self.columns, "default_divisor": self.default_divisor}
+
+
+_schemas = {}
+_schemas_lock = threading.Lock()
+
+
+def schema_for(resource_id, records):
+    """Cached extraction schema for `resource_id`, re-inferred if the payload no longer fits it."""
+    schema = _schemas.get(resource_id)
+    if schema is None or not schema.fits(records):
+        schema = ExtractionSchema.infer(resource_id, records)
+        with _schemas_lock:
+            _schemas[resource_id] = schema
+        logger.info('Extraction schema for %s: %s', resource_id, schema.describe())
+    return schema
+
+
+def query_data_gov_price(product):
+    """
+    Query data.gov.in Agmarknet dataset for the latest record matching `product`.
+    Returns a dict like: {'source':'DATA_GOV', 'price_per_kg': float, 'unit': 'INR/kg', 'market': '...', 'date': 'YYYY-MM-DD'}
+    or None if not available / on error.
+    """
+    if not DATA_GOV_API_KEY or not DATA_GOV_RESOURCE_ID:
+        return None
+
+    try:
+        # Build request params. data.gov.in API accepts filters like filters[commodity]=<name>
+        base = f"{DATA_GOV_BASE_URL}/resource/{DATA_GOV_RESOURCE_ID}"
+        params = {
+            "api-key": DATA_GOV_API_KEY,
+            "format": "json",
+            # using commodity filter (field name on resource may vary; try common keys)
+            "filters[commodity]": product,
+            "limit": 5,
+            "offset": 0,
+            # sort by date descending if supported
+            "sort[price_date]": "desc"
+        }
+
+        status, payload = fetch_json(base, params=params, timeout=12)
+        if 400 <= status < 500 and status != 429:
+            # transient errors were already retried; a client error means the filter was rejected:
+            # try without filters key name (some datasets use 'commodity' or 'Commodity')
+            # fallback: try simple search endpoint with q param
+            alt_params = {
+                "api-key": DATA_GOV_API_KEY,
+                "format": "json",
+                "q": product,
+                "limit": 5
+            }
+            status, payload = fetch_json(base, params=alt_params, timeout=12)
+        if status != 200:
+            return None
+
+        records = payload.get("records") or payload.get("result") or payload.get("data") or []
+        if not records:
+            return None
+
+        # the first record (most recent, when sorting is honoured) with a usable price
+        rows = schema_for(DATA_GOV_RESOURCE_ID, records).extract(records)
+        if rows:
+            row = rows[0]
+            return {
+                "source": "DATA_GOV",
+                "price_per_kg": row["price_per_kg"],
+                "raw_price": row["raw_price"],
+                "raw_unit": row["raw_unit"] or "unknown",
+                "unit": "INR/kg",
+                "market": row["market"],
+                "date": row["date"]
+            }
+        return None
+    except Exception as e:
+        # don't crash server on any errors
+        print("DATA_GOV query error:", e)
+        return None
+
+# ---------- Crop synonyms ----------
+# Regional and transliterated crop names ("gehun", "godhumai", "கோதுமை") map to one
+# canonical commodity id, loaded once from data/crop_synonyms.json. Market search, the
+# market caches, the knowledge base and the mandi store all key on that id, so the
+# different spellings of one crop share their entries. The lookups / resolve_rate stats
+# count only names typed by users (query_crop_key), not the internal keying of stored rows.
+CROP_SYNONYMS_FILE = os.getenv("CROP_SYNONYMS_FILE", os.path.join(app.root_path, "data", "crop_synonyms.json"))
+
+
+def synonym_text(text):
+    """normalize_text plus Unicode NFC, so differently composed Indic input compares equal."""
+    return unicodedata.normalize("NFC", normalize_text(text))
+
+
+class CropSynonyms:
+    """alias -> canonical commodity id, one dict lookup per candidate spelling."""
+
+    def __init__(self, path):
+        self._ids = {}    # normalized alias (or id) -> id
+        self._names = {}  # id -> display name
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.resolved = 0
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            logger.warning('Crop synonyms not loaded from %s', path)
+            data = {}
+        for crop_id, entry in data.items():
+            if crop_id.startswith("_"):
+                continue
+            self._names[crop_id] = entry.get("name") or crop_id.title()
+            for alias in [crop_id, entry.get("name", "")] + entry.get("aliases", []):
+                key = synonym_text(alias)
+                if key:
+                    self._ids.setdefault(key, crop_id)
+
+    def canonical(self, text, count=False):
+        """Canonical id for `text`, or None. Dataset-style names are also tried without
+        their parentheticals ("Bengal Gram(Gram)(Whole)" -> "bengal gram", "gram").
+        `count` records the lookup in stats() (user queries only)."""
+        key = synonym_text(text)
+        crop_id = self._ids.get(key)
+        if crop_id is None and "(" in key:
+            outer = normalize_text(re.sub(r"\(.*?\)", " ", key))
+            candidates = [outer] + [normalize_text(p) for p in re.findall(r"\(([^()]*)\)", key)]
+            crop_id = next((self._ids[c] for c in candidates if c in self._ids), None)
+        if count:
+            with self._lock:
+                self.lookups += 1
+                self.resolved += crop_id is not None
+        return crop_id
+
+    def resolve(self, text, count=False):
+        """Canonical id when known, else the normalized input."""
+        return self.canonical(text, count) or synonym_text(text)
+
+    def name(self, crop_id):
+        return self._names.get(crop_id)
+
+    def stats(self):
+        return {"aliases": len(self._ids), "commodities": len(self._names), "lookups": self.lookups,
+                "resolved": self.resolved,
+                "resolve_rate": round(self.resolved / self.lookups, 4) if self.lookups else 0.0}
+
+
+CROP_SYNONYMS = CropSynonyms(CROP_SYNONYMS_FILE)
+
+
+def crop_key(name):
+    """Cache / store key for a crop or commodity name."""
+    return CROP_SYNONYMS.resolve(name)
+
+
+def query_crop_key(name):
+    """crop_key for a crop name a user asked for; counted in the crop_synonyms stats."""
+    return CROP_SYNONYMS.resolve(name, count=True)
+
+
+# ---------- MSP lookup (shared by the sync and async views) ----------
+MSP_RESOURCE_ID = "6f655085-856d-4246-a516-5d6b3bebb990"
+MSP_FETCH_TIMEOUT = 10
+
+# Static short information for well-known crops
+PRODUCT_INFO = {
+    "wheat": {
+        "desc": "Wheat is a staple cereal grain widely used in breads and rotis.",
+        "benefits": "Rich in fiber and protein; aids digestion and heart health.",
+        "calories": "3.4 kcal/g"
+    },
+    "rice": {
+        "desc": "Rice is a key energy food and staple in most Indian diets.",
+        "benefits": "Provides quick energy and essential carbohydrates.",
+        "calories": "3.6 kcal/g"
+    },
+    "gram": {
+        "desc": "Gram (chickpea) is a protein-rich legume used in various dishes.",
+        "benefits": "Supports muscle growth and balances blood sugar.",
+        "calories": "3.8 kcal/g"
+    },
+    "mustard": {
+        "desc": "Mustard seeds are used for spice, oil extraction, and condiments.",
+        "benefits": "Boosts metabolism and contains anti-inflammatory compounds.",
+        "calories": "5.0 kcal/g"
+    },
+    "barley": {
+        "desc": "Barley is a nutrient-dense cereal known for its earthy flavor.",
+        "benefits": "Lowers cholesterol and promotes gut health.",
+        "calories": "3.5 kcal/g"
+    }
+}
+
+
+def msp_dataset_url(limit=100, offset=0):
+    """URL of one page of the rabi MSP dataset on data.gov.in."""
+    api_key = os.getenv("DATA_GOV_API_KEY")
+    return f"{DATA_GOV_BASE_URL}/resource/{MSP_RESOURCE_ID}?api-key={api_key}&format=json&limit={limit}&offset={offset}"
+
+
+# the last MSP download that succeeded, served (stale) while data.gov.in is failing
+MSP_LAST_GOOD = {"records": None, "fetched_at": None, "stale_served": 0}
+
+
+def remember_msp_records(records):
+    MSP_LAST_GOOD["records"], MSP_LAST_GOOD["fetched_at"] = records, datetime.utcnow().isoformat() + "Z"
+    return records
+
+
+def stale_msp_records(error):
+    """The last good MSP records in place of a failed download; re-raises `error` if there are none."""
+    if MSP_LAST_GOOD["records"] is None:
+        raise error
+    logger.warning('Serving MSP records from %s: %s', MSP_LAST_GOOD["fetched_at"], error)
+    MSP_LAST_GOOD["stale_served"] += 1
+    return MSP_LAST_GOOD["records"]
+
+
+def fetch_msp_records():
+    """Download the MSP records (concurrent searches share one in-flight download).
+
+    Falls back to the last good download when data.gov.in fails or its breaker is open.
+    """
+    try:
+        status, data = fetch_json(msp_dataset_url(), timeout=MSP_FETCH_TIMEOUT)
+        if data is None:
+            raise RuntimeError(f"data.gov.in returned HTTP {status}")
+    except Exception as e:
+        return stale_msp_records(e)
+    return remember_msp_records(data.get("records", []))
+
+
+def quintal_to_kg(price_quintal):
+    """Convert ₹ per quintal to ₹ per kg (1 quintal = 100 kg)."""
+    try:
+        return round(float(price_quintal) / 100.0, 2)
+    except (TypeError, ValueError):
+        return None
+
+
+def find_msp_record(records, crop):
+    """Return the first MSP record whose crop name contains `crop`, or None."""
+    return next(
+        (r for r in records if crop in r.get("rabi_crop_wise", "").lower()),
+        None
+    )
+
+
+def estimate_prompt(crop):
+    """Gemini prompt used when the government dataset has no entry for `crop`."""
+    return [
+        {"role": "system", "content": "You are AgroAI, an expert agricultural assistant focused on South India and Tamil Nadu. When asked about an agricultural product, provide a concise JSON object with keys: desc, benefits, calories_per_g, estimated_price_per_kg, storage, common_uses. Respond only with valid JSON."},
+        {"role": "user", "content": f"Provide JSON for the product '{crop}' with fields: desc, benefits, calories_per_g, estimated_price_per_kg, storage, common_uses. If you don't know the price, provide an approximate estimate for Tamil Nadu in INR per kg."}
+    ]
+
+
+def enrichment_prompt(crop):
+    """Gemini prompt used to fill in desc/benefits/calories for a crop with MSP data."""
+    return [
+        {"role": "system", "content": "You are AgroAI, an expert agricultural assistant focused on South India and Tamil Nadu. Provide concise JSON with fields: desc, benefits, calories_per_g, storage, common_uses."},
+        {"role": "user", "content": f"Provide JSON for the product '{crop}' with keys desc, benefits, calories_per_g, storage, common_uses. Keep it short."}
+    ]
+
+
+def fallback_prompt(crop):
+    """Gemini prompt used when the data.gov.in fetch itself failed."""
+    return [
+        {"role": "system", "content": "You are AgroAI, an expert agricultural assistant focused on South India and Tamil Nadu. When asked about an agricultural product, provide a concise text reply with lines: MSP (if known), Short Description, Health Benefits, Calories per gram, Price (estimate in ₹/kg). Keep replies short and human-readable."},
+        {"role": "user", "content": f"Provide details for the product '{crop}' with MSP if known, plus a short description, health benefits, calories per gram, and an estimated price in INR per kg for Tamil Nadu."}
+    ]
+
+
+def estimate_result(crop, gresp):
+    """Build the /market_online payload from a Gemini estimate (JSON if parseable, raw text otherwise)."""
+    try:
+        parsed = json.loads(gresp)
+        desc = parsed.get('desc', '')
+        benefits = parsed.get('benefits', '')
+        calories = parsed.get('calories_per_g', parsed.get('calories', ''))
+        est_price = parsed.get('estimated_price_per_kg')
+        price_str = f"₹{est_price}/kg" if est_price else ''
+        details = f"Short Description: {desc}\nHealth Benefits: {benefits}\nCalories per gram: {calories}\nPrice (est): {price_str}\nStorage: {parsed.get('storage','')}\nCommon uses: {parsed.get('common_uses','')}"
+        return {"results": [{"title": f"{crop.title()} — Estimated Details","description": details,"price_in_inr_per_kg": price_str,"source": "Gemini (estimated)"}]}
+    except Exception:
+        # fallback: return raw text received
+        return {"results": [{"title": f"{crop.title()} — Info","description": gresp, "source": "Gemini (raw)"}]}
+
+
+def no_match_result(crop):
+    return {
+        "results": [{
+            "title": f"No MSP data found for '{crop}'.",
+            "description": "Try common Rabi crops like Wheat, Gram, Barley, Mustard, etc.",
+            "source": "data.gov.in"
+        }]
+    }
+
+
+def enrichment_info(gresp):
+    """The info dict from a Gemini enrichment reply, or None if it is not usable JSON."""
+    try:
+        parsed = json.loads(gresp)
+        return {
+            'desc': parsed.get('desc', 'An agricultural product.'),
+            'benefits': parsed.get('benefits', ''),
+            'calories': parsed.get('calories_per_g', parsed.get('calories', ''))
+        }
+    except Exception:
+        return None
+
+
+def parse_enrichment(gresp, info):
+    """Parse a Gemini enrichment reply into an info dict, keeping `info` (or a generic one) on bad JSON."""
+    parsed = enrichment_info(gresp)
+    if parsed is None:
+        # leave info as fallback
+        if not info:
+            info = {
+                'desc': 'An agricultural product widely cultivated across India.',
+                'benefits': 'Provides essential nutrients and supports human health.',
+                'calories': 'Varies between 3–5 kcal/g'
+            }
+        return info
+    return parsed
+
+
+def needs_enrichment(info):
+    return (not info or not info.get('desc')) and model is not None
+
+
+def msp_result(crop, match, info):
+    """Build the /market_online payload for a crop found in the MSP dataset."""
+    msp_2025 = match.get("_2025_26___msp")
+    msp_per_kg = quintal_to_kg(msp_2025)
+
+    # Build response description
+    desc_lines = []
+    if msp_2025:
+        desc_lines.append(f"MSP: ₹{msp_2025}/quintal (₹{msp_per_kg}/kg)")
+    if info:
+        desc_lines.append(f"Short Description: {info.get('desc','')}")
+        desc_lines.append(f"Health Benefits: {info.get('benefits','')}")
+        desc_lines.append(f"Calories per gram: {info.get('calories','')}")
+
+    return {
+        "results": [{
+            "title": f"{match.get('rabi_crop_wise', crop).title()} — MSP (2025-26)",
+            "description": "\n".join(desc_lines),
+            "price_in_inr_per_kg": (f"₹{msp_per_kg}/kg" if msp_per_kg else ''),
+            "source": "Government of India (Rajya Sabha)"
+        }]
+    }
+
+
+def fallback_result(crop, gresp):
+    # If Gemini returns JSON or raw text, just place it in description
+    return {"results": [{"title": f"{crop.title()} — Estimated Details","description": str(gresp),"price_in_inr_per_kg": "","source": "Gemini (fallback)"}]}
+
+
+# ---------- Background jobs ----------
+# Periodic sync threads register here and are started by the serving process: on the
+# first Flask request (not under app.testing) or by async_app.create_async_app.
+# Importing the module (tests, CLI commands, tooling) starts nothing.
+BACKGROUND_JOBS = {}  # thread name -> loop function
+_jobs_lock = threading.Lock()
+_jobs_started = False
+
+
+def start_background_jobs():
+    """Start every registered job thread once per process."""
+    global _jobs_started
+    with _jobs_lock:
+        if _jobs_started:
+            return
+        _jobs_started = True
+        for name, loop in BACKGROUND_JOBS.items():
+            threading.Thread(target=loop, name=name, daemon=True).start()
+
+
+@app.before_request
+def _start_background_jobs():
+    if not _jobs_started and not app.testing:
+        start_background_jobs()
+
+
+# ---------- MSP mirror ----------
+# A local copy of the whole MSP dataset, kept in SQLite and refreshed by a background
+# thread every MSP_SYNC_INTERVAL seconds (0 disables the thread; `flask sync-msp` runs
+# one sync by hand). Searches are answered from an in-memory index built from the
+# snapshot, so they keep working while data.gov.in is slow or down.
+MSP_MIRROR_DB = os.getenv("MSP_MIRROR_DB", CONVERSATION_DB)
+MSP_SYNC_INTERVAL = int(os.getenv("MSP_SYNC_INTERVAL", str(6 * 3600)))
+MSP_SYNC_PAGE_SIZE = 100
+MSP_SYNC_MAX_PAGES = 500
+
+
+def msp_sync_pages():
+    """The full MSP dataset, one list of records per page, for MspMirror.sync."""
+    fetched = 0
+    for page in range(MSP_SYNC_MAX_PAGES):
+        status, data = fetch_json(msp_dataset_url(MSP_SYNC_PAGE_SIZE, page * MSP_SYNC_PAGE_SIZE),
+                                  timeout=MSP_FETCH_TIMEOUT, breaker=DATA_GOV_SYNC_BREAKER)
+        if data is None:
+            raise RuntimeError(f"data.gov.in returned HTTP {status}")
+        batch = data.get("records") or []
+        yield batch
+        fetched += len(batch)
+        total = int(data.get("total") or 0)
+        if len(batch) < MSP_SYNC_PAGE_SIZE or (total and fetched >= total):
+            break
+
+
+MSP_MIRROR = MspMirror(MSP_MIRROR_DB, msp_sync_pages)
+
+
+# ---------- Crop search index ----------
+def bounded_edit_distance(a, b, limit):
+    """Levenshtein distance between a and b, or limit + 1 as soon as it must exceed `limit`."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i] + [0] * len(b)
+        row_min = i
+        for j, cb in enumerate(b, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+            row_min = min(row_min, cur[j])
+        if row_min > limit:
+            return limit + 1
+        prev = cur
+    return prev[-1]
+
+
+FUZZY_MAX_EDITS = 2
+
+
+def deletion_variants(word, max_edits):
+    """`word` plus every string obtained by deleting up to `max_edits` characters."""
+    variants = {word}
+    frontier = {word}
+    for _ in range(max_edits):
+        frontier = {w[:i] + w[i + 1:] for w in frontier if len(w) > 1 for i in range(len(w))}
+        variants |= frontier
+    return variants
+
+
+class CropSearchIndex:
+    """Prefix + fuzzy search over crop / commodity names.
+
+    Names and their individual words are kept in sorted arrays so prefix lookups are two
+    bisects. Typo tolerance uses a deletion-neighbourhood index (every word under up to
+    FUZZY_MAX_EDITS deleted characters), so fuzzy candidates are a few dict lookups and
+    only those are checked with a bounded edit distance.
+    Results are ranked exact > name prefix > word prefix > substring > fuzzy, and recent
+    queries are memoized until the next rebuild (autocomplete repeats prefixes a lot).
+    """
+
+    def __init__(self, source=None, memo_size=4096):
+        self._source = source  # labels to build from on first search, if never rebuilt
+        self._names = []      # sorted normalized names
+        self._words = []      # sorted (word, name) pairs
+        self._word_names = {}  # word -> [names containing it]
+        self._deletes = {}    # word with <= FUZZY_MAX_EDITS chars deleted -> {words}
+        self._labels = {}     # normalized name -> display label
+        self._memo = LRUCache(maxsize=memo_size)
+        self._memo_lock = threading.Lock()
+
+    def rebuild(self, labels):
+        """Replace the index with `labels` (display names); safe to call while serving."""
+        names, words, label_map = set(), set(), {}
+        for label in labels:
+            name = normalize_text(label)
+            if not name:
+                continue
+            names.add(name)
+            label_map.setdefault(name, label.strip().title())
+            for w in re.split(r"[\s&/(),.-]+", name):
+                if w:
+                    words.add((w, name))
+        word_names, deletes = {}, {}
+        for w, name in words:
+            word_names.setdefault(w, []).append(name)
+        for w in word_names:
+            for variant in deletion_variants(w, FUZZY_MAX_EDITS):
+                deletes.setdefault(variant, set()).add(w)
+        # swap whole objects so readers never see a half-built index
+        self._names, self._words, self._labels = sorted(names), sorted(words), label_map
+        self._word_names, self._deletes = word_names, deletes
+        self._source = None
+        with self._memo_lock:
+            self._memo.clear()
+
+    def search(self, query, limit=8):
+        q = normalize_text(query)
+        if not q:
+            return []
+        if self._source is not None:
+            self.rebuild(self._source())
+        with self._memo_lock:
+            hit = self._memo.get((q, limit))
+        if hit is not None:
+            return hit
+
+        names, words, labels = self._names, self._words, self._labels
+        ranked = {}
+
+        def offer(name, rank, how):
+            if name not in ranked or rank < ranked[name][0]:
+                ranked[name] = (rank, how)
+
+        i = bisect.bisect_left(names, q)
+        while i < len(names) and names[i].startswith(q):
+            offer(names[i], 0 if names[i] == q else 1, "exact" if names[i] == q else "prefix")
+            i += 1
+        i = bisect.bisect_left(words, (q,))
+        while i < len(words) and words[i][0].startswith(q):
+            offer(words[i][1], 2, "prefix")
+            i += 1
+        if len(ranked) < limit:
+            for name in names:
+                if q in name:
+                    offer(name, 3, "substring")
+        if len(ranked) < limit and len(q) >= 3:
+            max_dist = 1 if len(q) <= 5 else FUZZY_MAX_EDITS
+            word_names, deletes = self._word_names, self._deletes
+            candidates = set()
+            for variant in deletion_variants(q, max_dist):
+                candidates.update(deletes.get(variant, ()))
+            for w in candidates:
+                d = bounded_edit_distance(q, w, max_dist)
+                if d <= max_dist:
+                    for name in word_names[w]:
+                        offer(name, 3 + d, "fuzzy")
+
+        hits = sorted(ranked.items(), key=lambda kv: (kv[1][0], len(kv[0]), kv[0]))[:limit]
+        result = [{"name": name, "label": labels.get(name, name.title()), "match": how} for name, (rank, how) in hits]
+        with self._memo_lock:
+            self._memo[(q, limit)] = result
+        return result
+
+    def best(self, query):
+        hits = self.search(query, limit=1)
+        return hits[0]["name"] if hits else None
+
+    def __len__(self):
+        return len(self._names)
+
+
+def search_labels():
+    return [r.get("rabi_crop_wise", "") for r in MSP_MIRROR.records()] + list(PRODUCT_INFO) + \
+        MANDI_STORE.commodities()
+
+
+# built from the stores on the first search, so importing the app opens no database
+SEARCH_INDEX = CropSearchIndex(search_labels)
+
+
+def rebuild_search_index():
+    SEARCH_INDEX.rebuild(search_labels())
+
+
+MSP_MIRROR.listeners.append(rebuild_search_index)
+
+
+def _msp_sync_loop():
+    while True:
+        try:
+            MSP_MIRROR.sync()
+        except Exception:
+            logger.exception('MSP mirror sync failed; serving the previous snapshot')
+        time.sleep(MSP_SYNC_INTERVAL)
+
+
+if MSP_SYNC_INTERVAL > 0:
+    BACKGROUND_JOBS['msp-sync'] = _msp_sync_loop
+
+
+@app.cli.command('sync-msp')
+def sync_msp_command():
+    """Download the full MSP dataset into the local mirror."""
+    print(f"Synced {MSP_MIRROR.sync()} MSP records into {MSP_MIRROR_DB}")
+
+
+# ---------- Crop knowledge base ----------
+# desc/benefits/calories per crop, kept in SQLite and loaded into memory once. The static
+# PRODUCT_INFO entries seed it; Gemini enrichments are written back and reused for
+# CROP_KNOWLEDGE_TTL seconds, so each crop is enriched at most once per TTL and market
+# lookups for known crops make no LLM calls. `flask prewarm-crops` fills it in bulk.
+CROP_KNOWLEDGE_DB = os.getenv("CROP_KNOWLEDGE_DB", CONVERSATION_DB)
+CROP_KNOWLEDGE_TTL = int(os.getenv("CROP_KNOWLEDGE_TTL", str(30 * 24 * 3600)))
+
+CROP_KNOWLEDGE = CropKnowledgeStore(CROP_KNOWLEDGE_DB, CROP_KNOWLEDGE_TTL, CROP_SYNONYMS, seed=PRODUCT_INFO)
+
+
+def crop_info(crop, match):
+    """Known info for a crop found in the MSP dataset, under its dataset name or the searched name."""
+    return CROP_KNOWLEDGE.get(match.get("rabi_crop_wise") if match else None, crop)
+
+
+def remember_enrichment(crop, match, gresp):
+    """Write a usable Gemini enrichment back to the knowledge base; returns its info or None."""
+    info = enrichment_info(gresp)
+    if info is not None:
+        name = (match.get("rabi_crop_wise") if match else None) or crop
+        CROP_KNOWLEDGE.put(name, info)
+        if crop_key(name) != crop_key(crop):
+            # also under the searched name, so the next "lentil" is known before any lookup
+            CROP_KNOWLEDGE.put(crop, info)
+    return info
+
+
+@app.cli.command('prewarm-crops')
+def prewarm_crops_command():
+    """Enrich every crop in the local MSP dataset that the knowledge base does not know yet."""
+    if model is None:
+        print(GEMINI_KEY_MISSING)
+        return
+    records = MSP_MIRROR.records() if MSP_MIRROR.ready else fetch_msp_records()
+    names = list(dict.fromkeys(n for n in ((r.get("rabi_crop_wise") or "").strip() for r in records) if n))
+    missing = [n for n in names if CROP_KNOWLEDGE.get(n) is None]
+
+    def enrich(name):
+        gresp = call_gemini_chat(enrichment_prompt(name.lower()), language='english', route='enrich')
+        return remember_enrichment(name, None, gresp) is not None
+
+    with ThreadPoolExecutor(max_workers=MARKET_BATCH_CONCURRENCY) as pool:
+        done = sum(pool.map(enrich, missing))
+    print(f"{len(names)} crops: {len(names) - len(missing)} already known, {done} enriched, "
+          f"{len(missing) - done} failed")
+
+
+def lookup_msp(crop, records=None):
+    """Find the MSP record for `crop`: local mirror when populated, live download otherwise.
+
+    `crop` must already be a crop_key; misspellings are not guessed at here (a near miss
+    could be another crop's price) but offered by /market/suggest. Pass `records` to
+    search an already-downloaded dataset instead of fetching it again.
+    """
+    if MSP_MIRROR.ready:
+        return MSP_MIRROR.find(crop)
+    return find_msp_record(fetch_msp_records() if records is None else records, crop)
+
+
+# ---------- No-MSP estimate cache ----------
+# Crops missing from the rabi MSP dataset (tomato, banana, coconut, ...) are searched
+# often. Their outcome (the Gemini estimate, or the plain no-match payload) is kept for
+# MSP_MISS_TTL seconds, keyed by crop name, so repeats skip the download and the LLM
+# call. A mirror sync that adds the crop drops its entry, and so does the knowledge base
+# learning the crop.
+MSP_MISS_CACHE = ResponseCache(
+    maxsize=int(os.getenv("MSP_MISS_CACHE_SIZE", "1024")),
+    ttl=int(os.getenv("MSP_MISS_TTL", str(24 * 3600))),
+)
+
+
+def miss_key(crop):
+    return crop_key(crop)
+
+
+def remember_miss(crop, payload, gresp=None):
+    """Cache a no-match payload unless it carries a Gemini error."""
+    if gresp is None or not is_error_reply(gresp):
+        MSP_MISS_CACHE.put(miss_key(crop), payload)
+    return payload
+
+
+def drop_resolved_misses():
+    dropped = MSP_MISS_CACHE.discard_if(lambda key: MSP_MIRROR.find(key) is not None)
+    if dropped:
+        logger.info('MSP sync resolved %d cached misses', dropped)
+
+
+def drop_known_miss(key):
+    if MSP_MISS_CACHE.discard(miss_key(key)):
+        logger.info('Crop knowledge resolved the cached miss for %s', key)
+
+
+MSP_MIRROR.listeners.append(drop_resolved_misses)
+CROP_KNOWLEDGE.listeners.append(drop_known_miss)
+
+
+def market_result(crop, match):
+    """The /market_online payload for `crop` given its MSP record (or None), enriching via Gemini if needed."""
+    if not match:
+        # No government data found. Try to enrich via Gemini if available.
+        if model is not None and LLM.routable():
+            gresp = call_gemini_chat(estimate_prompt(crop), language='english', route='enrich')
+            return remember_miss(crop, estimate_result(crop, gresp), gresp)
+        # with the LLM breakers open the plain answer is served but not cached
+        return no_match_result(crop) if model is not None else remember_miss(crop, no_match_result(crop))
+
+    info = crop_info(crop, match)
+    # If government data exists but the knowledge base has nothing on it, enrich via Gemini once
+    if needs_enrichment(info):
+        gresp = call_gemini_chat(enrichment_prompt(crop), language='english', route='enrich')
+        info = remember_enrichment(crop, match, gresp) or parse_enrichment(gresp, info)
+    return msp_result(crop, match, info)
+
+
+def market_fallback(crop):
+    """The /market_online payload when the MSP data itself could not be fetched."""
+    # Try to fall back to Gemini for estimated product details if available
+    if model is not None and LLM.routable():
+        try:
+            gresp = call_gemini_chat(fallback_prompt(crop), language='english', route='enrich')
+            return fallback_result(crop, gresp)
+        except Overloaded:
+            raise
+        except Exception:
+            logger.exception('Gemini fallback failed')
+            return {"error": "Failed to fetch MSP data and Gemini fallback failed. Please try again later."}
+    return {"error": "Failed to fetch MSP data (network error). Please try again later."}
+
+
+@app.route('/market/suggest', methods=['GET'])
+def market_suggest():
+    """Autocomplete for the market search box: ranked crop names for a partial query."""
+    q = request.args.get('q', '')
+    limit = max(1, min(request.args.get('limit', 8, type=int) or 8, 20))
+    suggestions = SEARCH_INDEX.search(q, limit)
+    crop_id = CROP_SYNONYMS.canonical(q) if q.strip() else None
+    if crop_id and crop_id != normalize_text(q):
+        # a regional name ("gehun"): offer the commodity it stands for first
+        suggestions = [{"name": crop_id, "label": CROP_SYNONYMS.name(crop_id), "match": "synonym"}] + \
+            [x for x in suggestions if x["name"] != crop_id][:limit - 1]
+    return jsonify({"query": q, "suggestions": suggestions})
+
+
+@app.route('/market_online', methods=['GET'])
+def msp_rate():
+    crop = request.args.get('product', '').strip().lower()
+    if not crop:
+        return jsonify({'error': 'Please provide a crop name'})
+    crop = query_crop_key(crop)  # "gehun" / "கோதுமை" -> "wheat"
+
+    return jsonify(market_lookup(crop))
+
+
+# ---------- Speculative market lookup ----------
+# When the MSP lookup needs a live download and the crop is not in the knowledge base,
+# the Gemini call starts alongside the fetch instead of after it. The estimate prompt
+# asks for a superset of the enrichment fields, so one speculative call serves the
+# no-match, enrichment and fetch-failure branches. It is dropped when the knowledge base
+# turns out to know the matched crop, and nothing waits past MARKET_DEADLINE seconds.
+MARKET_DEADLINE = float(os.getenv("MARKET_DEADLINE", "20"))
+SPECULATION_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("SPECULATION_WORKERS", "16")),
+                                      thread_name_prefix='speculate')
+# cancelled: dropped before it started; wasted: dropped, but the Gemini call ran anyway
+SPECULATION_STATS = {"started": 0, "used": 0, "cancelled": 0, "wasted": 0, "timed_out": 0}
+_speculation_lock = threading.Lock()
+
+
+def count_speculation(outcome):
+    with _speculation_lock:
+        SPECULATION_STATS[outcome] += 1
+
+
+def speculation_stats():
+    with _speculation_lock:
+        return dict(SPECULATION_STATS)
+
+
+def drop_speculation(future):
+    count_speculation("cancelled" if future.cancel() else "wasted")
+
+
+def market_lookup(crop, deadline=MARKET_DEADLINE):
+    """The /market_online payload for `crop`, overlapping the MSP fetch with Gemini where it helps."""
+    cached = MSP_MISS_CACHE.get(miss_key(crop))
+    if cached is not None:
+        return cached
+    if MSP_MIRROR.ready or model is None or not LLM.routable() or CROP_KNOWLEDGE.get(crop) is not None:
+        # the lookup is local or no LLM call is expected: nothing worth overlapping
+        try:
+            return market_result(crop, lookup_msp(crop))
+        except Overloaded:
+            raise
+        except Exception:
+            logger.exception('DATA_GOV fetch failed')
+            return market_fallback(crop)
+
+    t_end = time.monotonic() + deadline
+    speculative = SPECULATION_POOL.submit(call_gemini_chat, estimate_prompt(crop), 'english', 'enrich')
+    count_speculation("started")
+    fetch_failed = False
+    try:
+        match = lookup_msp(crop)
+    except Overloaded:
+        drop_speculation(speculative)
+        raise
+    except Exception:
+        logger.exception('DATA_GOV fetch failed')
+        match, fetch_failed = None, True
+
+    if match is not None:
+        info = crop_info(crop, match)
+        if info is not None:
+            # known under its dataset name ("masur" -> Lentil): the speculation is not needed
+            # (a call already in flight still finishes in its worker, but nobody waits for it)
+            drop_speculation(speculative)
+            return msp_result(crop, match, info)
+
+    try:
+        gresp = speculative.result(timeout=max(0.0, t_end - time.monotonic()))
+        count_speculation("used")
+    except FutureTimeout:
+        drop_speculation(speculative)
+        count_speculation("timed_out")
+        gresp = None
+
+    if match is not None:
+        info = remember_enrichment(crop, match, gresp) if gresp else None
+        return msp_result(crop, match, info or parse_enrichment("", None))
+    if gresp is not None and not is_error_reply(gresp):
+        result = estimate_result(crop, gresp)
+        return result if fetch_failed else remember_miss(crop, result, gresp)
+    if fetch_failed:
+        return {"error": "Failed to fetch MSP data and Gemini fallback failed. Please try again later."}
+    return no_match_result(crop)
+
+
+# ---------- Batch market lookup ----------
+# One request for many crops: the MSP dataset is fetched once (or read from the mirror),
+# every crop is resolved against it, and the Gemini enrichment calls that remain run
+# concurrently, at most MARKET_BATCH_CONCURRENCY at a time.
+MARKET_BATCH_MAX = int(os.getenv("MARKET_BATCH_MAX", "50"))
+MARKET_BATCH_CONCURRENCY = int(os.getenv("MARKET_BATCH_CONCURRENCY", "8"))
+
+
+def market_batch_item(crop, records, fetch_error):
+    t0 = time.monotonic()
+    cached = MSP_MISS_CACHE.get(miss_key(crop))
+    try:
+        if cached is not None:
+            payload = cached
+        elif fetch_error:
+            payload = market_fallback(crop)
+        else:
+            try:
+                payload = market_result(crop, lookup_msp(crop, records))
+            except Overloaded:
+                raise
+            except Exception:
+                logger.exception('Batch market lookup failed for %s', crop)
+                payload = market_fallback(crop)
+    except Overloaded as e:
+        payload = {"error": f"Server busy: {e}. Please retry in {e.retry_after} s.", "retry_after": e.retry_after}
+    return dict(payload, product=crop, elapsed_ms=round((time.monotonic() - t0) * 1000, 1))
+
+
+def run_market_batch(crops):
+    """Yield one payload per crop as it completes."""
+    records, fetch_error = None, False
+    if not MSP_MIRROR.ready:
+        try:
+            records = fetch_msp_records()
+        except Exception:
+            logger.exception('DATA_GOV fetch failed')
+            fetch_error = True
+    pool = ThreadPoolExecutor(max_workers=max(1, min(MARKET_BATCH_CONCURRENCY, len(crops))),
+                              thread_name_prefix='market-batch')
+    try:
+        futures = [pool.submit(market_batch_item, crop, records, fetch_error) for crop in crops]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # a client that went away should not keep enrichment calls queued
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+@app.route('/market_online/batch', methods=['POST'])
+def msp_rate_batch():
+    """Prices for many crops at once: {"products": [...]}.
+
+    Returns {"items": [...]} in request order, or streams one NDJSON line per crop as it
+    completes when the client asks for application/x-ndjson.
+    """
+    data = request.get_json(silent=True) or {}
+    products = data.get('products')
+    if not isinstance(products, list) or not products:
+        return jsonify({'error': 'Please provide a list of products'}), 400
+    # synonyms collapse to one item ("gehun" and "wheat" are both "wheat")
+    crops = list(dict.fromkeys(query_crop_key(p) for p in products if str(p).strip()))
+    if not crops:
+        return jsonify({'error': 'Please provide a list of products'}), 400
+    if len(crops) > MARKET_BATCH_MAX:
+        return jsonify({'error': f'At most {MARKET_BATCH_MAX} products per batch'}), 400
+
+    if 'application/x-ndjson' in request.headers.get('Accept', ''):
+        def generate():
+            for item in run_market_batch(crops):
+                yield json.dumps(item, ensure_ascii=False) + "\n"
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    by_crop = {item["product"]: item for item in run_market_batch(crops)}
+    return jsonify({"items": [by_crop[crop] for crop in crops]})
+
+
+# ---------- Batch advice ----------
+# Offline-collected questions synced in bulk. Identical items (same advice_cache_key) are
+# answered once; precomputed and cached answers go out first, and the misses run
+# ADVICE_BATCH_CONCURRENCY at a time, each still admitted through LLM_ADMISSION like any
+# other /get_advice call, so a batch cannot take more than its share of Gemini.
+ADVICE_BATCH_MAX = int(os.getenv("ADVICE_BATCH_MAX", "100"))
+ADVICE_BATCH_CONCURRENCY = int(os.getenv("ADVICE_BATCH_CONCURRENCY", "8"))
+
+
+def advice_batch_answer(data, messages, key):
+    """(status, answer) without an LLM call, or None when the item has to be generated."""
+    answer = precomputed_advice(data, messages)
+    if answer is not None:
+        return "precomputed", answer
+    if not LLM.available():
+        return "error", GEMINI_KEY_MISSING
+    answer = ADVICE_CACHE.get(key)
+    if answer is not None:
+        return "cached", answer
+    if not LLM.routable():
+        return "degraded", degraded_advice(data.get("soil_type"), data.get("climate"), data.get("language"))
+    return None
+
+
+def advice_batch_generate(data, messages):
+    try:
+        answer, _ = cached_gemini_chat(data.get("soil_type"), data.get("climate"), data["language"], messages)
+    except Overloaded as e:
+        return "busy", f"Server busy: {e}. Please retry in {e.retry_after} s.", e.retry_after
+    if answer.startswith(ADVICE_DEGRADED):
+        return "degraded", answer, None
+    return ("error" if is_error_reply(answer) else "ok"), answer, None
+
+
+def run_advice_batch(items):
+    """Yield one result per unique item as it completes, as (indexes, result)."""
+    t0 = time.monotonic()
+    groups = OrderedDict()  # advice_cache_key -> (data, messages, [indexes])
+    for i, data in items:
+        messages = advice_messages(data)
+        key = advice_cache_key(data.get("soil_type"), data.get("climate"), data["language"], messages)
+        groups.setdefault(key, (data, messages, []))[2].append(i)
+
+    pending = []
+    for key, (data, messages, indexes) in groups.items():
+        ready = advice_batch_answer(data, messages, key)
+        if ready is None:
+            pending.append((data, messages, indexes))
+        else:
+            yield indexes, {"status": ready[0], "response": ready[1],
+                            "elapsed_ms": round((time.monotonic() - t0) * 1000, 1)}
+    if not pending:
+        return
+
+    pool = ThreadPoolExecutor(max_workers=max(1, min(ADVICE_BATCH_CONCURRENCY, len(pending))),
+                              thread_name_prefix='advice-batch')
+    try:
+        futures = {pool.submit(advice_batch_generate, data, messages): indexes
+                   for data, messages, indexes in pending}
+        for future in as_completed(futures):
+            try:
+                status, answer, retry_after = future.result()
+            except Exception as e:
+                logger.exception('Batch advice item failed')
+                status, answer, retry_after = "error", f"Error from Gemini: {e}", None
+            result = {"status": status, "response": answer, "elapsed_ms": round((time.monotonic() - t0) * 1000, 1)}
+            if retry_after is not None:
+                result["retry_after"] = retry_after
+            yield futures[future], result
+    finally:
+        # a client that went away should not keep generations queued
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def batch_item_error(item):
+    """Why a batch item cannot be answered, or None when it is well formed."""
+    if not isinstance(item, dict):
+        return "Each item must be an object"
+    if not isinstance(item.get("query"), str) or not item["query"].strip():
+        return "Each item needs a query"
+    for field in ("soil_type", "soil", "climate", "language"):
+        if item.get(field) is not None and not isinstance(item[field], str):
+            return f"{field} must be a string"
+    return None
+
+
+@app.route('/get_advice/batch', methods=['POST'])
+def get_advice_batch():
+    """Answer many independent questions: {"items": [{"soil_type", "climate", "language", "query", "id"?}, ...]}.
+
+    Streams one NDJSON line per item as it is answered: its index and id, status
+    (precomputed, cached, ok, degraded, busy, error or invalid), response, elapsed_ms
+    since the batch started, and `deduped` when it shares the answer of an earlier item.
+    """
+    data = request.get_json(silent=True) or {}
+    raw = data.get('items')
+    if not isinstance(raw, list) or not raw:
+        return jsonify({'error': 'Please provide a list of items'}), 400
+    if len(raw) > ADVICE_BATCH_MAX:
+        return jsonify({'error': f'At most {ADVICE_BATCH_MAX} items per batch'}), 400
+
+    items, invalid = [], []
+    for i, item in enumerate(raw):
+        error = batch_item_error(item)
+        if error:
+            invalid.append((i, error))
+            continue
+        items.append((i, {"soil_type": item.get("soil_type", item.get("soil")), "climate": item.get("climate"),
+                          "language": (item.get("language") or "english").lower(), "query": item["query"]}))
+
+    def line(i, result, deduped=False):
+        item_id = raw[i].get("id") if isinstance(raw[i], dict) else None
+        payload = dict(result, index=i, id=item_id, timestamp=datetime.utcnow().isoformat() + "Z")
+        if deduped:
+            payload["deduped"] = True
+        return json.dumps(payload, ensure_ascii=False) + "\n"
+
+    def generate():
+        for i, error in invalid:
+            yield line(i, {"status": "invalid", "response": error, "elapsed_ms": 0.0})
+        for indexes, result in run_advice_batch(items):
+            for n, i in enumerate(indexes):
+                yield line(i, result, deduped=n > 0)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+# ---------- Mandi price time series ----------
+# Agmarknet daily mandi prices, paged in from data.gov.in by a background job (every
+# MANDI_SYNC_INTERVAL seconds, see BACKGROUND_JOBS; 0 disables it; `flask ingest-mandi` runs it by hand) and
+# stored per commodity/market/date in SQLite. The /market/prices endpoints only read
+# from this store; nothing is fetched on the request path. Rows are keyed on the raw
+# Agmarknet commodity name, so differently priced commodities that share a synonym id
+# ("Paddy(Dhan)(Common)" and "Paddy (Grade A)") never overwrite each other; the id is
+# kept in the indexed commodity_key column for lookups.
+AGMARKNET_RESOURCE_ID = os.getenv("AGMARKNET_RESOURCE_ID", "9ef84268-d588-465a-a308-a864a43d0070")
+MANDI_DB = os.getenv("MANDI_DB", CONVERSATION_DB)
+MANDI_SYNC_INTERVAL = int(os.getenv("MANDI_SYNC_INTERVAL", str(6 * 3600)))
+MANDI_PAGE_SIZE = 1000
+MANDI_MAX_PAGES = 1000
+
+def parse_price_date(value):
+    """Agmarknet dates come as dd/mm/yyyy; store ISO yyyy-mm-dd so they sort."""
+    value = (value or "").strip()
+    for fmt in ("%d/%m/%Y", "%Y-%m-%d", "%d-%m-%Y"):
+        try:
+            return datetime.strptime(value, fmt).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def normalize_mandi_batch(records):
+    """Turn one page of raw Agmarknet records into store rows (prices in INR/kg)."""
+    rows = []
+    for row in schema_for(AGMARKNET_RESOURCE_ID, records).extract(records):
+        day = parse_price_date(row["date"])
+        commodity = (row["commodity"] or "").strip()
+        market = (row["market"] or "").strip()
+        if not day or not commodity or not market:
+            continue
+        rows.append((crop_key(commodity), commodity, (row["state"] or "").strip(),
+                     (row["district"] or "").strip(), market, (row["variety"] or "").strip(), day,
+                     row["min_per_kg"], row["max_per_kg"], row["modal_per_kg"] or row["price_per_kg"]))
+    return rows
+
+
+def mandi_pages():
+    """The Agmarknet resource as store rows, one normalized batch per page, for MandiPriceStore.ingest."""
+    api_key = os.getenv("DATA_GOV_API_KEY")
+    base = f"{DATA_GOV_BASE_URL}/resource/{AGMARKNET_RESOURCE_ID}"
+    for page in range(MANDI_MAX_PAGES):
+        params = {"api-key": api_key, "format": "json", "limit": MANDI_PAGE_SIZE, "offset": page * MANDI_PAGE_SIZE}
+        status, data = fetch_json(base, params=params, timeout=30, breaker=DATA_GOV_SYNC_BREAKER)
+        if data is None:
+            raise RuntimeError(f"data.gov.in returned HTTP {status}")
+        batch = data.get("records") or []
+        yield normalize_mandi_batch(batch)
+        total = int(data.get("total") or 0)
+        if len(batch) < MANDI_PAGE_SIZE or (total and (page + 1) * MANDI_PAGE_SIZE >= total):
+            break
+
+
+MANDI_STORE = MandiPriceStore(MANDI_DB, CROP_SYNONYMS, mandi_pages)
+
+
+def _mandi_ingest_loop():
+    while True:
+        try:
+            MANDI_STORE.ingest()
+            rebuild_search_index()
+        except Exception:
+            logger.exception('Mandi price ingestion failed; serving stored prices')
+        time.sleep(MANDI_SYNC_INTERVAL)
+
+
+if MANDI_SYNC_INTERVAL > 0:
+    BACKGROUND_JOBS['mandi-ingest'] = _mandi_ingest_loop
+
+
+@app.cli.command('ingest-mandi')
+def ingest_mandi_command():
+    """Page the Agmarknet daily price resource into the local time-series store."""
+    print(f"Ingested {MANDI_STORE.ingest()} mandi price rows into {MANDI_DB}")
+    rebuild_search_index()
+
+
+def _commodity_arg():
+    commodity = request.args.get('commodity', '').strip()
+    if not commodity:
+        return commodity
+    # no fuzzy guess here: a near miss would return another commodity's prices
+    return CROP_SYNONYMS.canonical(commodity, count=True) or commodity
+
+
+@app.route('/market/prices/latest', methods=['GET'])
+def mandi_latest():
+    """Latest modal/min/max price (INR/kg) per market for ?commodity=, optionally filtered by state/market."""
+    commodity = _commodity_arg()
+    if not commodity:
+        return jsonify({'error': 'Please provide a commodity'}), 400
+    rows = MANDI_STORE.latest(commodity, request.args.get('state'), request.args.get('market'),
+                              max(1, min(request.args.get('limit', 50, type=int) or 50, 500)))
+    return jsonify({"commodity": commodity, "unit": "INR/kg", "results": rows})
+
+
+@app.route('/market/prices/history', methods=['GET'])
+def mandi_history():
+    """Daily price series for ?commodity= (optionally one market/state), newest first."""
+    commodity = _commodity_arg()
+    if not commodity:
+        return jsonify({'error': 'Please provide a commodity'}), 400
+    rows = MANDI_STORE.history(commodity, request.args.get('market'), request.args.get('state'),
+                               request.args.get('since'),
+                               max(1, min(request.args.get('limit', 365, type=int) or 365, 5000)))
+    return jsonify({"commodity": commodity, "unit": "INR/kg", "results": rows})
 
 
+@app.route('/market/prices/compare', methods=['GET'])
+def mandi_compare():
+    """Cross-market comparison for ?commodity= on ?date= (default: latest day with data)."""
+    commodity = _commodity_arg()
+    if not commodity:
+        return jsonify({'error': 'Please provide a commodity'}), 400
+    day, rows = MANDI_STORE.compare(commodity, request.args.get('date'), request.args.get('state'))
+    modal = [r["modal_price_per_kg"] for r in rows]
+    summary = {"markets": len(rows)}
+    if modal:
+        summary.update({"min": min(modal), "max": max(modal), "avg": round(sum(modal) / len(modal), 2),
+                        "cheapest": rows[0]["market"], "dearest": rows[-1]["market"]})
+    return jsonify({"commodity": commodity, "date": day, "unit": "INR/kg", "summary": summary, "results": rows})
 
 
 if __name__ == "__main__":
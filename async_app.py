@@ -0,0 +1,170 @@
+"""Async (aiohttp) entry point.
+
+The Flask views in app.py pin one worker per request for the whole upstream round trip.
+This app serves the same /get_advice and /market_online contracts on an asyncio loop,
+so one process can keep hundreds of Gemini / data.gov.in calls in flight.
+
+    python -m aiohttp.web -H 0.0.0.0 -P 8080 async_app:create_async_app
+
+Flask's own async views would need asgiref, which is not part of our venv; aiohttp is.
+"""
+import asyncio
+import os
+import time
+
+import aiohttp
+from aiohttp import web as aio_web
+
+from app import (ADVICE_CACHE, DATA_GOV_BREAKER, GEMINI_KEY_MISSING, LLM, MSP_FETCH_TIMEOUT, MSP_MIRROR,
+                 MSP_MISS_CACHE, UPSTREAM, InvalidRequest, Overloaded, advice_cache_key, advice_context,
+                 advice_response, agenerate_reply, crop_info, degraded_advice, drop_advice_turn,
+                 enrichment_prompt, estimate_prompt, estimate_result, fallback_prompt, fallback_result,
+                 find_msp_record, fit_context, health_status, logger, lookup_msp, miss_key, model,
+                 msp_dataset_url, msp_result, needs_enrichment, no_match_result, parse_enrichment,
+                 precomputed_advice, query_crop_key, remember_enrichment, remember_miss,
+                 remember_msp_records, stale_msp_records, start_background_jobs)
+
+
+async def async_call_gemini_chat(messages, language="english", cache_key=None, route="chat"):
+    """Async twin of call_gemini_chat (same provider routing, hedging and failover).
+
+    When `cache_key` is given, a successful reply is stored in ADVICE_CACHE.
+    """
+    if not LLM.available():
+        return GEMINI_KEY_MISSING
+
+    try:
+        answer = await agenerate_reply(messages, language, route)
+        if cache_key is not None and answer:
+            ADVICE_CACHE.put(cache_key, answer)
+        return answer
+    except Overloaded:
+        raise
+    except Exception as e:
+        logger.exception('Gemini chat error')
+        return f"Error from Gemini: {e}"
+
+
+async def async_get_advice(req):
+    try:
+        data = await req.json()
+    except Exception:
+        data = {}
+    data = data or {}
+    language = data.get("language", "english")
+
+    # the conversation store and crop knowledge are SQLite: keep them off the event loop
+    messages, conv_id, turn = await asyncio.to_thread(advice_context, data)
+    key = advice_cache_key(data.get("soil_type"), data.get("climate"), language, messages)
+    answer = await asyncio.to_thread(precomputed_advice, data, messages)
+    if answer is None and LLM.available():
+        answer = ADVICE_CACHE.get(key)
+        if answer is None and not LLM.routable():
+            answer = degraded_advice(data.get("soil_type"), data.get("climate"), language)
+    stats = None
+    if answer is None:
+        # summary regeneration is a blocking Gemini call; keep it off the event loop
+        prompt_messages, stats = await asyncio.to_thread(fit_context, messages, language, conv_id)
+        try:
+            answer = await async_call_gemini_chat(prompt_messages, language, cache_key=key)
+        except Overloaded:
+            await asyncio.to_thread(drop_advice_turn, turn)
+            raise
+    return aio_web.json_response(await asyncio.to_thread(advice_response, answer, conv_id, stats))
+
+
+async def async_fetch_msp_records(session):
+    """Async twin of fetch_msp_records, through the same breaker and stale fallback."""
+    try:
+        DATA_GOV_BREAKER.check()
+        t0 = time.monotonic()
+        try:
+            status, data = await UPSTREAM.aget(session, msp_dataset_url(), deadline=MSP_FETCH_TIMEOUT)
+        except Exception:
+            DATA_GOV_BREAKER.record(False, time.monotonic() - t0)
+            raise
+        DATA_GOV_BREAKER.record(status < 500 and status != 429, time.monotonic() - t0)
+        if data is None:
+            raise RuntimeError(f"data.gov.in returned HTTP {status}")
+    except Exception as e:
+        return stale_msp_records(e)
+    return remember_msp_records(data.get("records", []))
+
+
+async def async_msp_rate(req):
+    crop = req.query.get('product', '').strip().lower()
+    if not crop:
+        return aio_web.json_response({'error': 'Please provide a crop name'})
+    crop = query_crop_key(crop)
+
+    cached = MSP_MISS_CACHE.get(miss_key(crop))
+    if cached is not None:
+        return aio_web.json_response(cached)
+
+    session = req.app['http']
+    try:
+        # the mirror and the knowledge base are SQLite: keep them off the event loop
+        if MSP_MIRROR.ready:
+            match = await asyncio.to_thread(lookup_msp, crop)
+        else:
+            match = find_msp_record(await async_fetch_msp_records(session), crop)
+
+        if not match:
+            if model is not None and LLM.routable():
+                gresp = await async_call_gemini_chat(estimate_prompt(crop), language='english', route='enrich')
+                return aio_web.json_response(remember_miss(crop, estimate_result(crop, gresp), gresp))
+            if model is not None:
+                return aio_web.json_response(no_match_result(crop))
+            return aio_web.json_response(remember_miss(crop, no_match_result(crop)))
+
+        info = await asyncio.to_thread(crop_info, crop, match)
+        if needs_enrichment(info):
+            gresp = await async_call_gemini_chat(enrichment_prompt(crop), language='english', route='enrich')
+            info = await asyncio.to_thread(remember_enrichment, crop, match, gresp) or parse_enrichment(gresp, info)
+
+        return aio_web.json_response(msp_result(crop, match, info))
+
+    except Overloaded:
+        # load shedding is answered by _error_middleware as a 429/503, not papered over
+        raise
+    except Exception:
+        logger.exception('DATA_GOV fetch failed')
+        if model is not None and LLM.routable():
+            gresp = await async_call_gemini_chat(fallback_prompt(crop), language='english', route='enrich')
+            return aio_web.json_response(fallback_result(crop, gresp))
+        return aio_web.json_response({"error": "Failed to fetch MSP data (network error). Please try again later."})
+
+
+async def async_health(req):
+    return aio_web.json_response(health_status())
+
+
+async def _http_session_ctx(aio_app):
+    # one shared client session (and connection pool) per process
+    connector = aiohttp.TCPConnector(limit=int(os.getenv("ASYNC_HTTP_LIMIT", "200")))
+    aio_app['http'] = aiohttp.ClientSession(connector=connector)
+    yield
+    await aio_app['http'].close()
+
+
+@aio_web.middleware
+async def _error_middleware(req, handler):
+    try:
+        return await handler(req)
+    except InvalidRequest as e:
+        return aio_web.json_response({"error": str(e)}, status=400)
+    except Overloaded as e:
+        return aio_web.json_response(
+            {"error": f"Server busy: {e}. Please retry in {e.retry_after} s.", "retry_after": e.retry_after},
+            status=e.status, headers={"Retry-After": str(e.retry_after)})
+
+
+def create_async_app(argv=None):
+    """Build the aiohttp application serving the async /get_advice, /market_online and /health."""
+    aio_app = aio_web.Application(middlewares=[_error_middleware])
+    start_background_jobs()
+    aio_app.cleanup_ctx.append(_http_session_ctx)
+    aio_app.router.add_post('/get_advice', async_get_advice)
+    aio_app.router.add_get('/market_online', async_msp_rate)
+    aio_app.router.add_get('/health', async_health)
+    return aio_app
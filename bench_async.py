@@ -0,0 +1,194 @@
+"""Compare the sync Flask path with the async aiohttp path against a local fake upstream.
+
+A fake data.gov.in server (aiohttp, fixed delay per request) and a fake Gemini model
+(fixed delay per call, for every model name and pooled key) stand in for the real
+upstreams, so the numbers only reflect how many upstream calls each path can keep in
+flight. Every database lives in a throwaway directory, the prefix cache is off, the
+admission and key-quota limits are raised out of the way, and every advice request asks
+a different question so caches and request coalescing cannot answer it.
+
+    python bench_async.py --requests 400 --workers 16 --delay 0.2
+
+The sync path is driven by `--workers` threads, the way a fixed pool of Flask workers
+would serve it; the async path fires every request at once on one event loop.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from aiohttp import web as aio_web
+
+FAKE_RECORDS = [
+    {"rabi_crop_wise": "Wheat", "_2025_26___msp": "2585"},
+    {"rabi_crop_wise": "Barley", "_2025_26___msp": "2150"},
+    {"rabi_crop_wise": "Gram", "_2025_26___msp": "5875"},
+    {"rabi_crop_wise": "Mustard", "_2025_26___msp": "6200"},
+]
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModel:
+    """Stands in for genai.GenerativeModel with a fixed generation delay."""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def generate_content(self, convo, **kwargs):
+        time.sleep(self.delay)
+        return FakeResponse("Grow millets and pulses.")
+
+    async def generate_content_async(self, convo, **kwargs):
+        await asyncio.sleep(self.delay)
+        return FakeResponse("Grow millets and pulses.")
+
+
+def start_fake_upstream(delay):
+    """Run a fake data.gov.in in a background thread; returns its base URL."""
+    async def resource(request):
+        await asyncio.sleep(delay)
+        return aio_web.json_response({"records": FAKE_RECORDS})
+
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    holder = {}
+
+    async def boot():
+        fake = aio_web.Application()
+        fake.router.add_get('/resource/{rid}', resource)
+        runner = aio_web.AppRunner(fake)
+        await runner.setup()
+        site = aio_web.TCPSite(runner, '127.0.0.1', 0, backlog=1024)
+        await site.start()
+        holder['port'] = runner.addresses[0][1]
+        started.set()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(boot())
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    return f"http://127.0.0.1:{holder['port']}"
+
+
+def summarize(label, latencies, wall):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{label:<28} {len(latencies) / wall:8.1f} req/s   "
+          f"p50 {statistics.median(latencies) * 1000:7.1f} ms   p95 {p95 * 1000:7.1f} ms   "
+          f"wall {wall:6.2f} s")
+
+
+def advice_payload(i):
+    """A distinct question per request."""
+    return {"query": f"Which crops should follow my harvest in plot {i}, and why?",
+            "soil_type": "loam", "climate": "tropical"}
+
+
+def bench_sync(app_module, path, method, n, workers):
+    client = app_module.app.test_client()
+
+    def one(i):
+        t0 = time.perf_counter()
+        if method == 'POST':
+            client.post(path, json=advice_payload(i))
+        else:
+            client.get(path)
+        return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        latencies = list(pool.map(one, range(n)))
+    return latencies, time.perf_counter() - t0
+
+
+async def bench_async(async_module, path, method, n):
+    runner = aio_web.AppRunner(async_module.create_async_app())
+    await runner.setup()
+    # a deep backlog so the burst of connects is not throttled by SYN retries
+    site = aio_web.TCPSite(runner, '127.0.0.1', 0, backlog=1024)
+    await site.start()
+    url = f"http://127.0.0.1:{runner.addresses[0][1]}{path}"
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def one(i):
+            t0 = time.perf_counter()
+            if method == 'POST':
+                async with session.post(url, json=advice_payload(n + i)) as r:
+                    await r.read()
+            else:
+                async with session.get(url) as r:
+                    await r.read()
+            return time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        latencies = await asyncio.gather(*(one(i) for i in range(n)))
+        wall = time.perf_counter() - t0
+    await runner.cleanup()
+    return list(latencies), wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--workers', type=int, default=16, help='sync worker threads')
+    parser.add_argument('--delay', type=float, default=0.2, help='fake upstream delay (s)')
+    args = parser.parse_args()
+
+    os.environ['DATA_GOV_BASE_URL'] = start_fake_upstream(args.delay)
+    os.environ.setdefault('DATA_GOV_API_KEY', 'bench')
+    # measure the live upstream path: no background sync, empty mirror, throwaway databases
+    tmp = tempfile.mkdtemp(prefix='agrobot-bench-')
+    os.environ.update({
+        'MSP_SYNC_INTERVAL': '0',
+        'MANDI_SYNC_INTERVAL': '0',
+        'CONVERSATION_DB': os.path.join(tmp, 'agrobot.db'),
+        'MSP_MIRROR_DB': os.path.join(tmp, 'msp.db'),
+        'MANDI_DB': os.path.join(tmp, 'mandi.db'),
+        'CROP_KNOWLEDGE_DB': os.path.join(tmp, 'crops.db'),
+        # a dummy key (every call is answered by FakeModel), no OpenAI, no cached contents
+        'GOOGLE_API_KEY': 'bench',
+        'GOOGLE_API_KEYS': 'bench',
+        'OPENAI_API_KEY': '',
+        'GEMINI_PREFIX_CACHE': '0',
+        # admission control and key quotas would otherwise cap both paths at the same rate
+        'LLM_MAX_CONCURRENT': str(max(args.requests, args.workers)),
+        'LLM_RATE_PER_MIN': '1000000',
+        'LLM_BURST': str(2 * args.requests),
+        'LLM_MAX_QUEUE': str(2 * args.requests),
+        'GEMINI_PRO_RPM': '1000000',
+        'GEMINI_PRO_TPM': '1000000000',
+        'GEMINI_FLASH_RPM': '1000000',
+        'GEMINI_FLASH_TPM': '1000000000',
+    })
+
+    import app as app_module
+    import async_app
+    fake = FakeModel(args.delay)
+    app_module.model = fake
+    app_module.get_model = lambda name: fake
+    app_module.GEMINI_KEYS = app_module.GeminiKeyPool(app_module.GOOGLE_API_KEYS, app_module.GEMINI_QUOTAS,
+                                                      app_module.get_model)
+    app_module.logger.setLevel('WARNING')
+    logging.getLogger('aiohttp.access').setLevel('WARNING')
+
+    print(f"{args.requests} requests, upstream delay {args.delay * 1000:.0f} ms, {args.workers} sync workers\n")
+    for path, method in (('/market_online?product=wheat', 'GET'), ('/get_advice', 'POST')):
+        summarize(f"sync  {method} {path.split('?')[0]}", *bench_sync(app_module, path, method, args.requests, args.workers))
+        summarize(f"async {method} {path.split('?')[0]}", *asyncio.run(bench_async(async_app, path, method, args.requests)))
+
+
+if __name__ == '__main__':
+    main()
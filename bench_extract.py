@@ -0,0 +1,133 @@
+"""Compare per-record key probing with the compiled extraction schema on one payload.
+
+    python bench_extract.py --records 100000
+    python bench_extract.py --payload recorded_response.json
+
+`--payload` takes a saved data.gov.in JSON response; without it a synthetic Agmarknet
+payload of `--records` rows is generated. Both paths run over every record; the
+per-kg prices they disagree on are counted.
+"""
+import argparse
+import json
+import os
+import random
+import time
+
+STATES = ["Punjab", "Haryana", "Uttar Pradesh", "Maharashtra", "Karnataka", "Tamil Nadu"]
+COMMODITIES = ["Wheat", "Paddy(Dhan)(Common)", "Onion", "Tomato", "Potato", "Gram", "Mustard", "Cotton"]
+
+
+def synthetic_payload(n):
+    rng = random.Random(7)
+    records = []
+    for i in range(n):
+        modal = rng.randint(800, 9000)
+        records.append({
+            "state": rng.choice(STATES),
+            "district": f"District {i % 300}",
+            "market": f"Market {i % 2000}",
+            "commodity": rng.choice(COMMODITIES),
+            "variety": "Other",
+            "grade": "FAQ",
+            "arrival_date": f"{1 + i % 28:02d}/10/2026",
+            "min_price": str(modal - rng.randint(0, 300)),
+            "max_price": str(modal + rng.randint(0, 300)),
+            "modal_price": str(modal),
+        })
+    return {"records": records, "total": n}
+
+
+def legacy_extract(records):
+    """The per-record probing that query_data_gov_price used, run over every record."""
+    rows = []
+    for rec in records:
+        lower_keys = {k.lower(): k for k in rec.keys()}
+
+        def get_field(possible):
+            for p in possible:
+                k = lower_keys.get(p.lower())
+                if k and rec.get(k) not in (None, "", "NA"):
+                    return rec.get(k)
+            return None
+
+        modal = get_field(["modal_price", "modalprice", "modal price", "modal"])
+        minp = get_field(["min_price", "minprice", "min price"])
+        maxp = get_field(["max_price", "maxprice", "max price"])
+        unit_field = get_field(["price_unit", "unit", "priceunit"])
+        date = get_field(["price_date", "date", "recorded_date", "trade_date", "arrival_date"])
+        market = get_field(["market", "market_name", "marketname", "marketplace"])
+
+        chosen = modal or ((float(minp) + float(maxp)) / 2 if minp and maxp else None) or minp or maxp
+        if not chosen:
+            continue
+        s = str(chosen).replace(",", "").replace("Rs.", "").replace("₹", "").strip()
+        try:
+            price_value = float(s)
+        except Exception:
+            continue
+        if not price_value:
+            continue
+        u = (unit_field or "").lower()
+        if "quintal" in u:
+            price_per_kg = round(price_value / 100.0, 2)
+        elif "kg" in u or "kilogram" in u:
+            price_per_kg = round(price_value, 2)
+        elif "ton" in u or "tonne" in u:
+            price_per_kg = round(price_value / 1000.0, 2)
+        elif price_value > 1000:
+            price_per_kg = round(price_value / 100.0, 2)
+        else:
+            price_per_kg = round(price_value, 2)
+        rows.append({"price_per_kg": price_per_kg, "market": market, "date": date})
+    return rows
+
+
+def timed(fn, records, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        rows = fn(records)
+        best = min(best, time.perf_counter() - t0)
+    return rows, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--payload', help='recorded data.gov.in JSON response')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    os.environ['MSP_SYNC_INTERVAL'] = '0'
+    os.environ['MANDI_SYNC_INTERVAL'] = '0'
+    os.environ['MSP_MIRROR_DB'] = ':memory:'
+    os.environ['MANDI_DB'] = ':memory:'
+    import app as app_module
+    app_module.logger.setLevel('WARNING')
+
+    if args.payload:
+        with open(args.payload, encoding='utf-8') as f:
+            payload = json.load(f)
+    else:
+        payload = synthetic_payload(args.records)
+    records = payload.get("records") or payload.get("result") or payload.get("data") or []
+
+    legacy_rows, legacy_s = timed(legacy_extract, records, args.repeat)
+    t0 = time.perf_counter()
+    schema = app_module.schema_for("bench", records)
+    infer_s = time.perf_counter() - t0
+    compiled_rows, compiled_s = timed(schema.extract, records, args.repeat)
+
+    # the old path guessed the unit per record (>1000 means per quintal), so cheap
+    # per-quintal records come out 100x too high there; those show up as mismatches
+    mismatches = sum(a["price_per_kg"] != b["price_per_kg"] for a, b in zip(legacy_rows, compiled_rows))
+    print(f"{len(records)} records, best of {args.repeat}")
+    print(f"legacy probing   {legacy_s * 1000:8.1f} ms   {len(records) / legacy_s:12,.0f} rec/s")
+    print(f"compiled schema  {compiled_s * 1000:8.1f} ms   {len(records) / compiled_s:12,.0f} rec/s   "
+          f"(inference {infer_s * 1000:.2f} ms, once per resource)")
+    print(f"speedup {legacy_s / compiled_s:.1f}x   rows {len(legacy_rows)} vs {len(compiled_rows)}   "
+          f"price mismatches {mismatches}")
+
+
+if __name__ == '__main__':
+    main()
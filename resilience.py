@@ -0,0 +1,1107 @@
+"""Resilience primitives shared by the Flask and aiohttp apps.
+
+Latency windows, circuit breakers, LLM admission control, the Gemini key pool, the LLM
+provider pool, request coalescing and the pooled upstream HTTP client. Nothing here
+knows about AgroBot's routes: app.py configures and creates the instances.
+"""
+import asyncio
+import contextvars
+import logging
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeout
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import urlsplit
+
+import aiohttp
+import google.generativeai as genai
+import requests
+from google.api_core import exceptions as google_exceptions
+from google.generativeai import client as genai_client
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger('agrobot')
+
+
+# ---------- Latency windows ----------
+class LatencyWindow:
+    """Rolling window of recent call latencies for one model.
+
+    With `max_age` (seconds) samples older than that no longer count.
+    """
+
+    def __init__(self, size=200, max_age=None):
+        self._samples = deque(maxlen=size)  # (monotonic time, seconds)
+        self._lock = threading.Lock()
+        self.max_age = max_age
+        self.count = 0
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append((time.monotonic(), seconds))
+            self.count += 1
+
+    def _live(self):
+        if self.max_age is None:
+            return [s for _, s in self._samples]
+        cutoff = time.monotonic() - self.max_age
+        return [s for t, s in self._samples if t >= cutoff]
+
+    def recent(self):
+        """Number of samples still inside the window."""
+        with self._lock:
+            return len(self._live())
+
+    def percentile(self, q):
+        with self._lock:
+            samples = sorted(self._live())
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+# ---------- Circuit breakers ----------
+# Calls that fail or run past `slow_seconds` count as failures over a rolling
+# BREAKER_WINDOW; once at least BREAKER_MIN_CALLS were seen and BREAKER_FAILURE_RATE of
+# them failed, the breaker opens and callers get CircuitOpen at once instead of waiting
+# out a timeout. After BREAKER_OPEN_SECONDS one probe call is let through (half-open):
+# success closes the breaker, failure opens it again.
+BREAKER_WINDOW = float(os.getenv("BREAKER_WINDOW", "60"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+
+CIRCUIT_BREAKERS = {}
+
+
+class CircuitOpen(Exception):
+    """An upstream call was skipped because its breaker is open."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is unavailable (circuit open, retry in {max(1, int(math.ceil(retry_after)))} s)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker over a rolling window of outcomes and latencies."""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name, slow_seconds, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+                 failure_rate=BREAKER_FAILURE_RATE, open_seconds=BREAKER_OPEN_SECONDS):
+        self.name = name
+        self.slow_seconds = slow_seconds
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.state = self.CLOSED
+        self._calls = deque()  # (monotonic time, failed)
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.latency = LatencyWindow()
+        self.opens = 0
+        self.short_circuited = 0
+        CIRCUIT_BREAKERS[name] = self
+
+    def _cooldown(self, now):
+        return max(0.0, self._opened_at + self.open_seconds - now)
+
+    def routable(self):
+        """True unless the breaker is open and still cooling down (does not take the probe slot)."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            return self._cooldown(time.monotonic()) == 0 or (self.state == self.HALF_OPEN and not self._probing)
+
+    def retry_after(self):
+        with self._lock:
+            return self._cooldown(time.monotonic()) if self.state != self.CLOSED else 0.0
+
+    def allow(self):
+        """Whether a call may go upstream now; in half-open only one probe at a time."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.OPEN and self._cooldown(now) == 0:
+                self.state, self._probing = self.HALF_OPEN, False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and (not self._probing or self._cooldown(now) == 0):
+                # a probe that never reported back (abandoned stream) is replaced after a cooldown
+                self._probing, self._opened_at = True, now
+                return True
+            self.short_circuited += 1
+            return False
+
+    def check(self):
+        """allow(), raising CircuitOpen when the call must be skipped."""
+        if not self.allow():
+            raise CircuitOpen(self.name, self.retry_after() or self.open_seconds)
+
+    def record(self, ok, seconds, slow_seconds=None):
+        """Record one finished call; successes slower than `slow_seconds` count as failures."""
+        failed = not ok or seconds > (slow_seconds or self.slow_seconds)
+        now = time.monotonic()
+        if ok:
+            self.latency.add(seconds)
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if failed:
+                    self._open(now)
+                else:
+                    self.state = self.CLOSED
+                    self._calls.clear()
+                return
+            self._calls.append((now, failed))
+            while self._calls and self._calls[0][0] < now - self.window:
+                self._calls.popleft()
+            if self.state == self.CLOSED and len(self._calls) >= self.min_calls:
+                if sum(f for _, f in self._calls) / len(self._calls) >= self.failure_rate:
+                    self._open(now)
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self._opened_at = now
+        self._calls.clear()
+        self.opens += 1
+        logger.warning('Circuit breaker %s opened for %.0f s', self.name, self.open_seconds)
+
+    @contextmanager
+    def guard(self, slow_seconds=None):
+        """Run the block as one call through the breaker (CircuitOpen if it is open)."""
+        self.check()
+        t0 = time.monotonic()
+        try:
+            yield
+        except Overloaded:
+            raise  # shed locally; says nothing about the upstream
+        except Exception:
+            self.record(False, time.monotonic() - t0)
+            raise
+        self.record(True, time.monotonic() - t0, slow_seconds)
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            recent = [f for t, f in self._calls if t >= now - self.window]
+            state = {"state": self.state, "retry_after": round(self._cooldown(now), 1) if self.state != self.CLOSED else 0,
+                     "window_calls": len(recent), "window_failures": sum(recent)}
+        return dict(state, opens=self.opens, short_circuited=self.short_circuited,
+                    latency={"p50": round(self.latency.percentile(0.5), 3),
+                             "p90": round(self.latency.percentile(0.9), 3)})
+
+# ---------- LLM admission control ----------
+# A concurrency limit, a token bucket and a bounded wait queue with deadlines. Anyone
+# who cannot be admitted gets Overloaded, which the apps turn into a fast 429 (quota)
+# or 503 (capacity) with Retry-After.
+class Overloaded(Exception):
+    """An LLM call was not admitted; `status` is 429 (rate limited) or 503 (no capacity)."""
+
+    def __init__(self, message, retry_after, status=503):
+        super().__init__(message)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        self.status = status
+
+
+class AdmissionController:
+    """Concurrency limit + token bucket + bounded wait queue with deadlines."""
+
+    def __init__(self, max_concurrent, rate_per_min, burst, max_queue, max_wait):
+        self.max_concurrent = max_concurrent
+        self.rate = rate_per_min / 60.0
+        self.burst = burst
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self.waits = LatencyWindow()
+        self.holds = LatencyWindow()
+        # set while the current request holds a slot, so the LLM calls it makes on its own
+        # behalf (e.g. a summary while preparing a chat session) do not queue for a second one
+        self._held = contextvars.ContextVar('llm_admitted', default=False)
+        self.admitted = 0
+        self.rejected = {"queue_full": 0, "rate_limited": 0, "no_capacity": 0}
+        self.max_depth = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _retry_after(self, rate_limited, ahead):
+        if rate_limited and self.rate > 0:
+            # time until the bucket has a token for everyone ahead of us, and one for us
+            return (ahead + 1 - self._tokens) / self.rate
+        return self.holds.percentile(0.5) or 1.0
+
+    def acquire(self, timeout=None):
+        """Block until admitted (returns seconds waited) or raise Overloaded."""
+        start = time.monotonic()
+        deadline = start + min(timeout if timeout is not None else self.max_wait, self.max_wait)
+        with self._cond:
+            self._refill(start)
+            if self._waiting == 0 and self._active < self.max_concurrent and self._tokens >= 1:
+                return self._admit(start)
+            if self._waiting >= self.max_queue:
+                self.rejected["queue_full"] += 1
+                raise Overloaded("LLM queue is full", self._retry_after(self._tokens < 1, self._waiting), 503)
+            self._waiting += 1
+            self.max_depth = max(self.max_depth, self._waiting)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._active < self.max_concurrent and self._tokens >= 1:
+                        return self._admit(start)
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        rate_limited = self._tokens < 1
+                        self.rejected["rate_limited" if rate_limited else "no_capacity"] += 1
+                        raise Overloaded("LLM rate limit reached" if rate_limited else "LLM capacity exhausted",
+                                         self._retry_after(rate_limited, self._waiting - 1),
+                                         429 if rate_limited else 503)
+                    # wake for a released slot, the next token, or the deadline
+                    next_token = (1 - self._tokens) / self.rate if self._tokens < 1 and self.rate > 0 else remaining
+                    self._cond.wait(min(remaining, max(next_token, 0.001)))
+            finally:
+                self._waiting -= 1
+
+    def _admit(self, start):
+        self._active += 1
+        self._tokens -= 1
+        self.admitted += 1
+        waited = time.monotonic() - start
+        self.waits.add(waited)
+        return waited
+
+    def release(self, held):
+        self.holds.add(held)
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    async def acquire_async(self, timeout=None):
+        """acquire() for coroutines: waits off the event loop.
+
+        A caller cancelled while waiting gives back the slot if it is granted afterwards.
+        """
+        waiting = asyncio.ensure_future(asyncio.to_thread(self.acquire, timeout))
+        try:
+            return await asyncio.shield(waiting)
+        except asyncio.CancelledError:
+            def release_orphan(f):
+                if not f.cancelled() and f.exception() is None:
+                    self.release(0.0)
+            waiting.add_done_callback(release_orphan)
+            raise
+
+    @contextmanager
+    def admit(self, timeout=None):
+        """Hold a slot for the block; a no-op when this request already holds one."""
+        if self._held.get():
+            yield
+            return
+        self.acquire(timeout)
+        with self.holding():
+            yield
+
+    @asynccontextmanager
+    async def admit_async(self, timeout=None):
+        """admit() for coroutines."""
+        if self._held.get():
+            yield
+            return
+        await self.acquire_async(timeout)
+        with self.holding():
+            yield
+
+    @contextmanager
+    def holding(self):
+        """Mark an already acquired slot as held by this request and release it when the block ends."""
+        self._held.set(True)
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            self._held.set(False)
+            self.release(time.monotonic() - t0)
+
+    def stats(self):
+        with self._cond:
+            self._refill(time.monotonic())
+            state = {"active": self._active, "queued": self._waiting, "tokens": round(self._tokens, 2)}
+        return dict(state, max_concurrent=self.max_concurrent, rate_per_min=self.rate * 60,
+                    max_queue=self.max_queue, max_queue_depth=self.max_depth, admitted=self.admitted,
+                    rejected=dict(self.rejected),
+                    wait_seconds={"p50": round(self.waits.percentile(0.5), 3),
+                                  "p95": round(self.waits.percentile(0.95), 3)})
+
+# ---------- Gemini key pool ----------
+# Spreads Gemini calls over several API keys, each with its own client. Every key counts
+# the requests and tokens it sent per model over the last QUOTA_WINDOW against that
+# model's RPM/TPM quota, and each call goes to the key with the most headroom left. A
+# key that gets a 429 is backed off (doubling per repeat) and the call moves to another
+# key. The first key is the default client (`default_model`): prefix caches and native
+# chat sessions live in its project, so only calls placed on it use them.
+# google-generativeai has no public per-key client (genai.configure is process-wide), so
+# the other keys' clients come from its internals (client._ClientManager and
+# GenerativeModel._client). They are pinned to GENAI_TESTED_VERSION: key_client raises
+# instead of silently falling back to the default key, and tests/test_key_pool.py fails
+# on an SDK upgrade that changes them.
+GENAI_TESTED_VERSION = "0.8.5"
+GEMINI_KEY_MISSING = "Gemini API key missing. Please configure GOOGLE_API_KEY in .env."
+QUOTA_WINDOW = 60.0
+
+
+def key_client(api_key, kind):
+    """The "generative" or "generative_async" client bound to `api_key`."""
+    try:
+        manager = genai_client._ClientManager()
+        manager.configure(api_key=api_key)
+        return manager.get_default_client(kind)
+    except AttributeError as e:
+        raise RuntimeError(f"google-generativeai {genai.__version__} changed the client internals the key pool "
+                           f"uses (tested with {GENAI_TESTED_VERSION}): {e}") from e
+
+
+def in_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def usage_tokens(resp):
+    """Total tokens Gemini billed for `resp`, or None if it did not say."""
+    usage = getattr(resp, 'usage_metadata', None)
+    return getattr(usage, 'total_token_count', None) or None
+
+
+class GeminiKey:
+    """One API key: its own client, and per-model request/token use over the last minute.
+
+    `quotas` maps model name -> (RPM, TPM); unknown models get the first entry's. The
+    primary key serves its models from `default_model` (the process-wide client).
+    """
+
+    def __init__(self, label, api_key, quotas, default_model=None):
+        self.label = label
+        self.primary = default_model is not None
+        self.quotas = quotas
+        self._api_key = api_key
+        self._default_model = default_model
+        self._client = None
+        self._async_client = None
+        self._models = {}
+        self._sent = {}  # model name -> deque of [monotonic time, tokens]
+        self.in_flight = 0
+        self.backoff_until = 0.0
+        self.strikes = 0
+        self.requests = 0
+        self.throttled = 0
+
+    def model(self, name):
+        """GenerativeModel for `name` bound to this key's clients.
+
+        The async client binds to an event loop when it is created, so it is only made
+        (once) when a coroutine asks for the model; worker threads get the sync one.
+        """
+        if self.primary:
+            return self._default_model(name)
+        m = self._models.get(name)
+        if m is None:
+            if self._client is None:
+                self._client = key_client(self._api_key, "generative")
+            m = genai.GenerativeModel(name)
+            if not {"_client", "_async_client"} <= vars(m).keys():
+                # assigning them anyway would quietly send this key's calls on the default key
+                raise RuntimeError(f"google-generativeai {genai.__version__} no longer keeps its client on "
+                                   f"GenerativeModel (tested with {GENAI_TESTED_VERSION})")
+            m._client = self._client
+            self._models[name] = m
+        if m._async_client is None and in_event_loop():
+            if self._async_client is None:
+                self._async_client = key_client(self._api_key, "generative_async")
+            m._async_client = self._async_client
+        return m
+
+    def _window(self, model_name, now):
+        sent = self._sent.setdefault(model_name, deque())
+        while sent and sent[0][0] <= now - QUOTA_WINDOW:
+            sent.popleft()
+        return sent
+
+    def headroom(self, model_name, tokens, now):
+        """Smaller of the RPM and TPM shares left for `model_name` after this call; < 0 if it does not fit."""
+        rpm, tpm = self.quotas.get(model_name) or next(iter(self.quotas.values()))
+        sent = self._window(model_name, now)
+        return min((rpm - len(sent) - 1) / rpm, (tpm - sum(t for _, t in sent) - tokens) / tpm)
+
+    def free_at(self, model_name, now):
+        """When the oldest call for `model_name` leaves the window."""
+        sent = self._window(model_name, now)
+        return sent[0][0] + QUOTA_WINDOW if sent else now
+
+    def stats(self, now):
+        return {"in_flight": self.in_flight, "requests": self.requests, "throttled": self.throttled,
+                "backoff": round(max(0.0, self.backoff_until - now), 1),
+                "last_minute": {name: {"requests": len(self._window(name, now)),
+                                       "tokens": sum(t for _, t in self._window(name, now))}
+                                for name in list(self._sent)}}
+
+
+class GeminiKeyPool:
+    """Least-loaded dispatch over GeminiKeys with local quota tracking and 429 backoff.
+
+    The first of `api_keys` is the one `default_model` is configured with; a key that
+    gets a 429 sits out `backoff` seconds, doubling per repeat up to `max_backoff`.
+    """
+
+    def __init__(self, api_keys, quotas, default_model, backoff=30.0, max_backoff=300.0):
+        self.keys = [GeminiKey(f"key{i + 1}", k, quotas, default_model if i == 0 else None)
+                     for i, k in enumerate(api_keys)]
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def acquire(self, model_name, tokens, exclude=()):
+        """Reserve quota on the key with the most headroom; returns (key, reservation).
+
+        Raises Overloaded (429) when no key has quota left for this call.
+        """
+        if not self.keys:
+            raise RuntimeError(GEMINI_KEY_MISSING)
+        now = time.monotonic()
+        with self._lock:
+            best, best_room = None, None
+            for key in self.keys:
+                if key in exclude or key.backoff_until > now:
+                    continue
+                room = key.headroom(model_name, tokens, now)
+                if room >= 0 and (best is None or (room, -key.in_flight) > (best_room, -best.in_flight)):
+                    best, best_room = key, room
+            if best is None:
+                self.rejected += 1
+                waits = [max(k.backoff_until, k.free_at(model_name, now)) - now for k in self.keys if k not in exclude]
+                raise Overloaded(f"Gemini quota exhausted on all {len(self.keys)} keys", min(waits, default=1.0), 429)
+            reservation = [now, tokens]
+            best._window(model_name, now).append(reservation)
+            best.in_flight += 1
+            best.requests += 1
+            return best, reservation
+
+    def release(self, key, reservation, used=None, throttled=False):
+        """Return the key; `used` corrects the token reservation, `throttled` backs the key off."""
+        with self._lock:
+            key.in_flight -= 1
+            if used is not None:
+                reservation[1] = used
+            if throttled:
+                key.throttled += 1
+                key.backoff_until = time.monotonic() + min(self.max_backoff, self.backoff * 2 ** key.strikes)
+                key.strikes += 1
+                logger.warning('Gemini %s got 429; backing off until its quota recovers', key.label)
+            else:
+                key.strikes = 0
+
+    def call(self, model_name, tokens, send):
+        """send(key) on the least-loaded key, moving to another key on 429."""
+        tried, error = set(), None
+        while len(tried) < len(self.keys):
+            key, reservation = self.acquire(model_name, tokens, tried)
+            try:
+                resp = send(key)
+            except google_exceptions.ResourceExhausted as e:
+                self.release(key, reservation, throttled=True)
+                tried.add(key)
+                error = e
+                continue
+            except Exception:
+                self.release(key, reservation)
+                raise
+            self.release(key, reservation, usage_tokens(resp))
+            return resp
+        raise error or RuntimeError(GEMINI_KEY_MISSING)
+
+    async def acall(self, model_name, tokens, send):
+        """Async twin of call(); `send(key)` returns an awaitable."""
+        tried, error = set(), None
+        while len(tried) < len(self.keys):
+            key, reservation = self.acquire(model_name, tokens, tried)
+            try:
+                resp = await send(key)
+            except google_exceptions.ResourceExhausted as e:
+                self.release(key, reservation, throttled=True)
+                tried.add(key)
+                error = e
+                continue
+            except BaseException:
+                self.release(key, reservation)
+                raise
+            self.release(key, reservation, usage_tokens(resp))
+            return resp
+        raise error or RuntimeError(GEMINI_KEY_MISSING)
+
+    def stream(self, model_name, tokens, open_stream):
+        """Yield chunks from open_stream(key); a 429 before the first chunk moves to another key."""
+        tried, error = set(), None
+        while len(tried) < len(self.keys):
+            key, reservation = self.acquire(model_name, tokens, tried)
+            started, last = False, None
+            try:
+                for chunk in open_stream(key):
+                    started, last = True, chunk
+                    yield chunk
+            except google_exceptions.ResourceExhausted as e:
+                self.release(key, reservation, throttled=True)
+                if started:
+                    raise
+                tried.add(key)
+                error = e
+                continue
+            except BaseException:
+                self.release(key, reservation)
+                raise
+            self.release(key, reservation, usage_tokens(last))
+            return
+        raise error or RuntimeError(GEMINI_KEY_MISSING)
+
+    @contextmanager
+    def reserve(self, model_name, tokens, primary_only=False):
+        """Hold quota for a call made outside call()/stream(); yields the key to use.
+
+        Chat sessions and cached contents live on the default client, so they pass
+        primary_only and are counted against the first key.
+        """
+        exclude = [k for k in self.keys if not k.primary] if primary_only else ()
+        key, reservation = self.acquire(model_name, tokens, exclude)
+        try:
+            yield key
+        except google_exceptions.ResourceExhausted:
+            self.release(key, reservation, throttled=True)
+            raise
+        except BaseException:
+            self.release(key, reservation)
+            raise
+        self.release(key, reservation)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {"keys": len(self.keys), "rejected": self.rejected,
+                    "per_key": {k.label: k.stats(now) for k in self.keys}}
+
+# ---------- LLM provider pool ----------
+# Each call goes to the first healthy provider: one whose recent error rate (last
+# LLM_HEALTH_WINDOW seconds) is below LLM_ERROR_THRESHOLD, and which is not more than
+# LLM_LATENCY_SWITCH_RATIO slower at p90 than the next. Failures fail over to the next
+# provider. With `hedge` a second request is also fired when the first has not answered
+# by its route's p90 latency, and whichever answers first wins.
+LLM_ERROR_THRESHOLD = float(os.getenv("LLM_ERROR_THRESHOLD", "0.5"))
+LLM_HEALTH_WINDOW = float(os.getenv("LLM_HEALTH_WINDOW", "60"))
+LLM_LATENCY_SWITCH_RATIO = float(os.getenv("LLM_LATENCY_SWITCH_RATIO", "2.0"))
+LLM_MIN_SAMPLES = 10
+HEDGE_MIN_SECONDS = 1.0
+
+
+class ProviderHealth:
+    """Recent outcomes (time-bounded) and per-route latency for one provider."""
+
+    def __init__(self, window):
+        self.window = window
+        self._outcomes = deque(maxlen=500)  # (monotonic time, ok)
+        self._latency = {}                   # route -> LatencyWindow (successful calls)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+    def record(self, route, seconds, ok):
+        with self._lock:
+            self._outcomes.append((time.monotonic(), ok))
+            self.calls += 1
+            if not ok:
+                self.errors += 1
+            if ok:
+                self._latency.setdefault(route, LatencyWindow()).add(seconds)
+
+    def error_rate(self):
+        """Error share over the last `window` seconds (0.0 below LLM_MIN_SAMPLES calls)."""
+        cutoff = time.monotonic() - self.window
+        with self._lock:
+            recent = [ok for t, ok in self._outcomes if t >= cutoff]
+        if len(recent) < LLM_MIN_SAMPLES:
+            return 0.0
+        return 1.0 - sum(recent) / len(recent)
+
+    def p90(self, route):
+        """p90 latency for `route`, or None until there are enough samples."""
+        with self._lock:
+            w = self._latency.get(route)
+        if w is None or w.count < LLM_MIN_SAMPLES:
+            return None
+        return w.percentile(0.9)
+
+    def stats(self):
+        with self._lock:
+            routes = dict(self._latency)
+        return {"calls": self.calls, "errors": self.errors, "error_rate": round(self.error_rate(), 4),
+                "latency": {r: {"p50": round(w.percentile(0.5), 3), "p90": round(w.percentile(0.9), 3)}
+                            for r, w in routes.items()}}
+
+
+class ProviderPool:
+    """Route LLM calls across providers by health and latency, with failover and optional hedging.
+
+    `router` classifies requests into routes and holds their latency budgets; every call
+    is admitted through `admission`. Each provider gets a breaker that counts calls
+    slower than `slow_seconds` (or the route's budget) as failures.
+    """
+
+    def __init__(self, providers, router, admission, slow_seconds, hedge=False):
+        self.providers = providers
+        self.router = router
+        self.admission = admission
+        self.hedge = hedge
+        self.health = {p.name: ProviderHealth(LLM_HEALTH_WINDOW) for p in providers}
+        self.breakers = {p.name: CircuitBreaker(p.name, slow_seconds) for p in providers}
+        self._executor = ThreadPoolExecutor(max_workers=int(os.getenv("LLM_HEDGE_WORKERS", "32")),
+                                            thread_name_prefix='llm')
+        self.failovers = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def available(self):
+        return any(p.available() for p in self.providers)
+
+    def routable(self):
+        """True if some configured provider's breaker would let a call through."""
+        return any(p.available() and self.breakers[p.name].routable() for p in self.providers)
+
+    def order(self, lane):
+        """Available providers for a classified route, best first: healthy before unhealthy, then preference order
+        unless a later provider is LLM_LATENCY_SWITCH_RATIO times faster at p90. Open breakers are left out."""
+        live = [p for p in self.providers if p.available() and self.breakers[p.name].routable()]
+        healthy = [p for p in live if self.health[p.name].error_rate() <= LLM_ERROR_THRESHOLD]
+        ordered = healthy + [p for p in live if p not in healthy]
+        if len(healthy) > 1:
+            first, second = (self.health[p.name].p90(lane) for p in healthy[:2])
+            if first is not None and second is not None and first > LLM_LATENCY_SWITCH_RATIO * second:
+                ordered[0], ordered[1] = ordered[1], ordered[0]
+        return ordered
+
+    def _providers(self, route, messages):
+        """order() for this request; CircuitOpen when every configured provider is open."""
+        providers = self.order(self.router.classify(route, messages))
+        if providers:
+            return providers
+        if self.available():
+            raise CircuitOpen("LLM", min(b.retry_after() for b in self.breakers.values()))
+        raise RuntimeError(GEMINI_KEY_MISSING)
+
+    def _record(self, provider, lane, seconds, ok):
+        self.health[provider.name].record(lane, seconds, ok)
+        self.breakers[provider.name].record(ok, seconds, self.router.budgets.get(lane))
+
+    def _call(self, provider, messages, language, route):
+        self.breakers[provider.name].check()
+        lane, t0 = self.router.classify(route, messages), time.monotonic()
+        try:
+            result = provider.generate(messages, language, route)
+        except Overloaded:
+            # refused locally (key quota), never reached the provider
+            raise
+        except Exception:
+            self._record(provider, lane, time.monotonic() - t0, False)
+            raise
+        self._record(provider, lane, time.monotonic() - t0, True)
+        return result
+
+    async def _acall(self, provider, messages, language, route):
+        self.breakers[provider.name].check()
+        lane, t0 = self.router.classify(route, messages), time.monotonic()
+        try:
+            result = await provider.agenerate(messages, language, route)
+        except Overloaded:
+            raise
+        except Exception:
+            self._record(provider, lane, time.monotonic() - t0, False)
+            raise
+        self._record(provider, lane, time.monotonic() - t0, True)
+        return result
+
+    def _hedge_after(self, provider, route, messages, providers):
+        if not self.hedge or len(providers) < 2:
+            return None
+        p90 = self.health[provider.name].p90(self.router.classify(route, messages))
+        return max(HEDGE_MIN_SECONDS, p90) if p90 is not None else None
+
+    def generate(self, messages, language, route="chat"):
+        providers = self._providers(route, messages)
+        hedge_after = self._hedge_after(providers[0], route, messages, providers)
+        with self.admission.admit():
+            if hedge_after is not None:
+                return self._hedged(providers, messages, language, route, hedge_after)
+            return self._failover(providers, messages, language, route)
+
+    def _failover(self, providers, messages, language, route):
+        error = None
+        for i, provider in enumerate(providers):
+            if i:
+                self.failovers += 1
+            try:
+                return self._call(provider, messages, language, route)
+            except Exception as e:
+                logger.warning('LLM provider %s failed: %s', provider.name, e)
+                error = e
+        raise error
+
+    def _hedged(self, providers, messages, language, route, hedge_after):
+        first = self._executor.submit(self._call, providers[0], messages, language, route)
+        try:
+            return first.result(timeout=hedge_after)
+        except FutureTimeout:
+            pass
+        except Exception as e:
+            logger.warning('LLM provider %s failed: %s', providers[0].name, e)
+            self.failovers += 1
+            return self._failover(providers[1:], messages, language, route)
+        # the first provider is past its p90: race a second request against it
+        self.hedges += 1
+        second = self._executor.submit(self._call, providers[1], messages, language, route)
+        error = None
+        for future in as_completed([first, second]):
+            try:
+                result = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if future is second:
+                self.hedge_wins += 1
+            return result
+        raise error
+
+    def stream(self, messages, language, route="chat"):
+        """Stream from the best provider, failing over only if it breaks before the first chunk."""
+        providers = self._providers(route, messages)
+        with self.admission.admit():
+            yield from self._stream(providers, messages, language, route)
+
+    def _stream(self, providers, messages, language, route):
+        lane = self.router.classify(route, messages)
+        for i, provider in enumerate(providers):
+            t0 = time.monotonic()
+            started = None  # seconds to the first chunk
+            try:
+                self.breakers[provider.name].check()
+                for text in provider.stream(messages, language, route):
+                    if started is None:
+                        started = time.monotonic() - t0
+                    yield text
+            except Exception as e:
+                if not isinstance(e, (CircuitOpen, Overloaded)):
+                    self._record(provider, lane, time.monotonic() - t0, False)
+                if started is not None or i == len(providers) - 1:
+                    raise
+                logger.warning('LLM provider %s failed before streaming: %s', provider.name, e)
+                self.failovers += 1
+                continue
+            # the breaker judges a stream by its time to first chunk, not its length
+            self.health[provider.name].record(lane, time.monotonic() - t0, True)
+            self.breakers[provider.name].record(True, started or 0.0, self.router.budgets.get(lane))
+            return
+
+    async def agenerate(self, messages, language, route="chat"):
+        providers = self._providers(route, messages)
+        async with self.admission.admit_async():
+            return await self._agenerate(providers, messages, language, route)
+
+    async def _agenerate(self, providers, messages, language, route):
+        hedge_after = self._hedge_after(providers[0], route, messages, providers)
+        first = asyncio.ensure_future(self._acall(providers[0], messages, language, route))
+        done, _ = await asyncio.wait({first}, timeout=hedge_after)
+        if done and first.exception() is None:
+            return first.result()
+        if done:
+            # the first provider failed: try the rest in order
+            logger.warning('LLM provider %s failed: %s', providers[0].name, first.exception())
+            error = first.exception()
+            for provider in providers[1:]:
+                self.failovers += 1
+                try:
+                    return await self._acall(provider, messages, language, route)
+                except Exception as e:
+                    error = e
+            raise error
+        self.hedges += 1
+        second = asyncio.ensure_future(self._acall(providers[1], messages, language, route))
+        pending, error = {first, second}, None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    if task is second:
+                        self.hedge_wins += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+
+    def stats(self):
+        return {"providers": [p.name for p in self.providers if p.available()], "hedge": self.hedge,
+                "failovers": self.failovers, "hedges": self.hedges, "hedge_wins": self.hedge_wins,
+                "health": {name: h.stats() for name, h in self.health.items()},
+                "breakers": {name: b.state for name, b in self.breakers.items()}}
+
+# ---------- Request coalescing ----------
+class SingleFlight:
+    """Collapse concurrent identical calls into one upstream call whose result every caller shares.
+
+    The first caller for a key runs `fn`; callers arriving while it is in flight wait for
+    it and get the same result (or exception). Nothing is remembered once the call ends.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.callers = 1
+            self.result = None
+            self.error = None
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}
+        self.upstream_calls = 0
+        self.callers_served = 0
+        self.max_callers = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+            else:
+                call.callers += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+        finally:
+            with self._lock:
+                del self._calls[key]
+                self.upstream_calls += 1
+                self.callers_served += call.callers
+                self.max_callers = max(self.max_callers, call.callers)
+            call.done.set()
+            if call.callers > 1:
+                logger.info('%s: one upstream call served %d callers', self.name, call.callers)
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    async def ado(self, key, fn, *args, **kwargs):
+        """do() for coroutine functions: callers on one event loop await a single fn(...) task.
+
+        The task is shielded, so a cancelled caller does not cancel it for the others.
+        """
+        slot = (id(asyncio.get_running_loop()), key)
+        with self._lock:
+            entry = self._tasks.get(slot)
+            if entry is None:
+                entry = self._tasks[slot] = [asyncio.ensure_future(fn(*args, **kwargs)), 0]
+                entry[0].add_done_callback(lambda task: self._finish_task(slot, entry))
+            entry[1] += 1
+        return await asyncio.shield(entry[0])
+
+    def _finish_task(self, slot, entry):
+        with self._lock:
+            del self._tasks[slot]
+            self.upstream_calls += 1
+            self.callers_served += entry[1]
+            self.max_callers = max(self.max_callers, entry[1])
+        if entry[1] > 1:
+            logger.info('%s: one upstream call served %d callers', self.name, entry[1])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "upstream_calls": self.upstream_calls,
+                "callers_served": self.callers_served,
+                "coalesced": self.callers_served - self.upstream_calls,
+                "max_callers": self.max_callers,
+                "in_flight": len(self._calls) + len(self._tasks),
+            }
+
+# ---------- Upstream HTTP client ----------
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class UpstreamTimeout(requests.Timeout):
+    """Raised when a call's overall deadline runs out (waiting for a slot, or between retries)."""
+
+
+class UpstreamClient:
+    """Shared keep-alive session with per-host concurrency limits, retries and deadlines.
+
+    get() takes an overall `deadline` in seconds: each attempt gets only the time that is
+    left, and retries (connection errors, timeouts, 429/5xx) back off with full jitter.
+    aget() does the same on a caller's aiohttp session, under the same counters.
+    """
+
+    def __init__(self, pool_size, host_limit, retries, backoff, backoff_max):
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.pool_size = pool_size
+        self.host_limit = host_limit
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._async_slots = {}
+        self.in_flight = 0
+        self.counters = {"requests": 0, "attempts": 0, "retries": 0, "failures": 0,
+                         "deadline_exceeded": 0, "slot_waits": 0, "max_in_flight": 0}
+
+    def _slot(self, host):
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.host_limit)
+            return self._slots[host]
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def _started(self):
+        with self._lock:
+            self.in_flight += 1
+            self.counters["attempts"] += 1
+            self.counters["max_in_flight"] = max(self.counters["max_in_flight"], self.in_flight)
+
+    def _finished(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _pause(self, attempt, retry_after, ends):
+        self._count("retries")
+        pause = random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+        if retry_after and retry_after.isdigit():
+            pause = max(pause, min(float(retry_after), self.backoff_max))
+        return max(0.0, min(pause, ends - time.monotonic()))
+
+    def get(self, url, params=None, deadline=10):
+        ends = time.monotonic() + deadline
+        slot = self._slot(urlsplit(url).netloc)
+        self._count("requests")
+        attempt = 0
+        while True:
+            remaining = ends - time.monotonic()
+            if remaining <= 0:
+                self._count("deadline_exceeded")
+                raise UpstreamTimeout(f"deadline of {deadline}s exceeded for {urlsplit(url).netloc}")
+            if not slot.acquire(blocking=False):
+                self._count("slot_waits")
+                if not slot.acquire(timeout=remaining):
+                    self._count("deadline_exceeded")
+                    raise UpstreamTimeout(f"no free connection slot for {urlsplit(url).netloc} within {deadline}s")
+            self._started()
+            error, resp = None, None
+            try:
+                resp = self.session.get(url, params=params, timeout=max(0.1, ends - time.monotonic()))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                self._finished()
+                slot.release()
+
+            retryable = error is not None or resp.status_code in RETRY_STATUSES
+            if not retryable or attempt >= self.retries:
+                if error is not None:
+                    self._count("failures")
+                    raise error
+                return resp
+
+            attempt += 1
+            time.sleep(self._pause(attempt, resp.headers.get("Retry-After") if resp is not None else None, ends))
+
+    async def aget(self, session, url, params=None, deadline=10):
+        """get() on an aiohttp session; returns (status, parsed JSON or None)."""
+        ends = time.monotonic() + deadline
+        host = urlsplit(url).netloc
+        # asyncio semaphores belong to one event loop, so the async slots are kept per loop
+        slot = self._async_slots.setdefault((id(asyncio.get_running_loop()), host), asyncio.Semaphore(self.host_limit))
+        self._count("requests")
+        attempt = 0
+        while True:
+            remaining = ends - time.monotonic()
+            if remaining <= 0:
+                self._count("deadline_exceeded")
+                raise UpstreamTimeout(f"deadline of {deadline}s exceeded for {host}")
+            if slot.locked():
+                self._count("slot_waits")
+            try:
+                await asyncio.wait_for(slot.acquire(), remaining)
+            except asyncio.TimeoutError:
+                self._count("deadline_exceeded")
+                raise UpstreamTimeout(f"no free connection slot for {host} within {deadline}s") from None
+            self._started()
+            error, status, data, retry_after = None, None, None, None
+            try:
+                timeout = aiohttp.ClientTimeout(total=max(0.1, ends - time.monotonic()))
+                async with session.get(url, params=params, timeout=timeout) as response:
+                    status, retry_after = response.status, response.headers.get("Retry-After")
+                    data = await response.json(content_type=None) if status == 200 else None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            finally:
+                self._finished()
+                slot.release()
+
+            retryable = error is not None or status in RETRY_STATUSES
+            if not retryable or attempt >= self.retries:
+                if error is not None:
+                    self._count("failures")
+                    raise error
+                return status, data
+
+            attempt += 1
+            await asyncio.sleep(self._pause(attempt, retry_after, ends))
+
+    def stats(self):
+        pools = self.adapter.poolmanager.pools
+        opened = served = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                served += pool.num_requests
+        with self._lock:
+            return dict(self.counters, in_flight=self.in_flight, pool_size=self.pool_size,
+                        host_limit=self.host_limit,
+                        saturation=round(self.in_flight / self.pool_size, 3),
+                        connections_opened=opened, http_requests=served,
+                        connection_reuse_rate=round(1 - opened / served, 4) if served else 0.0)
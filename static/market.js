@@ -56,9 +56,36 @@ document.addEventListener('DOMContentLoaded', () => {
     search(v);
   });
 
+  // autocomplete: ask /market/suggest on every keystroke, dropping stale requests
+  const suggestions = document.getElementById('market-suggestions');
+  let pendingSuggest = null;
+
+  input.addEventListener('input', async () => {
+    const q = input.value.trim();
+    if (pendingSuggest) pendingSuggest.abort();
+    if (!q || !suggestions) {
+      if (suggestions) suggestions.innerHTML = '';
+      return;
+    }
+    pendingSuggest = new AbortController();
+    try {
+      const res = await fetch(`/market/suggest?q=${encodeURIComponent(q)}`, { signal: pendingSuggest.signal });
+      const data = await res.json();
+      suggestions.innerHTML = (data.suggestions || [])
+        .map(s => `<option value="${escapeHtml(s.label)}"></option>`)
+        .join('');
+    } catch (e) {
+      if (e.name !== 'AbortError') console.error('suggest failed', e);
+    }
+  });
+
+  input.addEventListener('keydown', (e) => {
+    if (e.key === 'Enter') btn.click();
+  });
+
   // helper
   function escapeHtml(s) {
     if (!s) return '';
-    return String(s).replace(/&/g,'&amp;').replace(/</g,'&lt;').replace(/>/g,'&gt;');
+    return String(s).replace(/&/g,'&amp;').replace(/</g,'&lt;').replace(/>/g,'&gt;').replace(/"/g,'&quot;');
   }
 });
@@ -7,12 +7,18 @@
 
 const STORAGE_KEY = 'agroai_chat_history_v4';
 const STORAGE_PREFIX = 'agroai_chat_v4::';
+const CONVERSATION_PREFIX = 'agroai_conversation_v1::';
 let messages = [];
 
 function makeStorageKey(soil, climate) {
   return `${STORAGE_PREFIX}${soil || '__'}::${climate || '__'}`;
 }
 
+// server-side conversation id for a (soil, climate) context; '' for general chat
+function makeConversationKey(soil, climate) {
+  return `${CONVERSATION_PREFIX}${soil || '__'}::${climate || '__'}`;
+}
+
 function loadHistoryForContext(soil, climate) {
   const raw = localStorage.getItem(makeStorageKey(soil, climate));
   if (!raw) {
@@ -621,13 +627,90 @@ function addMessageElement(role, content, ts) {
   chatHistoryEl.scrollTop = chatHistoryEl.scrollHeight;
 }
 function setLoading(on = true) {
-  if (on) addMessageElement('assistant', 'Thinking...');
-  else {
-    const last = chatHistoryEl.lastElementChild;
-    if (last && last.textContent && last.textContent.includes('Thinking')) last.remove();
+  if (on) {
+    addMessageElement('assistant', 'Thinking...');
+    chatHistoryEl.lastElementChild.classList.add('loading');
+  } else {
+    const last = chatHistoryEl.querySelector('.message.loading');
+    if (last) last.remove();
   }
 }
 
+/* ---------- Streaming advice (Server-Sent Events over POST) ---------- */
+// Reads /get_advice/stream, painting chunks into the "Thinking..." bubble as they arrive.
+// Resolves with the final {response, timestamp} payload; falls back to /get_advice if streaming is unavailable.
+async function fetchAdviceStream(payload) {
+  const res = await fetch('/get_advice/stream', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' },
+    body: JSON.stringify(payload)
+  });
+
+  if (!res.ok) {
+    // 429/503 when the server is shedding load: show its "Server busy" message as the reply.
+    // The request was refused, not lost, so it is not sent again.
+    const data = await res.json().catch(() => ({}));
+    if (data.error) return { response: data.error };
+    throw new Error(`Advice request failed (${res.status})`);
+  }
+
+  if (!res.body || !res.body.getReader) {
+    // no streaming support in this browser: ask for the plain JSON reply instead
+    const fallback = await fetch('/get_advice', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(payload)
+    });
+    const data = await fallback.json();
+    if (!fallback.ok && data.error) return { response: data.error };
+    return data;
+  }
+
+  const bubble = chatHistoryEl.querySelector('.message.loading');
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let text = '';
+  let final = null;
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let sep;
+    while ((sep = buffer.indexOf('\n\n')) !== -1) {
+      const frame = buffer.slice(0, sep);
+      buffer = buffer.slice(sep + 2);
+      let event = 'message';
+      let dataLine = '';
+      frame.split('\n').forEach(line => {
+        if (line.startsWith('event:')) event = line.slice(6).trim();
+        else if (line.startsWith('data:')) dataLine += line.slice(5).trim();
+      });
+      if (!dataLine) continue;
+      const data = JSON.parse(dataLine);
+      if (event === 'chunk') {
+        text += data.text;
+        if (bubble) {
+          bubble.innerHTML = text;
+          chatHistoryEl.scrollTop = chatHistoryEl.scrollHeight;
+        }
+      } else if (event === 'done') {
+        final = data;
+      }
+    }
+  }
+
+  if (final) return final;
+  // the stream was cut before its `done` event: never show a partial reply as complete
+  if (!text) throw new Error('Advice stream ended without a reply');
+  return {
+    response: `${text}<br><br><em>Connection interrupted: this reply may be incomplete. Please ask again.</em>`,
+    timestamp: new Date().toISOString()
+  };
+}
+
 /* ---------- Core: Get Advice (sends language to server) ---------- */
 async function getAdvice() {
   const soil = soilSelect.value;
@@ -667,19 +750,17 @@ async function getAdvice() {
   addMessageElement('user', userMsg.content, userMsg.timestamp);
   setLoading(true);
 
+  // Only the new turn goes up; the server keeps the rest of the conversation.
+  // Without a conversation id yet, send the local history once so the server can seed it.
+  const conversationKey = usingContext ? makeConversationKey(soil, climate) : makeConversationKey('', '');
+  const conversationId = localStorage.getItem(conversationKey);
+  const payload = { soil_type: soil, climate: climate, language: lang, message: userMsg.content };
+  if (conversationId) payload.conversation_id = conversationId;
+  else payload.messages = messages.slice(0, -1).map(m => ({ role: m.role, content: m.content }));
+
   try {
-    const res = await fetch('/get_advice', {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({
-        soil_type: soil,
-        climate: climate,
-        language: lang,
-        messages: messages.map(m => ({ role: m.role, content: m.content }))
-      })
-    });
-    const data = await res.json();
-    setLoading(false);
+    const data = await fetchAdviceStream(payload);
+    if (data.conversation_id) localStorage.setItem(conversationKey, data.conversation_id);
     const botMsg = {
       role: 'assistant',
       content: data.response,
@@ -687,6 +768,7 @@ async function getAdvice() {
     };
     messages.push(botMsg);
     saveHistoryForContext(soil, climate);
+    setLoading(false);
     addMessageElement('assistant', botMsg.content, botMsg.timestamp);
   } catch (err) {
     console.error(err);
@@ -769,6 +851,8 @@ function clearHistory() {
   if (!confirm('Clear chat history?')) return;
   messages = [];
   localStorage.removeItem(STORAGE_KEY);
+  localStorage.removeItem(makeConversationKey('', ''));
+  if (soilSelect.value && climateSelect.value) localStorage.removeItem(makeConversationKey(soilSelect.value, climateSelect.value));
   chatHistoryEl.innerHTML = '';
 }
 
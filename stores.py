@@ -0,0 +1,452 @@
+"""SQLite-backed stores: the conversation log, the MSP mirror, the crop knowledge base
+and the mandi price series.
+
+Each store keeps one connection, shared across threads under the store's lock. It is
+opened on first use (WAL mode, so readers do not block the writer) and only then is the
+schema created: importing the app touches no database file. What a store needs from the
+app (crop-name keying, the data.gov.in pages to sync from) is passed to its constructor.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+logger = logging.getLogger('agrobot')
+
+
+class SqliteStore:
+    """Base for the SQLite-backed stores: a lazily opened connection plus `_setup`."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def _db(self):
+        if self._conn is None:
+            with self._open_lock:
+                if self._conn is None:
+                    db = sqlite3.connect(self.path, check_same_thread=False)
+                    db.row_factory = sqlite3.Row
+                    db.execute("PRAGMA journal_mode=WAL")
+                    self._setup(db)
+                    self._conn = db
+        return self._conn
+
+    def _setup(self, db):
+        """Create the schema on a freshly opened connection."""
+
+
+class ConversationStore(SqliteStore):
+    """Append-only SQLite message log keyed by conversation id.
+
+    Clients send only the new user turn plus a conversation_id; the server rebuilds the
+    context from here, so upload size stays flat however long the chat gets.
+    """
+
+    def _setup(self, db):
+        with db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS conversations (
+                    id TEXT PRIMARY KEY,
+                    soil TEXT,
+                    climate TEXT,
+                    language TEXT,
+                    created_at TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    conversation_id TEXT NOT NULL REFERENCES conversations(id),
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(conversation_id, id);
+            """)
+
+    def create(self, soil=None, climate=None, language=None, messages=()):
+        """New conversation, seeded with `messages` ((role, content) pairs) in the same transaction."""
+        conv_id = uuid.uuid4().hex
+        now = datetime.utcnow().isoformat() + "Z"
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO conversations (id, soil, climate, language, created_at) VALUES (?, ?, ?, ?, ?)",
+                (conv_id, soil, climate, language, now))
+            self._db.executemany(
+                "INSERT INTO messages (conversation_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                [(conv_id, role, content, now) for role, content in messages])
+        return conv_id
+
+    def exists(self, conv_id):
+        with self._lock:
+            row = self._db.execute("SELECT 1 FROM conversations WHERE id = ?", (conv_id,)).fetchone()
+        return row is not None
+
+    def append(self, conv_id, role, content):
+        with self._lock, self._db:
+            cur = self._db.execute(
+                "INSERT INTO messages (conversation_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                (conv_id, role, content, datetime.utcnow().isoformat() + "Z"))
+        return cur.lastrowid
+
+    def discard(self, conv_id, message_id, created=False):
+        """Remove one message, and the whole conversation if `created` (it held nothing else)."""
+        with self._lock, self._db:
+            if created:
+                self._db.execute("DELETE FROM messages WHERE conversation_id = ?", (conv_id,))
+                self._db.execute("DELETE FROM conversations WHERE id = ?", (conv_id,))
+            else:
+                self._db.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+
+    def messages(self, conv_id):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY id", (conv_id,)).fetchall()
+        return [{"role": r["role"], "content": r["content"]} for r in rows]
+
+
+class MspMirror(SqliteStore):
+    """SQLite snapshot of the MSP dataset with an in-memory crop-name index.
+
+    sync() replaces the snapshot with every record `pages()` yields (one list per
+    data.gov.in page). The index is read from the snapshot on first use and replaced by
+    every sync.
+    """
+
+    def __init__(self, path, pages):
+        super().__init__(path)
+        self.pages = pages
+        self._by_name = None
+        self._names = []
+        self.listeners = []  # called after every sync
+        self.synced_at = None
+        self.last_error = None
+        self.syncs = 0
+        self.lookups = 0
+
+    def _setup(self, db):
+        with db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS msp_records (
+                    crop TEXT PRIMARY KEY,
+                    record TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS msp_sync (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    synced_at TEXT NOT NULL,
+                    record_count INTEGER NOT NULL
+                );
+            """)
+
+    @property
+    def ready(self):
+        return bool(self._loaded())
+
+    def _loaded(self):
+        """The crop-name index, read from the snapshot the first time it is needed."""
+        if self._by_name is None:
+            with self._lock:
+                if self._by_name is None:
+                    rows = self._db.execute("SELECT crop, record FROM msp_records").fetchall()
+                    meta = self._db.execute("SELECT synced_at FROM msp_sync WHERE id = 1").fetchone()
+                    self.synced_at = self.synced_at or (meta[0] if meta else None)
+                    self._index([json.loads(r[1]) for r in rows])
+        return self._by_name
+
+    def _index(self, records):
+        by_name = {}
+        for r in records:
+            name = (r.get("rabi_crop_wise") or "").strip().lower()
+            if name and name not in by_name:
+                by_name[name] = r
+        # swap whole objects so readers never see a half-built index
+        self._names = sorted(by_name)
+        self._by_name = by_name
+
+    def find(self, crop):
+        """Exact crop-name match, else the first name containing `crop` (as the live scan did)."""
+        self.lookups += 1
+        by_name = self._loaded()
+        match = by_name.get(crop)
+        if match is not None:
+            return match
+        return next((by_name[n] for n in self._names if crop in n), None)
+
+    def records(self):
+        return list(self._loaded().values())
+
+    def sync(self):
+        """Page through the full dataset and replace the snapshot. Returns the record count."""
+        records = []
+        try:
+            for batch in self.pages():
+                records.extend(batch)
+        except Exception as e:
+            self.last_error = f"{datetime.utcnow().isoformat()}Z {e}"
+            raise
+
+        if not records:
+            raise RuntimeError("data.gov.in returned no MSP records; keeping the previous snapshot")
+
+        synced_at = datetime.utcnow().isoformat() + "Z"
+        rows = {}
+        for r in records:
+            name = (r.get("rabi_crop_wise") or "").strip().lower()
+            if name:
+                rows.setdefault(name, json.dumps(r, ensure_ascii=False))
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM msp_records")
+            self._db.executemany("INSERT INTO msp_records (crop, record) VALUES (?, ?)", rows.items())
+            self._db.execute("INSERT OR REPLACE INTO msp_sync (id, synced_at, record_count) VALUES (1, ?, ?)",
+                             (synced_at, len(rows)))
+        self._index(records)
+        self.synced_at = synced_at
+        self.last_error = None
+        self.syncs += 1
+        logger.info('MSP mirror synced: %d records', len(rows))
+        for listener in self.listeners:
+            listener()
+        return len(rows)
+
+    def stats(self):
+        return {"records": len(self._loaded()), "synced_at": self.synced_at, "syncs": self.syncs,
+                "lookups": self.lookups, "last_error": self.last_error}
+
+
+class CropKnowledgeStore(SqliteStore):
+    """Crop name -> info dict, persisted in SQLite with an in-memory copy.
+
+    Names are keyed by `synonyms` (a CropSynonyms). The copy is read (and `seed` written
+    for crops it lacks) on first use.
+    """
+
+    def __init__(self, path, ttl, synonyms, seed=None):
+        super().__init__(path)
+        self.ttl = ttl
+        self.synonyms = synonyms
+        self._seed = seed or {}
+        self._entries = None  # crop -> (info, source, updated_at)
+        self.listeners = []  # called with the crop key after every put
+        self.hits = self.misses = self.writes = 0
+
+    def _setup(self, db):
+        with db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS crop_knowledge (
+                    crop TEXT PRIMARY KEY,
+                    info TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+
+    def _loaded(self):
+        if self._entries is None:
+            with self._lock:
+                if self._entries is None:
+                    rows = self._db.execute("SELECT crop, info, source, updated_at FROM crop_knowledge").fetchall()
+                    entries = {r[0]: (json.loads(r[1]), r[2], r[3]) for r in rows}
+                    now = time.time()
+                    seeds = {self.synonyms.resolve(crop): info for crop, info in self._seed.items()
+                             if self.synonyms.resolve(crop) not in entries}
+                    with self._db:
+                        self._db.executemany(
+                            "INSERT OR REPLACE INTO crop_knowledge (crop, info, source, updated_at) "
+                            "VALUES (?, ?, 'static', ?)",
+                            [(key, json.dumps(info, ensure_ascii=False), now) for key, info in seeds.items()])
+                    entries.update((key, (info, "static", now)) for key, info in seeds.items())
+                    self.writes += len(seeds)
+                    self._entries = entries
+        return self._entries
+
+    def _fresh(self, entry):
+        # static entries are curated and never expire
+        return entry[1] == "static" or time.time() - entry[2] < self.ttl
+
+    def get(self, *names):
+        """Info for the first of `names` with a fresh entry, else None."""
+        entries = self._loaded()
+        for name in names:
+            entry = entries.get(self.synonyms.resolve(name)) if name else None
+            if entry and self._fresh(entry):
+                self.hits += 1
+                return entry[0]
+        self.misses += 1
+        return None
+
+    def put(self, crop, info, source="gemini"):
+        key = self.synonyms.resolve(crop)
+        now = time.time()
+        self._loaded()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO crop_knowledge (crop, info, source, updated_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(info, ensure_ascii=False), source, now))
+        self._entries[key] = (info, source, now)
+        self.writes += 1
+        for listener in self.listeners:
+            listener(key)
+
+    def stats(self):
+        entries = list(self._loaded().values())
+        return {"entries": len(entries), "fresh": sum(self._fresh(e) for e in entries),
+                "hits": self.hits, "misses": self.misses, "writes": self.writes}
+
+
+class MandiPriceStore(SqliteStore):
+    """Per-commodity, per-market daily price series in SQLite.
+
+    Commodities are keyed and named by `synonyms` (a CropSynonyms); ingest() writes the
+    rows `pages()` yields, one normalized batch per data.gov.in page.
+    """
+
+    COLUMNS = ("commodity", "state", "district", "market", "variety", "price_date",
+               "min_price_per_kg", "max_price_per_kg", "modal_price_per_kg")
+    INDEXES = ("idx_mandi_commodity_date", "idx_mandi_state", "idx_mandi_market", "idx_mandi_date")
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS mandi_prices (
+            commodity_key TEXT NOT NULL,
+            commodity TEXT NOT NULL,
+            state TEXT NOT NULL,
+            district TEXT NOT NULL,
+            market TEXT NOT NULL,
+            variety TEXT NOT NULL,
+            price_date TEXT NOT NULL,
+            min_price_per_kg REAL,
+            max_price_per_kg REAL,
+            modal_price_per_kg REAL NOT NULL,
+            PRIMARY KEY (commodity, market, state, variety, price_date)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_mandi_commodity_date ON mandi_prices(commodity_key, price_date);
+        CREATE INDEX IF NOT EXISTS idx_mandi_state ON mandi_prices(state, commodity_key);
+        CREATE INDEX IF NOT EXISTS idx_mandi_market ON mandi_prices(market, commodity_key);
+        CREATE INDEX IF NOT EXISTS idx_mandi_date ON mandi_prices(price_date);
+    """
+    INSERT = ("INSERT OR REPLACE INTO mandi_prices (commodity_key, commodity, state, district, market, variety, "
+              "price_date, min_price_per_kg, max_price_per_kg, modal_price_per_kg) "
+              "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+    def __init__(self, path, synonyms, pages):
+        super().__init__(path)
+        self.synonyms = synonyms
+        self.pages = pages
+        self.last_ingest = None
+        self.last_error = None
+        self.rows_ingested = 0
+
+    def _setup(self, db):
+        """Create the table, re-keying one from before the raw-commodity primary key.
+
+        The old key merged commodities that share a synonym id, so the rows it overwrote are
+        gone: the copied rows keep what survived and the next ingest fills in the rest.
+        """
+        pk = [r["name"] for r in sorted(db.execute("PRAGMA table_info(mandi_prices)"), key=lambda r: r["pk"])
+              if r["pk"]]
+        if pk and pk[0] == "commodity_key":
+            with db:
+                db.execute("ALTER TABLE mandi_prices RENAME TO mandi_prices_old")
+                for index in self.INDEXES:
+                    db.execute(f"DROP INDEX IF EXISTS {index}")
+        db.executescript(self.SCHEMA)
+        if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'mandi_prices_old'").fetchone():
+            old = db.execute(f"SELECT {', '.join(self.COLUMNS)} FROM mandi_prices_old").fetchall()
+            with db:
+                db.executemany(self.INSERT, [(self.synonyms.resolve(r["commodity"]),) + tuple(r) for r in old])
+                db.execute("DROP TABLE mandi_prices_old")
+            logger.warning('Mandi store re-keyed on the raw commodity (%d rows kept); '
+                           'run `flask ingest-mandi` to restore rows the old key merged', len(old))
+
+    def write(self, rows):
+        with self._lock, self._db:
+            self._db.executemany(self.INSERT, rows)
+
+    def ingest(self):
+        """Write the rows of each page as it arrives. Returns the number of rows written."""
+        written = 0
+        try:
+            for rows in self.pages():
+                if rows:
+                    self.write(rows)
+                    written += len(rows)
+        except Exception as e:
+            self.last_error = f"{datetime.utcnow().isoformat()}Z {e}"
+            raise
+        self.last_ingest = datetime.utcnow().isoformat() + "Z"
+        self.last_error = None
+        self.rows_ingested += written
+        logger.info('Mandi prices ingested: %d rows', written)
+        return written
+
+    def _query(self, sql, args):
+        with self._lock:
+            return [dict(r) for r in self._db.execute(sql, args).fetchall()]
+
+    def commodities(self):
+        """One display name per commodity id: its canonical name, else its first raw spelling."""
+        return [self.synonyms.name(r["commodity_key"]) or r["commodity"] for r in self._query(
+            "SELECT commodity_key, MIN(commodity) AS commodity FROM mandi_prices GROUP BY commodity_key", ())]
+
+    def latest(self, commodity, state=None, market=None, limit=50):
+        """Most recent price per market for a commodity."""
+        cols = ", ".join(f"p.{c}" for c in self.COLUMNS)
+        sql = (f"SELECT {cols} FROM mandi_prices p JOIN ("
+               "  SELECT commodity, market, state, variety, MAX(price_date) AS d FROM mandi_prices"
+               "  WHERE commodity_key = ? GROUP BY commodity, market, state, variety"
+               ") m ON p.commodity = m.commodity AND p.market = m.market AND p.state = m.state"
+               " AND p.variety = m.variety AND p.price_date = m.d "
+               "WHERE p.commodity_key = ?")
+        key = self.synonyms.resolve(commodity)
+        args = [key, key]
+        if state:
+            sql += " AND p.state = ? COLLATE NOCASE"
+            args.append(state)
+        if market:
+            sql += " AND p.market = ? COLLATE NOCASE"
+            args.append(market)
+        sql += " ORDER BY p.price_date DESC, p.modal_price_per_kg LIMIT ?"
+        args.append(limit)
+        return self._query(sql, args)
+
+    def history(self, commodity, market=None, state=None, since=None, limit=365):
+        sql = f"SELECT {', '.join(self.COLUMNS)} FROM mandi_prices WHERE commodity_key = ?"
+        args = [self.synonyms.resolve(commodity)]
+        if market:
+            sql += " AND market = ? COLLATE NOCASE"
+            args.append(market)
+        if state:
+            sql += " AND state = ? COLLATE NOCASE"
+            args.append(state)
+        if since:
+            sql += " AND price_date >= ?"
+            args.append(since)
+        sql += " ORDER BY price_date DESC LIMIT ?"
+        args.append(limit)
+        return self._query(sql, args)
+
+    def compare(self, commodity, day=None, state=None):
+        """Prices across markets on one day (the latest day with data if `day` is omitted)."""
+        key = self.synonyms.resolve(commodity)
+        if not day:
+            row = self._query("SELECT MAX(price_date) AS d FROM mandi_prices WHERE commodity_key = ?", (key,))
+            day = row[0]["d"] if row else None
+        if not day:
+            return day, []
+        sql = f"SELECT {', '.join(self.COLUMNS)} FROM mandi_prices WHERE commodity_key = ? AND price_date = ?"
+        args = [key, day]
+        if state:
+            sql += " AND state = ? COLLATE NOCASE"
+            args.append(state)
+        sql += " ORDER BY modal_price_per_kg"
+        return day, self._query(sql, args)
+
+    def stats(self):
+        row = self._query("SELECT COUNT(*) AS n, COUNT(DISTINCT commodity_key) AS c, MAX(price_date) AS d "
+                          "FROM mandi_prices", ())[0]
+        return {"rows": row["n"], "commodities": row["c"], "latest_date": row["d"],
+                "last_ingest": self.last_ingest, "last_error": self.last_error,
+                "rows_ingested": self.rows_ingested}
@@ -0,0 +1,86 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+# configure the app before it is imported: no background jobs, throwaway databases,
+# a dummy Gemini key (every call is answered by a stub model) and no OpenAI fallback
+_tmp = tempfile.mkdtemp(prefix='agrobot-tests-')
+os.environ.update({
+    "GOOGLE_API_KEYS": "test-key",
+    "OPENAI_API_KEY": "",
+    "GEMINI_PREFIX_CACHE": "0",
+    "MSP_SYNC_INTERVAL": "0",
+    "MANDI_SYNC_INTERVAL": "0",
+    "CONVERSATION_DB": os.path.join(_tmp, "agrobot.db"),
+    "MSP_MIRROR_DB": os.path.join(_tmp, "msp.db"),
+    "MANDI_DB": os.path.join(_tmp, "mandi.db"),
+    "CROP_KNOWLEDGE_DB": os.path.join(_tmp, "crops.db"),
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+    def __iter__(self):
+        return iter([StubResponse(word + " ") for word in self.text.split()])
+
+
+class StubModel:
+    """Stands in for genai.GenerativeModel: counts calls, optionally slow or failing."""
+
+    def __init__(self, reply="Grow millets.", delay=0.0, error=None):
+        self.reply = reply
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return StubResponse(self.reply)
+
+    async def generate_content_async(self, prompt, **kwargs):
+        return self.generate_content(prompt)
+
+
+@pytest.fixture
+def app():
+    return app_module
+
+
+@pytest.fixture
+def use_admission(monkeypatch):
+    """use_admission(controller): admit the app's LLM calls through `controller` for this test."""
+    def use(admission):
+        monkeypatch.setattr(app_module, "LLM_ADMISSION", admission)
+        monkeypatch.setattr(app_module.LLM, "admission", admission)
+        return admission
+    return use
+
+
+@pytest.fixture
+def stub_model(monkeypatch, use_admission):
+    """Install a StubModel for every Gemini model name and reset the LLM singletons' state."""
+    model = StubModel()
+    monkeypatch.setattr(app_module, "model", model)
+    monkeypatch.setattr(app_module, "get_model", lambda name: model)
+    monkeypatch.setattr(app_module, "GEMINI_KEYS",
+                        app_module.GeminiKeyPool(["test-key"], app_module.GEMINI_QUOTAS, app_module.get_model))
+    use_admission(app_module.AdmissionController(16, 6000, 100, 64, 1.0))
+    for breaker in app_module.LLM.breakers.values():
+        monkeypatch.setattr(breaker, "state", breaker.CLOSED)
+        breaker._calls.clear()
+    app_module.ADVICE_CACHE.discard_if(lambda key: True)
+    return model
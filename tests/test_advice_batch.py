@@ -0,0 +1,20 @@
+import json
+
+
+def test_malformed_items_get_their_own_invalid_line(app, stub_model):
+    items = [
+        {"id": "ok", "soil_type": "Loam", "climate": "Tropical", "query": "Is drip irrigation worth it for bananas?"},
+        {"id": "lang", "query": "What should I sow?", "language": 5},
+        {"id": "soil", "query": "What should I sow?", "soil_type": ["Loam"]},
+        {"id": "query", "query": {"text": "hi"}},
+        "not an object",
+    ]
+    resp = app.app.test_client().post('/get_advice/batch', json={"items": items})
+
+    assert resp.status_code == 200
+    lines = {line["index"]: line for line in map(json.loads, resp.get_data(as_text=True).splitlines())}
+    assert lines[0]["status"] == "ok"
+    assert lines[1]["status"] == "invalid" and "language" in lines[1]["response"]
+    assert lines[2]["status"] == "invalid" and "soil_type" in lines[2]["response"]
+    assert lines[3]["status"] == "invalid" and lines[3]["response"] == "Each item needs a query"
+    assert lines[4]["status"] == "invalid" and lines[4]["id"] is None
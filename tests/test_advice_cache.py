@@ -0,0 +1,13 @@
+def test_empty_stream_is_not_cached(app, stub_model):
+    stub_model.reply = ""
+    client = app.app.test_client()
+    body = {"query": "Is this blocked?", "soil_type": "clay", "climate": "arid"}
+
+    client.post('/get_advice/stream', json=body).get_data()
+
+    messages = app.advice_messages(body)
+    assert app.ADVICE_CACHE.get(app.advice_cache_key("clay", "arid", "english", messages)) is None
+
+    stub_model.reply = "Grow sorghum."
+    text = client.post('/get_advice/stream', json=body).get_data(as_text=True)
+    assert "Grow sorghum." in text
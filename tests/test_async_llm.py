@@ -0,0 +1,61 @@
+import asyncio
+import threading
+
+import async_app
+
+
+def test_identical_async_requests_share_one_call_and_one_admission(app, stub_model, use_admission):
+    stub_model.delay = 0.2
+    admission = app.AdmissionController(4, 6000, 100, 64, 1.0)
+    use_admission(admission)
+    messages = [{"role": "user", "content": "Which crops suit black soil in a semi-arid climate? Explain why."}]
+
+    async def main():
+        return await asyncio.gather(*(app.agenerate_reply(messages, "english") for _ in range(10)))
+
+    assert asyncio.run(main()) == ["Grow millets."] * 10
+    assert stub_model.calls == 1
+    assert admission.admitted == 1
+    assert admission.stats()["active"] == 0
+
+
+def test_cancelled_async_admission_gives_the_slot_back(app):
+    admission = app.AdmissionController(1, 6000, 100, 4, 2.0)
+    admission.acquire()  # the only slot is busy
+    release_soon = threading.Timer(0.2, admission.release, args=(0.0,))
+
+    async def main():
+        waiter = asyncio.ensure_future(admission.acquire_async())
+        await asyncio.sleep(0.05)
+        waiter.cancel()
+        release_soon.start()  # the abandoned wait is granted the slot after the cancel
+        await asyncio.sleep(0.5)
+
+    asyncio.run(main())
+    assert admission.admitted == 2
+    assert admission.stats()["active"] == 0
+
+
+def test_async_market_lookup_sheds_overload_as_503(app, stub_model, monkeypatch):
+    from aiohttp.test_utils import TestClient, TestServer
+
+    replies = [app.Overloaded("LLM queue is full", 2, 503)]
+
+    async def call_gemini(*args, **kwargs):
+        if replies:
+            raise replies.pop()
+        return "Estimated price: 20 INR/kg"
+
+    async def no_records(session):
+        return []
+
+    monkeypatch.setattr(async_app, "async_call_gemini_chat", call_gemini)
+    monkeypatch.setattr(async_app, "async_fetch_msp_records", no_records)
+    monkeypatch.setattr(async_app, "start_background_jobs", lambda: None)
+
+    async def main():
+        async with TestClient(TestServer(async_app.create_async_app())) as client:
+            resp = await client.get('/market_online', params={"product": "quinoa"})
+            return resp.status, resp.headers.get("Retry-After")
+
+    assert asyncio.run(main()) == (503, "2")
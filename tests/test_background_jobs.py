@@ -0,0 +1,28 @@
+import threading
+
+
+def test_jobs_start_once_from_the_serving_process(app, monkeypatch):
+    runs = []
+    started = threading.Event()
+
+    def job():
+        runs.append(threading.current_thread().name)
+        started.set()
+
+    monkeypatch.setattr(app, "BACKGROUND_JOBS", {"test-job": job})
+    monkeypatch.setattr(app, "_jobs_started", False)
+    assert not any(t.name in ("msp-sync", "mandi-ingest") for t in threading.enumerate())
+
+    app.start_background_jobs()
+    app.start_background_jobs()
+    assert started.wait(1)
+    assert runs == ["test-job"]
+
+
+def test_testing_requests_do_not_start_jobs(app, monkeypatch):
+    monkeypatch.setattr(app, "BACKGROUND_JOBS", {"test-job": lambda: None})
+    monkeypatch.setattr(app, "_jobs_started", False)
+    monkeypatch.setattr(app.app, "testing", True)
+
+    app.app.test_client().get('/health')
+    assert app._jobs_started is False
@@ -0,0 +1,77 @@
+import pytest
+
+
+class FakeChat:
+    def __init__(self, history):
+        self.history = history
+        self.sent = []
+
+    def send_message(self, text, stream=False):
+        self.sent.append(text)
+        return type("Reply", (), {"text": f"re: {text}"})()
+
+
+@pytest.fixture
+def chats(app, stub_model, monkeypatch):
+    """Every ChatSession the pool starts, in order."""
+    started = []
+
+    class FakeModel:
+        def __init__(self, instruction):
+            self.instruction = instruction
+
+        def start_chat(self, history):
+            started.append(FakeChat(history))
+            return started[-1]
+
+    monkeypatch.setattr(app, "session_model", FakeModel)
+    return started
+
+
+def turn(text):
+    return [{"role": "user", "content": text}]
+
+
+def test_least_recently_used_session_is_evicted(app, chats):
+    pool = app.ChatSessionPool(2, 10 ** 6, 3600)
+    pool.reply("a", turn("first a"))
+    pool.reply("b", turn("first b"))
+    pool.reply("a", turn("first a") + [{"role": "assistant", "content": "re: first a"}] + turn("second a"))
+    pool.reply("c", turn("first c"))
+
+    assert list(pool._entries) == ["a", "c"]
+    assert pool.stats()["evicted"] == 1
+    assert pool.counters["reused"] == 1
+
+
+def test_byte_budget_evicts_older_sessions(app, chats):
+    pool = app.ChatSessionPool(10, 6000, 3600)
+    pool.reply("a", turn("x" * 2000))
+    pool.reply("b", turn("y" * 2000))  # the system prompt plus both turns no longer fit
+
+    stats = pool.stats()
+    assert list(pool._entries) == ["b"]
+    assert stats["evicted"] == 1 and stats["bytes"] <= 6000
+
+
+def test_session_is_rebuilt_when_the_history_diverges(app, chats):
+    pool = app.ChatSessionPool(10, 10 ** 6, 3600)
+    history = turn("What should I grow?")
+    _, stats = pool.reply("a", history)
+    assert stats["session"] == "created"
+
+    history += [{"role": "assistant", "content": "re: What should I grow?"}] + turn("And water?")
+    _, stats = pool.reply("a", history)
+    assert stats["session"] == "reused" and len(chats) == 1
+
+    # another worker answered two turns this session never saw: start over from the store
+    history += [{"role": "assistant", "content": "Drip."}] + turn("Fertiliser?") + \
+        [{"role": "assistant", "content": "Compost."}] + turn("Pests?")
+    _, stats = pool.reply("a", history)
+    assert stats["session"] == "rebuilt" and len(chats) == 2
+    assert [h["parts"][0] for h in chats[1].history][-2:] == ["Fertiliser?", "Compost."]
+    assert chats[1].sent == ["Pests?"]
+
+    # a changed soil/climate context also rebuilds
+    _, stats = pool.reply("a", [{"role": "system", "content": "Soil: Clay"}] + history)
+    assert stats["session"] == "rebuilt" and len(chats) == 3
@@ -0,0 +1,94 @@
+import pytest
+
+
+def make_breaker(app, name, slow_seconds=8.0):
+    app.CIRCUIT_BREAKERS.pop(name, None)
+    breaker = app.CircuitBreaker(name, slow_seconds, window=60, min_calls=2, failure_rate=0.5, open_seconds=30)
+    app.CIRCUIT_BREAKERS.pop(name, None)
+    return breaker
+
+
+def test_failures_open_then_one_probe_closes(app, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: now[0])
+    breaker = make_breaker(app, "test upstream")
+
+    breaker.record(False, 0.1)
+    assert breaker.state == breaker.CLOSED  # below min_calls
+    breaker.record(False, 0.1)
+    assert breaker.state == breaker.OPEN
+    with pytest.raises(app.CircuitOpen):
+        breaker.check()
+    assert breaker.short_circuited == 1
+
+    now[0] += 31  # past open_seconds: one probe is let through, a second caller is not
+    assert breaker.allow() is True
+    assert breaker.state == breaker.HALF_OPEN
+    assert breaker.allow() is False
+    breaker.record(True, 0.1)
+    assert breaker.state == breaker.CLOSED
+
+
+def test_failed_probe_reopens(app, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: now[0])
+    breaker = make_breaker(app, "test upstream")
+    for _ in range(2):
+        breaker.record(False, 0.1)
+    now[0] += 31
+    assert breaker.allow()
+
+    breaker.record(True, 9.0)  # a slow success counts as a failure
+    assert breaker.state == breaker.OPEN
+    assert breaker.opens == 2
+
+
+def test_guard_does_not_count_local_shedding(app):
+    breaker = make_breaker(app, "test upstream")
+    for _ in range(3):
+        with pytest.raises(app.Overloaded):
+            with breaker.guard():
+                raise app.Overloaded("busy", 1)
+    assert breaker.stats()["window_calls"] == 0
+
+
+def test_llm_calls_are_slow_only_past_their_route_budget(app, stub_model, monkeypatch):
+    # a 45 s chat answer is within the 60 s chat budget and must not open the breaker
+    pool = app.LLM
+    provider = pool.providers[0]
+    for _ in range(5):
+        pool._record(provider, "chat", 45.0, True)
+    assert pool.breakers[provider.name].state == app.CircuitBreaker.CLOSED
+
+    for _ in range(5):
+        pool._record(provider, "chat_short", 45.0, True)
+    assert pool.breakers[provider.name].state == app.CircuitBreaker.OPEN
+
+
+def test_background_jobs_do_not_trip_the_search_breaker(app, monkeypatch):
+    class SlowResponse:
+        status_code = 200
+
+        def json(self):
+            return {"records": []}
+
+    clock = iter(range(0, 10000, 20))  # the clock moves 20 s per reading, so every fetch is "slow"
+    monkeypatch.setattr(app.time, "monotonic", lambda: float(next(clock)))
+    monkeypatch.setattr(app.UPSTREAM, "get", lambda url, params=None, deadline=None: SlowResponse())
+    search = make_breaker(app, "test data.gov.in")
+    sync = make_breaker(app, "test data.gov.in sync", slow_seconds=60.0)
+    monkeypatch.setattr(app, "DATA_GOV_BREAKER", search)
+
+    for page in range(5):
+        app.fetch_json("https://example.invalid/resource", {"offset": page}, breaker=sync)
+
+    assert search.stats()["window_calls"] == 0
+    assert sync.state == app.CircuitBreaker.CLOSED
+
+
+@pytest.fixture(autouse=True)
+def reset_llm_breakers(app):
+    yield
+    for breaker in app.LLM.breakers.values():
+        breaker.state = breaker.CLOSED
+        breaker._calls.clear()
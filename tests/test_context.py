@@ -0,0 +1,31 @@
+def _long_history(n, words=120):
+    turns = []
+    for i in range(n):
+        turns.append({"role": "user" if i % 2 == 0 else "assistant", "content": f"turn {i} " + "soil " * words})
+    return turns
+
+
+def test_failed_summary_is_not_counted_as_reused(app, stub_model, monkeypatch):
+    monkeypatch.setattr(app, "CONTEXT_TOKEN_BUDGET", 800)
+    stub_model.error = RuntimeError("summary model down")
+    before = dict(app.CONTEXT_STATS)
+
+    prompt, stats = app.fit_context(_long_history(24), "english", thread_key="failed-summary")
+
+    assert not stats["summary_regenerated"]
+    assert app.CONTEXT_STATS["summary_failures"] == before["summary_failures"] + 1
+    assert app.CONTEXT_STATS["summaries_reused"] == before["summaries_reused"]
+    assert not any(m.get("summary") for m in prompt)
+
+
+def test_recent_turns_are_kept_verbatim_even_past_the_budget(app, stub_model, monkeypatch):
+    monkeypatch.setattr(app, "CONTEXT_TOKEN_BUDGET", 800)
+    monkeypatch.setattr(app, "CONTEXT_KEEP_TURNS", 4)
+    stub_model.reply = "Earlier: soil questions."
+    history = _long_history(24, words=300)  # each turn alone is close to the whole budget
+
+    prompt, stats = app.fit_context(history, "english", thread_key="keep-turns")
+
+    assert prompt[-4:] == history[-4:]
+    assert stats["turns_summarized"] == 20
+    assert stats["tokens_in"] > 800
@@ -0,0 +1,54 @@
+def test_bad_seed_is_a_400_and_writes_nothing(app, stub_model):
+    before = app.CONVERSATIONS._db.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+    body = {"message": "And for the next season?", "soil_type": "Loam", "climate": "Tropical",
+            "messages": [{"role": "user", "content": "What should I grow?"}, {"role": "assistant", "content": None}]}
+    resp = app.app.test_client().post('/get_advice', json=body)
+
+    assert resp.status_code == 400
+    assert "messages[1]" in resp.get_json()["error"]
+    assert app.CONVERSATIONS._db.execute("SELECT COUNT(*) FROM conversations").fetchone()[0] == before
+
+
+def test_seed_is_stored_with_the_new_conversation(app, stub_model):
+    body = {"message": "And for the next season?", "soil_type": "Loam", "climate": "Tropical",
+            "messages": [{"role": "user", "content": "What should I grow?"}, {"role": "assistant", "content": "Rice."}]}
+    resp = app.app.test_client().post('/get_advice', json=body)
+
+    assert resp.status_code == 200
+    stored = app.CONVERSATIONS.messages(resp.get_json()["conversation_id"])
+    assert [m["role"] for m in stored] == ["system", "user", "assistant", "user", "assistant"]
+    assert stored[-2]["content"] == "And for the next season?"
+
+
+def test_shed_request_leaves_no_turn_and_the_retry_stores_it_once(app, stub_model, use_admission):
+    client = app.app.test_client()
+    conv_id = client.post('/get_advice', json={"message": "What should I grow?", "soil_type": "Loam",
+                                               "climate": "Tropical"}).get_json()["conversation_id"]
+    before = app.CONVERSATIONS.messages(conv_id)
+    admission = app.AdmissionController(1, 6000, 100, 0, 1.0)
+    admission.acquire()  # the only slot is busy and nothing may queue: the next call is a 503
+    use_admission(admission)
+
+    body = {"message": "And for the next season?", "conversation_id": conv_id}
+    resp = client.post('/get_advice', json=body)
+    assert resp.status_code == 503
+    assert app.CONVERSATIONS.messages(conv_id) == before
+
+    admission.release(0.0)
+    resp = client.post('/get_advice', json=body)
+    assert resp.status_code == 200
+    stored = app.CONVERSATIONS.messages(conv_id)
+    assert [m["content"] for m in stored].count("And for the next season?") == 1
+    assert stored[len(before):] == [{"role": "user", "content": "And for the next season?"},
+                                    {"role": "assistant", "content": "Grow millets."}]
+
+
+def test_shed_stream_request_leaves_no_new_conversation(app, stub_model, use_admission):
+    admission = app.AdmissionController(1, 6000, 100, 0, 1.0)
+    admission.acquire()
+    use_admission(admission)
+    before = app.CONVERSATIONS._db.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+    resp = app.app.test_client().post('/get_advice/stream', json={"message": "Which fertiliser for maize?"})
+    assert resp.status_code == 503
+    assert app.CONVERSATIONS._db.execute("SELECT COUNT(*) FROM conversations").fetchone()[0] == before
@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+INFO = {"desc": "A rabi cereal.", "benefits": "Fibre.", "calories": 3.4}
+
+
+@pytest.fixture
+def clock(app, monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(app.time, "time", lambda: now[0])
+    return now
+
+
+def test_enrichments_expire_after_the_ttl_but_static_entries_do_not(app, clock, tmp_path):
+    path = str(tmp_path / "crops.db")
+    store = app.CropKnowledgeStore(path, 60, app.CROP_SYNONYMS, seed={"Tomato": {"desc": "A fruit."}})
+    store.put("Wheat", INFO)
+
+    clock[0] += 59
+    assert store.get("gehun") == INFO  # stored under the canonical id
+    clock[0] += 2
+    assert store.get("wheat") is None
+    assert store.get("tomato") == {"desc": "A fruit."}
+    assert store.stats()["fresh"] == 1
+
+    # the expiry survives a restart: it is judged from the stored write time
+    reopened = app.CropKnowledgeStore(path, 60, app.CROP_SYNONYMS, seed={"Tomato": {"desc": "changed"}})
+    assert reopened.get("wheat") is None
+    assert reopened.get("tomato") == {"desc": "A fruit."}  # seeds only fill in missing crops
+    reopened.put("wheat", INFO)
+    assert reopened.get("wheat") == INFO
+
+
+def test_prewarm_enriches_only_unknown_crops(app, stub_model, tmp_path, monkeypatch):
+    mirror = app.MspMirror(str(tmp_path / "msp.db"), app.msp_sync_pages)
+    mirror._index([{"rabi_crop_wise": name} for name in ("Wheat", "Barley", "Lentil (Masur)")])
+    knowledge = app.CropKnowledgeStore(str(tmp_path / "crops.db"), 3600, app.CROP_SYNONYMS)
+    knowledge.put("wheat", INFO)
+    monkeypatch.setattr(app, "MSP_MIRROR", mirror)
+    monkeypatch.setattr(app, "CROP_KNOWLEDGE", knowledge)
+    stub_model.reply = json.dumps({"desc": "A pulse.", "benefits": "Protein.", "calories_per_g": 3.5})
+    runner = app.app.test_cli_runner()
+
+    result = runner.invoke(args=["prewarm-crops"])
+    assert "3 crops: 1 already known, 2 enriched, 0 failed" in result.output
+    assert stub_model.calls == 2
+    assert knowledge.get("barley")["desc"] == "A pulse."
+
+    result = runner.invoke(args=["prewarm-crops"])
+    assert "3 crops: 3 already known, 0 enriched, 0 failed" in result.output
+    assert stub_model.calls == 2
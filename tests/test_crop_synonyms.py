@@ -0,0 +1,26 @@
+def test_regional_names_resolve_to_the_canonical_id(app):
+    synonyms = app.CropSynonyms(app.CROP_SYNONYMS_FILE)
+    assert synonyms.canonical("gehun") == "wheat"
+    assert synonyms.canonical("Gehun ") == "wheat"
+    assert synonyms.canonical("Wheat(Atta)") == "wheat"
+    assert synonyms.canonical("no such crop") is None
+    assert synonyms.resolve("No Such  Crop") == "no such crop"
+
+
+def test_only_user_queries_count_towards_the_resolve_rate(app, monkeypatch):
+    synonyms = app.CropSynonyms(app.CROP_SYNONYMS_FILE)
+    monkeypatch.setattr(app, "CROP_SYNONYMS", synonyms)
+
+    # internal keying (store rows, cache keys) and autocomplete keystrokes are not counted
+    app.crop_key("Wheat")
+    rows = app.normalize_mandi_batch([{"state": "Haryana", "district": "Karnal", "market": "Karnal",
+                                       "commodity": "Wheat", "variety": "Other", "arrival_date": "01/10/2026",
+                                       "min_price": "2400", "max_price": "2600", "modal_price": "2500"}])
+    assert rows[0][0] == "wheat"
+    app.app.test_client().get('/market/suggest', query_string={"q": "gehun"})
+    assert synonyms.stats()["lookups"] == 0
+
+    assert app.query_crop_key("gehun") == "wheat"
+    assert app.query_crop_key("quinoa") == "quinoa"
+    stats = synonyms.stats()
+    assert (stats["lookups"], stats["resolved"], stats["resolve_rate"]) == (2, 1, 0.5)
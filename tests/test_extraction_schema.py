@@ -0,0 +1,64 @@
+import pytest
+
+# one record of the Agmarknet daily price resource, as data.gov.in returns it
+AGMARKNET_RECORD = {
+    "state": "Tamil Nadu", "district": "Coimbatore", "market": "Pollachi", "commodity": "Coconut",
+    "variety": "Coconut", "grade": "FAQ", "arrival_date": "01/10/2026",
+    "min_price": "2400", "max_price": "2600", "modal_price": "2500",
+}
+
+
+@pytest.fixture
+def schemas(app, monkeypatch):
+    cache = {}
+    monkeypatch.setattr(app, "_schemas", cache)
+    return cache
+
+
+def test_agmarknet_columns_and_quintal_prices_are_inferred(app):
+    schema = app.ExtractionSchema.infer("agmarknet", [AGMARKNET_RECORD])
+
+    assert schema.columns["modal"] == "modal_price" and schema.columns["date"] == "arrival_date"
+    assert schema.columns["unit"] is None
+    assert schema.default_divisor == 100.0  # unit-less prices in the thousands are per quintal
+    [row] = schema.extract([AGMARKNET_RECORD])
+    assert (row["modal_per_kg"], row["min_per_kg"], row["max_per_kg"]) == (25.0, 24.0, 26.0)
+    assert (row["market"], row["commodity"], row["date"]) == ("Pollachi", "Coconut", "01/10/2026")
+
+
+def test_other_spellings_and_an_explicit_unit_column(app):
+    records = [
+        {"Market Name": "Koyambedu", "Modal Price": "", "Price Unit": "Rs/Quintal"},  # sparse first record
+        {"Market Name": "Koyambedu", "Modal Price": "3,200", "Price Unit": "Rs/Quintal"},
+        {"Market Name": "Madurai", "Modal Price": "Rs. 34", "Price Unit": "Rs/Kg"},
+        {"Market Name": "Salem", "Modal Price": "31000", "Price Unit": "Rs/Tonne"},
+    ]
+    schema = app.ExtractionSchema.infer("other", records)
+
+    assert schema.columns["modal"] == "Modal Price" and schema.columns["unit"] == "Price Unit"
+    assert schema.columns["market"] == "Market Name"
+    assert [r["price_per_kg"] for r in schema.extract(records)] == [32.0, 34.0, 31.0]
+
+
+def test_small_unit_less_prices_are_per_kg(app):
+    schema = app.ExtractionSchema.infer("retail", [{"market": "Ooty", "modal_price": p} for p in ("40", "42", "38")])
+    assert schema.default_divisor == 1.0
+    assert schema.extract([{"modal_price": "40"}])[0]["price_per_kg"] == 40.0
+
+
+def test_schema_is_cached_per_resource_until_the_payload_changes(app, schemas, monkeypatch):
+    inferred = []
+    infer = app.ExtractionSchema.infer.__func__
+    monkeypatch.setattr(app.ExtractionSchema, "infer",
+                        classmethod(lambda cls, rid, recs: inferred.append(rid) or infer(cls, rid, recs)))
+
+    first = app.schema_for("agmarknet", [AGMARKNET_RECORD])
+    assert app.schema_for("agmarknet", [dict(AGMARKNET_RECORD, modal_price="2700")]) is first
+    assert app.schema_for("other", [AGMARKNET_RECORD]) is not first
+    assert inferred == ["agmarknet", "other"]
+
+    # the resource renamed its price column: the cached mapping no longer fits
+    renamed = {"market": "Pollachi", "Modal Price": "2500"}
+    assert app.schema_for("agmarknet", [renamed]).columns["modal"] == "Modal Price"
+    assert inferred == ["agmarknet", "other", "agmarknet"]
+    assert set(schemas) == {"agmarknet", "other"}
@@ -0,0 +1,101 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import resilience
+
+
+def key_pool(app, api_keys):
+    return app.GeminiKeyPool(api_keys, app.GEMINI_QUOTAS, app.get_model)
+
+
+def test_throttled_key_backs_off_and_the_call_moves_on(app):
+    pool = key_pool(app, ["a", "b"])
+    sent = []
+
+    def send(key):
+        sent.append(key.label)
+        if key.label == "key1":
+            raise app.google_exceptions.ResourceExhausted("quota")
+        return "ok"
+
+    assert pool.call(app.GEMINI_MODEL_NAME, 100, send) == "ok"
+    assert sorted(sent) == ["key1", "key2"]
+    key1 = pool.keys[0]
+    assert key1.throttled == 1 and key1.backoff_until > 0
+    # while key1 is backed off every call goes to key2
+    sent.clear()
+    pool.call(app.GEMINI_MODEL_NAME, 100, send)
+    assert sent == ["key2"]
+
+
+def test_exhausted_pool_is_a_429_with_retry_after(app, monkeypatch):
+    monkeypatch.setitem(app.GEMINI_QUOTAS, app.GEMINI_MODEL_NAME, (2, 1_000_000))
+    pool = key_pool(app, ["a"])
+    for _ in range(2):
+        pool.call(app.GEMINI_MODEL_NAME, 100, lambda key: "ok")
+
+    with pytest.raises(app.Overloaded) as info:
+        pool.call(app.GEMINI_MODEL_NAME, 100, lambda key: "ok")
+    assert info.value.status == 429
+    assert 0 < info.value.retry_after <= resilience.QUOTA_WINDOW
+    assert pool.rejected == 1
+
+
+def test_every_key_throttled_raises_the_upstream_error(app):
+    pool = key_pool(app, ["a", "b"])
+
+    def send(key):
+        raise app.google_exceptions.ResourceExhausted("quota")
+
+    with pytest.raises(app.google_exceptions.ResourceExhausted):
+        pool.call(app.GEMINI_MODEL_NAME, 100, send)
+    assert all(k.in_flight == 0 for k in pool.keys)
+
+
+def test_empty_pool_says_the_key_is_missing(app):
+    pool = key_pool(app, [])
+    with pytest.raises(RuntimeError, match="API key missing"):
+        pool.call(app.GEMINI_MODEL_NAME, 100, lambda key: "ok")
+    with pytest.raises(RuntimeError, match="API key missing"):
+        list(pool.stream(app.GEMINI_MODEL_NAME, 100, lambda key: iter(["ok"])))
+
+
+def test_reserve_counts_default_client_calls_against_the_first_key(app, monkeypatch):
+    monkeypatch.setitem(app.GEMINI_QUOTAS, app.GEMINI_MODEL_NAME, (1, 1_000_000))
+    pool = key_pool(app, ["a", "b"])
+    with pool.reserve(app.GEMINI_MODEL_NAME, 100, primary_only=True) as key:
+        assert key.primary
+    assert pool.keys[0].stats(app.time.monotonic())["last_minute"][app.GEMINI_MODEL_NAME]["requests"] == 1
+
+    # the first key is out of quota: default-client calls are refused, pooled calls are not
+    with pytest.raises(app.Overloaded):
+        with pool.reserve(app.GEMINI_MODEL_NAME, 100, primary_only=True):
+            pass
+    assert pool.call(app.GEMINI_MODEL_NAME, 100, lambda key: key.label) == "key2"
+
+
+def test_sdk_internals_behind_per_key_clients_are_unchanged(app):
+    # GeminiKey.model reaches into google-generativeai; an upgrade must fail here, not in production
+    assert app.genai.__version__ == resilience.GENAI_TESTED_VERSION
+    key = resilience.GeminiKey("key-2", "second-project-key", app.GEMINI_QUOTAS)
+
+    # a Flask worker thread has no event loop: it gets the sync client only
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        model = pool.submit(key.model, app.GEMINI_FAST_MODEL_NAME).result()
+    assert model._client is key._client and model._async_client is None
+    assert model._client.transport._credentials.token == "second-project-key"
+
+    async def from_a_coroutine():
+        return key.model(app.GEMINI_FAST_MODEL_NAME)
+
+    assert asyncio.run(from_a_coroutine()) is model
+    assert model._async_client is key._async_client
+    assert model._async_client.transport._credentials.token == "second-project-key"
+
+
+def test_changed_sdk_internals_fail_loudly(app, monkeypatch):
+    monkeypatch.delattr(resilience.genai_client, "_ClientManager")
+    with pytest.raises(RuntimeError, match="tested with"):
+        resilience.GeminiKey("key-2", "second-project-key", app.GEMINI_QUOTAS).model(app.GEMINI_FAST_MODEL_NAME)
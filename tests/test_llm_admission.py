@@ -0,0 +1,52 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def test_identical_concurrent_requests_take_one_admission(app, stub_model, use_admission):
+    stub_model.delay = 0.3
+    admission = app.AdmissionController(4, 6000, 100, 64, 1.0)
+    use_admission(admission)
+    messages = [{"role": "user", "content": "Which crops suit loam soil in a tropical climate? Explain why."}]
+    start = threading.Barrier(10)
+
+    def ask(_):
+        start.wait()
+        return app.generate_reply(messages, "english")
+
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        answers = list(pool.map(ask, range(10)))
+
+    assert answers == ["Grow millets."] * 10
+    assert stub_model.calls == 1
+    assert admission.admitted == 1
+    assert sum(admission.rejected.values()) == 0
+
+
+def test_nested_llm_call_reuses_the_callers_slot(app, stub_model, use_admission):
+    # e.g. a session-mode request summarizing its history while it holds the only slot
+    admission = app.AdmissionController(1, 6000, 100, 64, 0.2)
+    use_admission(admission)
+    with admission.admit():
+        answer = app.generate_reply([{"role": "user", "content": "Summarize this conversation."}], route="summary")
+
+    assert answer == "Grow millets."
+    assert admission.admitted == 1
+    assert sum(admission.rejected.values()) == 0
+    assert admission.stats()["active"] == 0
+
+
+def test_stream_overload_is_a_real_status_with_retry_after(app, stub_model, use_admission):
+    admission = app.AdmissionController(1, 6000, 100, 0, 0.1)
+    use_admission(admission)
+    client = app.app.test_client()
+    body = {"query": "How do I plan irrigation for wheat this season?", "soil_type": "loam", "climate": "tropical"}
+
+    with admission.admit():
+        busy = client.post('/get_advice/stream', json=body)
+    assert busy.status_code == 503
+    assert busy.headers["Retry-After"]
+
+    ok = client.post('/get_advice/stream', json=body)
+    assert ok.status_code == 200
+    assert 'event: done' in ok.get_data(as_text=True)
+    assert admission.stats()["active"] == 0
@@ -0,0 +1,65 @@
+import sqlite3
+
+
+def row(app, commodity, market="Karnal", day="2026-10-01", modal=22.0):
+    return (app.crop_key(commodity), commodity, "Haryana", "Karnal", market, "Other", day, None, None, modal)
+
+
+def test_commodities_sharing_an_id_keep_their_own_rows(app, tmp_path):
+    store = app.MandiPriceStore(str(tmp_path / "mandi.db"), app.CROP_SYNONYMS, app.mandi_pages)
+    store.write([row(app, "Paddy(Dhan)(Common)", modal=22.0), row(app, "Paddy (Grade A)", modal=23.5)])
+    store.write([row(app, "Paddy(Dhan)(Common)", modal=22.4)])  # same day re-ingested: replaces its own row
+
+    latest = {r["commodity"]: r["modal_price_per_kg"] for r in store.latest("dhan")}
+    assert latest == {"Paddy(Dhan)(Common)": 22.4, "Paddy (Grade A)": 23.5}
+    assert store.stats()["rows"] == 2
+
+
+def test_differently_priced_commodities_no_longer_share_an_id(app):
+    assert app.crop_key("Paddy(Dhan)(Common)") != app.crop_key("Rice")
+    assert app.crop_key("Green Chilli") != app.crop_key("Dry Chillies")
+    assert app.crop_key("Banana - Green") != app.crop_key("Banana")
+    assert app.crop_key("chawal") == app.crop_key("Rice")
+
+
+def test_old_commodity_key_table_is_rekeyed(app, tmp_path):
+    path = str(tmp_path / "old.db")
+    db = sqlite3.connect(path)
+    db.executescript("""
+        CREATE TABLE mandi_prices (
+            commodity_key TEXT NOT NULL, commodity TEXT NOT NULL, state TEXT NOT NULL, district TEXT NOT NULL,
+            market TEXT NOT NULL, variety TEXT NOT NULL, price_date TEXT NOT NULL, min_price_per_kg REAL,
+            max_price_per_kg REAL, modal_price_per_kg REAL NOT NULL,
+            PRIMARY KEY (commodity_key, market, state, variety, price_date)
+        ) WITHOUT ROWID;
+        CREATE INDEX idx_mandi_commodity_date ON mandi_prices(commodity_key, price_date);
+        INSERT INTO mandi_prices VALUES ('rice', 'Paddy(Dhan)(Common)', 'Haryana', 'Karnal', 'Karnal', 'Other',
+                                         '2026-10-01', NULL, NULL, 22.0);
+    """)
+    db.close()
+
+    store = app.MandiPriceStore(path, app.CROP_SYNONYMS, app.mandi_pages)
+    assert [r["commodity"] for r in store.history("paddy")] == ["Paddy(Dhan)(Common)"]
+    store.write([row(app, "Paddy (Grade A)")])
+    assert store.stats()["rows"] == 2
+    pk = [r[1] for r in sorted(store._db.execute("PRAGMA table_info(mandi_prices)"), key=lambda r: r[5]) if r[5]]
+    assert pk[0] == "commodity"
+
+
+def test_negative_limit_is_not_unlimited(app):
+    app.MANDI_STORE.write([row(app, "Onion", day=f"2026-09-{d:02d}") for d in range(1, 11)])
+    resp = app.app.test_client().get('/market/prices/history', query_string={"commodity": "onion", "limit": -1})
+
+    assert resp.status_code == 200
+    assert len(resp.get_json()["results"]) == 1
+
+
+def test_commodities_lists_one_stable_name_per_id(app, tmp_path):
+    store = app.MandiPriceStore(str(tmp_path / "mandi.db"), app.CROP_SYNONYMS, app.mandi_pages)
+    store.write([row(app, "Wheat(Atta)"), row(app, "Wheat", market="Panipat"), row(app, "kodo millet"),
+                 row(app, "Kodo Millet", market="Panipat")])
+
+    names = store.commodities()
+    assert app.CROP_SYNONYMS.name("wheat") in names
+    assert "Kodo Millet" in names and "kodo millet" not in names  # no synonym entry: the first raw spelling
+    assert len(names) == 2
@@ -0,0 +1,56 @@
+import json
+import time
+
+import pytest
+
+
+@pytest.fixture
+def lookups(app, monkeypatch):
+    """Per-crop market_result behaviour: a delay, an exception, or a plain payload."""
+    behaviour = {
+        "wheat": lambda: time.sleep(0.3) or {"price": 25.85},
+        "barley": lambda: {"price": 21.5},
+        "gram": lambda: (_ for _ in ()).throw(RuntimeError("bad record")),
+        "lentil": lambda: (_ for _ in ()).throw(app.Overloaded("LLM queue is full", 3, 503)),
+    }
+    monkeypatch.setattr(app, "fetch_msp_records", lambda: [])
+    monkeypatch.setattr(app, "lookup_msp", lambda crop, records=None: {"rabi_crop_wise": crop})
+    monkeypatch.setattr(app, "market_result", lambda crop, match: behaviour[crop]())
+    monkeypatch.setattr(app, "market_fallback", lambda crop: {"error": "fallback"})
+    monkeypatch.setattr(app, "MSP_MISS_CACHE", app.ResponseCache(maxsize=16, ttl=60))
+    return behaviour
+
+
+def test_items_fail_on_their_own_and_come_back_in_request_order(app, lookups):
+    products = ["Wheat", "barley", "gehun", "gram", "lentil"]
+    resp = app.app.test_client().post('/market_online/batch', json={"products": products})
+
+    assert resp.status_code == 200
+    items = resp.get_json()["items"]
+    assert [i["product"] for i in items] == ["wheat", "barley", "gram", "lentil"]  # "gehun" is wheat
+    assert items[0]["price"] == 25.85 and items[1]["price"] == 21.5
+    assert items[2]["error"] == "fallback"
+    assert items[3]["retry_after"] == 3 and items[3]["error"].startswith("Server busy")
+
+
+def test_ndjson_streams_items_as_they_complete(app, lookups):
+    resp = app.app.test_client().post('/market_online/batch', json={"products": ["wheat", "barley", "gram"]},
+                                      headers={"Accept": "application/x-ndjson"})
+
+    assert resp.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    assert sorted(line["product"] for line in lines) == ["barley", "gram", "wheat"]
+    assert lines[-1]["product"] == "wheat"  # the slow lookup does not hold back the others
+
+
+def test_batch_size_is_limited(app, lookups, monkeypatch):
+    monkeypatch.setattr(app, "MARKET_BATCH_MAX", 2)
+    client = app.app.test_client()
+
+    resp = client.post('/market_online/batch', json={"products": ["wheat", "barley", "gram"]})
+    assert resp.status_code == 400 and "At most 2" in resp.get_json()["error"]
+    # duplicates and synonyms count once
+    resp = client.post('/market_online/batch', json={"products": ["wheat", "gehun", "Wheat ", "barley"]})
+    assert resp.status_code == 200 and len(resp.get_json()["items"]) == 2
+    for body in ({"products": []}, {"products": "wheat"}, {"products": ["  "]}):
+        assert client.post('/market_online/batch', json=body).status_code == 400
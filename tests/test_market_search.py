@@ -0,0 +1,21 @@
+def test_suggest_limit_is_clamped(app):
+    client = app.app.test_client()
+    for limit, most in ((-5, 1), (0, 8), (1000, 20)):
+        resp = client.get('/market/suggest', query_string={"q": "wh", "limit": limit})
+        assert resp.status_code == 200
+        assert 1 <= len(resp.get_json()["suggestions"]) <= most
+
+
+def test_misspelling_is_suggested_but_not_priced(app, tmp_path, monkeypatch):
+    index = app.CropSearchIndex()
+    index.rebuild(["Wheat", "Barley", "Gram", "Wheat Flour"])
+    hits = index.search("wheet")
+    assert hits[0]["name"] == "wheat" and hits[0]["match"] == "fuzzy"
+
+    mirror = app.MspMirror(str(tmp_path / "msp.db"), app.msp_sync_pages)
+    mirror._index([{"rabi_crop_wise": "Wheat", "_2025_26___msp": "2585"},
+                   {"rabi_crop_wise": "Barley", "_2025_26___msp": "2150"}])
+    monkeypatch.setattr(app, "MSP_MIRROR", mirror)
+    # a near miss could be another crop's MSP: only exact or synonym-canonical keys are priced
+    assert app.lookup_msp("wheet") is None
+    assert app.lookup_msp(app.crop_key("gehun"))["rabi_crop_wise"] == "Wheat"
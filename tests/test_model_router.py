@@ -0,0 +1,59 @@
+def _router(app):
+    return app.ModelRouter(app.MODEL_ROUTES, app.LATENCY_BUDGETS, app.GEMINI_MODEL_NAME,
+                           app.GEMINI_FAST_MODEL_NAME, 25.0, min_samples=20)
+
+
+def test_slow_pro_falls_back_then_probes(app, monkeypatch):
+    monkeypatch.setattr(app, "PRO_PROBE_SECONDS", 3600)
+    router = _router(app)
+    for _ in range(30):
+        router.window(app.GEMINI_MODEL_NAME).add(40.0)
+
+    picks = [router.pick("chat")[0] for _ in range(5)]
+
+    assert picks[0] == app.GEMINI_MODEL_NAME  # the probe
+    assert picks[1:] == [app.GEMINI_FAST_MODEL_NAME] * 4
+
+
+def test_pro_recovers_once_probes_are_fast(app, monkeypatch):
+    monkeypatch.setattr(app, "PRO_PROBE_SECONDS", 0)
+    router = _router(app)
+    pro = router.window(app.GEMINI_MODEL_NAME)
+    for _ in range(30):
+        pro.add(40.0)
+    assert router.p95(app.GEMINI_MODEL_NAME) == 40.0
+
+    # every pick is a probe here; each probe answers quickly
+    for _ in range(200):
+        name, _ = router.pick("chat")
+        router.window(name).add(2.0)
+
+    assert router.p95(app.GEMINI_MODEL_NAME) == 2.0
+    monkeypatch.setattr(app, "PRO_PROBE_SECONDS", 3600)
+    assert router.pick("chat")[0] == app.GEMINI_MODEL_NAME
+
+
+def test_old_samples_expire(app, monkeypatch):
+    router = _router(app)
+    pro = router.window(app.GEMINI_MODEL_NAME)
+    for _ in range(30):
+        pro.add(40.0)
+    now = app.time.monotonic()
+    monkeypatch.setattr(app.time, "monotonic", lambda: now + app.PRO_LATENCY_MAX_AGE + 1)
+
+    assert router.p95(app.GEMINI_MODEL_NAME) == 0.0
+    assert router.pick("chat")[0] == app.GEMINI_MODEL_NAME
+
+
+def test_matrix_route_is_pinned_to_its_model(app, monkeypatch):
+    monkeypatch.setattr(app, "PRO_PROBE_SECONDS", 3600)
+    router = app.ModelRouter(app.MODEL_ROUTES, app.LATENCY_BUDGETS, app.GEMINI_MODEL_NAME,
+                             app.GEMINI_FAST_MODEL_NAME, 25.0, min_samples=20, pinned=app.PINNED_ROUTES)
+    for _ in range(30):
+        router.window(app.GEMINI_MODEL_NAME).add(40.0)
+    router.pick("chat")  # use up the probe
+    prompt = app.matrix_prompt("Loam", "Tropical")  # short question: plain chat would be chat_short
+
+    assert router.classify("chat", prompt) == "chat_short"
+    assert [router.pick("matrix", prompt)[0] for _ in range(3)] == [app.MODEL_ROUTES["matrix"]] * 3
+    assert router.pick("chat")[0] == app.GEMINI_FAST_MODEL_NAME
@@ -0,0 +1,66 @@
+import os
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+RECORDS = [{"rabi_crop_wise": name, "_2025_26___msp": str(2000 + i)}
+           for i, name in enumerate(["Wheat", "Barley", "Gram", "Lentil (Masur)", "Rapeseed & Mustard"])]
+
+
+@pytest.fixture
+def dataset(app, monkeypatch):
+    """Serve RECORDS two per page through fetch_json; returns the offsets requested."""
+    offsets, failing = [], []
+    monkeypatch.setattr(app, "MSP_SYNC_PAGE_SIZE", 2)
+
+    def fetch_json(url, params=None, timeout=10, breaker=None):
+        if failing:
+            return 503, None
+        query = parse_qs(urlparse(url).query)
+        offset, limit = int(query["offset"][0]), int(query["limit"][0])
+        offsets.append(offset)
+        return 200, {"total": len(RECORDS), "records": RECORDS[offset:offset + limit]}
+
+    monkeypatch.setattr(app, "fetch_json", fetch_json)
+    return offsets, failing
+
+
+def test_sync_pages_through_the_dataset_and_becomes_ready(app, dataset, tmp_path):
+    offsets, _ = dataset
+    path = str(tmp_path / "msp.db")
+    mirror = app.MspMirror(path, app.msp_sync_pages)
+    synced = []
+    mirror.listeners.append(lambda: synced.append(len(mirror.records())))
+    assert not os.path.exists(path)  # nothing is opened until the mirror is used
+
+    assert not mirror.ready
+    assert mirror.sync() == 5
+    assert offsets == [0, 2, 4]
+    assert mirror.ready and synced == [5]
+    assert mirror.find("masur")["rabi_crop_wise"] == "Lentil (Masur)"
+
+    reopened = app.MspMirror(path, app.msp_sync_pages)
+    assert reopened.ready and reopened.synced_at == mirror.synced_at
+    assert reopened.find("gram")["_2025_26___msp"] == "2002"
+
+
+def test_failed_sync_keeps_the_previous_snapshot(app, dataset, tmp_path):
+    _, failing = dataset
+    mirror = app.MspMirror(str(tmp_path / "msp.db"), app.msp_sync_pages)
+    mirror.sync()
+
+    failing.append(True)
+    with pytest.raises(RuntimeError):
+        mirror.sync()
+    assert mirror.ready and len(mirror.records()) == 5
+    assert "HTTP 503" in mirror.stats()["last_error"]
+
+
+def test_stores_open_their_database_on_first_use(app, tmp_path):
+    path = str(tmp_path / "conversations.db")
+    store = app.ConversationStore(path)
+    assert not os.path.exists(path)
+
+    conv_id = store.create(messages=[("user", "hello")])
+    assert store.messages(conv_id) == [{"role": "user", "content": "hello"}]
+    assert store._db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+ESTIMATE = json.dumps({"desc": "A pseudo-cereal.", "benefits": "Protein.", "calories_per_g": 3.7,
+                       "estimated_price_per_kg": 450})
+
+
+@pytest.fixture
+def market(app, stub_model, tmp_path, monkeypatch):
+    """A ready mirror without quinoa, a fresh knowledge base and an empty miss cache."""
+    mirror = app.MspMirror(str(tmp_path / "msp.db"), app.msp_sync_pages)
+    mirror._index([{"rabi_crop_wise": "Wheat", "_2025_26___msp": "2585"}])
+    mirror.listeners.extend(app.MSP_MIRROR.listeners)
+    knowledge = app.CropKnowledgeStore(str(tmp_path / "crops.db"), 3600, app.CROP_SYNONYMS)
+    knowledge.listeners.extend(app.CROP_KNOWLEDGE.listeners)
+    monkeypatch.setattr(app, "MSP_MIRROR", mirror)
+    monkeypatch.setattr(app, "CROP_KNOWLEDGE", knowledge)
+    monkeypatch.setattr(app, "MSP_MISS_CACHE", app.ResponseCache(maxsize=16, ttl=60))
+    monkeypatch.setattr(app, "rebuild_search_index", lambda: None)
+    stub_model.reply = ESTIMATE
+    return mirror, knowledge
+
+
+def test_a_miss_is_estimated_once_then_served_from_the_cache(app, market, stub_model):
+    first = app.market_lookup("quinoa")
+    assert first["results"][0]["source"] == "Gemini (estimated)"
+    assert app.market_lookup("quinoa") == first
+    assert stub_model.calls == 1
+    assert app.MSP_MISS_CACHE.stats()["hits"] == 1
+
+
+def test_mirror_sync_that_adds_the_crop_drops_the_miss(app, market, monkeypatch):
+    mirror, _ = market
+    app.market_lookup("quinoa")
+    records = [{"rabi_crop_wise": "Wheat", "_2025_26___msp": "2585"},
+               {"rabi_crop_wise": "Quinoa", "_2025_26___msp": "4000"}]
+    monkeypatch.setattr(app, "fetch_json", lambda url, params=None, timeout=10, breaker=None:
+                        (200, {"total": 2, "records": records}))
+
+    mirror.sync()
+    assert app.MSP_MISS_CACHE.get(app.miss_key("quinoa")) is None
+    assert "MSP: ₹4000/quintal" in json.dumps(app.market_lookup("quinoa"), ensure_ascii=False)
+
+
+def test_knowledge_base_learning_the_crop_drops_the_miss(app, market):
+    _, knowledge = market
+    app.market_lookup("quinoa")
+    app.market_lookup("ragi")
+
+    knowledge.put("Quinoa", {"desc": "A pseudo-cereal."})
+    assert app.MSP_MISS_CACHE.get(app.miss_key("quinoa")) is None
+    assert app.MSP_MISS_CACHE.get(app.miss_key("ragi")) is not None
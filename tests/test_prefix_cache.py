@@ -0,0 +1,87 @@
+import time
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+
+class StubCacheProvider:
+    """Local stand-in for GeminiCacheProvider: records calls, optionally slow or refusing."""
+
+    def __init__(self, delay=0.0, error=None):
+        self.delay = delay
+        self.error = error
+        self.created = []
+        self.refreshed = 0
+
+    def create(self, model_name, instruction, ttl):
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        self.created.append((model_name, instruction))
+        return {"name": f"cachedContents/{len(self.created)}"}
+
+    def refresh(self, handle, ttl):
+        self.refreshed += 1
+
+    def model(self, handle):
+        return ("cached-model", handle["name"])
+
+
+@pytest.fixture
+def make_cache(app):
+    def make(provider):
+        return app.PrefixCache(provider, ttl=3600, refresh_margin=300, retry_seconds=600,
+                               min_tokens={"pro": 1000})
+    return make
+
+
+def _settle(cache):
+    cache._worker.submit(lambda: None).result(timeout=5)
+
+
+LONG = "System: reference data " + "soil pH and irrigation notes " * 200
+
+
+def test_prefix_below_minimum_is_never_sent(make_cache):
+    provider = StubCacheProvider()
+    cache = make_cache(provider)
+
+    assert cache.model_for("pro", "System: Answer in English.") is None
+    _settle(cache)
+
+    assert provider.created == []
+    assert cache.stats()["too_small"] == 1
+
+
+def test_registration_runs_off_the_request_path(make_cache):
+    provider = StubCacheProvider(delay=0.5)
+    cache = make_cache(provider)
+
+    t0 = time.monotonic()
+    assert cache.model_for("pro", LONG) is None
+    assert time.monotonic() - t0 < 0.1
+    _settle(cache)
+
+    assert cache.model_for("pro", LONG) == ("cached-model", "cachedContents/1")
+    assert len(provider.created) == 1
+    assert cache.stats()["hits"] == 1
+
+
+def test_refused_prefix_is_not_retried(make_cache):
+    provider = StubCacheProvider(error=google_exceptions.InvalidArgument("too small"))
+    cache = make_cache(provider)
+
+    cache.model_for("pro", LONG)
+    _settle(cache)
+    provider.error = None
+    assert cache.model_for("pro", LONG) is None
+    _settle(cache)
+
+    assert provider.created == []
+    assert cache.stats()["unsupported"] == 1
+
+
+def test_stock_prefixes_skip_the_provider(app):
+    # the language instruction plus soil/climate context is far below any model's minimum
+    instruction = "System: " + app.build_system_prompt("hindi") + "\n" + app.soil_climate_context("loam", "tropical")
+    assert app.estimate_tokens(instruction) < min(app.PREFIX_CACHE_MIN_TOKENS.values())
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+
+class FakeProvider:
+    def __init__(self, name, reply="ok", delay=0.0, error=None):
+        self.name = name
+        self.reply = reply
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+        self.cancelled = 0
+
+    def available(self):
+        return True
+
+    async def agenerate(self, messages, language, route):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.error is not None:
+            raise self.error
+        return self.reply
+
+
+@pytest.fixture
+def make_pool(app):
+    names = []
+
+    def make(*providers, hedge=False):
+        names.extend(p.name for p in providers)
+        return app.ProviderPool(list(providers), app.ROUTER, app.LLM_ADMISSION, app.LLM_BREAKER_SLOW_SECONDS,
+                                hedge=hedge)
+
+    yield make
+    for name in names:
+        app.CIRCUIT_BREAKERS.pop(name, None)
+
+
+MESSAGES = [{"role": "user", "content": "When should I sow mustard?"}]
+
+
+def test_nested_async_call_reuses_the_callers_slot(app, make_pool, use_admission):
+    admission = app.AdmissionController(1, 6000, 100, 4, 0.5)
+    use_admission(admission)
+    inner = make_pool(FakeProvider("fake inner", reply="inner"))
+
+    class Outer(FakeProvider):
+        async def agenerate(self, messages, language, route):
+            # e.g. a summary call made while the reply call holds the only slot
+            return "outer+" + await inner.agenerate(messages, language, route)
+
+    outer = make_pool(Outer("fake outer"))
+    assert asyncio.run(outer.agenerate(MESSAGES, "english")) == "outer+inner"
+    assert admission.admitted == 1
+    assert admission.stats()["active"] == 0
+
+
+def test_gemini_failure_fails_over_to_openai(app, stub_model, monkeypatch):
+    stub_model.error = RuntimeError("Gemini is down")
+    openai_provider = app.LLM.providers[1]
+    monkeypatch.setattr(openai_provider, "api_key", "sk-test")
+    sent = []
+
+    def create(**request):
+        sent.append(request)
+        return {"choices": [{"message": {"content": " Sow in October. "}}]}
+
+    async def acreate(**request):
+        return create(**request)
+
+    monkeypatch.setattr(app.openai.ChatCompletion, "create", create)
+    monkeypatch.setattr(app.openai.ChatCompletion, "acreate", acreate)
+    failovers = app.LLM.failovers
+
+    assert app.LLM.generate(MESSAGES, "english") == "Sow in October."
+    assert asyncio.run(app.LLM.agenerate(MESSAGES, "english")) == "Sow in October."
+    assert app.LLM.failovers == failovers + 2
+    assert sent[0]["api_key"] == "sk-test" and sent[0]["model"] == app.OPENAI_MODEL
+    assert sent[0]["messages"][0]["role"] == "system"
+
+
+def test_hedge_winner_cancels_the_slow_request(app, stub_model, make_pool, monkeypatch):
+    slow, fast = FakeProvider("fake slow", reply="slow", delay=5.0), FakeProvider("fake fast", reply="fast")
+    pool = make_pool(slow, fast, hedge=True)
+    monkeypatch.setattr(pool, "_hedge_after", lambda *args: 0.05)
+
+    async def main():
+        reply = await pool.agenerate(MESSAGES, "english")
+        await asyncio.sleep(0)  # let the cancellation reach the loser
+        return reply
+
+    assert asyncio.run(main()) == "fast"
+    assert (pool.hedges, pool.hedge_wins) == (1, 1)
+    assert slow.cancelled == 1
+    assert pool.breakers["fake slow"].stats()["window_calls"] == 0  # a cancelled loser is not a failure
@@ -0,0 +1,62 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+
+def test_concurrent_callers_share_one_call_and_its_error(app):
+    flight = app.SingleFlight("test")
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        release.wait(1)
+        raise RuntimeError("upstream down")
+
+    def caller(_):
+        try:
+            flight.do("k", fetch)
+        except RuntimeError as e:
+            return str(e)
+
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        results = [pool.submit(caller, i) for i in range(5)]
+        started.wait(1)
+        # let the followers join before the leader finishes
+        threading.Timer(0.2, release.set).start()
+        errors = [r.result() for r in results]
+
+    assert errors == ["upstream down"] * 5
+    assert len(calls) == 1
+    assert flight.stats()["upstream_calls"] == 1 and flight.stats()["in_flight"] == 0
+
+
+def test_nothing_is_remembered_after_the_call(app):
+    flight = app.SingleFlight("test")
+    assert flight.do("k", lambda: 1) == 1
+    assert flight.do("k", lambda: 2) == 2
+    assert flight.stats()["coalesced"] == 0
+
+
+def test_async_leader_cancellation_does_not_cancel_followers(app):
+    import asyncio
+
+    flight = app.SingleFlight("test")
+
+    async def fetch():
+        await asyncio.sleep(0.1)
+        return "ok"
+
+    async def main():
+        leader = asyncio.ensure_future(flight.ado("k", fetch))
+        follower = asyncio.ensure_future(flight.ado("k", fetch))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(main()) == "ok"
+    assert flight.stats()["upstream_calls"] == 1
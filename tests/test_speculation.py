@@ -0,0 +1,36 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+def test_only_calls_that_never_started_count_as_cancelled(app, monkeypatch):
+    stats = dict.fromkeys(app.SPECULATION_STATS, 0)
+    monkeypatch.setattr(app, "SPECULATION_STATS", stats)
+    queued, running = Future(), Future()
+    running.set_running_or_notify_cancel()
+
+    app.drop_speculation(queued)
+    app.drop_speculation(running)
+
+    assert queued.cancelled() and not running.cancelled()
+    assert stats["cancelled"] == 1 and stats["wasted"] == 1
+
+
+def test_market_lookup_sheds_overload_as_503(app, stub_model, monkeypatch):
+    def overloaded(crop, match):
+        raise app.Overloaded("LLM queue is full", 2, 503)
+
+    monkeypatch.setattr(app, "lookup_msp", lambda crop, records=None: None)
+    monkeypatch.setattr(app.CROP_KNOWLEDGE, "get", lambda *names: {})  # known crop: the plain path
+    monkeypatch.setattr(app, "market_result", overloaded)
+    resp = app.app.test_client().get('/market_online', query_string={"product": "quinoa"})
+
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "2"
+
+
+def test_concurrent_counts_are_not_lost(app, monkeypatch):
+    stats = dict.fromkeys(app.SPECULATION_STATS, 0)
+    monkeypatch.setattr(app, "SPECULATION_STATS", stats)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda _: [app.count_speculation("started") for _ in range(1000)], range(8)))
+
+    assert app.speculation_stats()["started"] == 8000
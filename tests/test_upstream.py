@@ -0,0 +1,141 @@
+import asyncio
+
+import aiohttp
+import pytest
+import requests
+from aiohttp import web
+
+import resilience
+
+
+async def serve(statuses, run):
+    """Serve `statuses` in turn (then 200s) on a local port and await run(session, url)."""
+    seen = []
+
+    async def handler(request):
+        seen.append(request.query.get("q"))
+        status = statuses.pop(0) if statuses else 200
+        return web.json_response({"records": [{"q": request.query.get("q")}]}, status=status)
+
+    server = web.Application()
+    server.router.add_get("/resource", handler)
+    runner = web.AppRunner(server)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        async with aiohttp.ClientSession() as session:
+            return await run(session, f"http://127.0.0.1:{port}/resource"), seen
+    finally:
+        await runner.cleanup()
+
+
+def make_client(app):
+    return app.UpstreamClient(4, 2, retries=2, backoff=0.01, backoff_max=0.02)
+
+
+def test_aget_retries_5xx_and_returns_the_json(app):
+    client = make_client(app)
+    (status, data), seen = asyncio.run(serve([503, 502], lambda s, url: client.aget(s, url, {"q": "rice"})))
+
+    assert status == 200
+    assert data == {"records": [{"q": "rice"}]}
+    assert seen == ["rice"] * 3
+    assert client.counters["retries"] == 2 and client.counters["attempts"] == 3
+    assert client.in_flight == 0
+
+
+def test_aget_gives_up_after_its_retries(app):
+    client = make_client(app)
+    (status, data), _ = asyncio.run(serve([500] * 5, lambda s, url: client.aget(s, url)))
+
+    assert (status, data) == (500, None)
+    assert client.counters["attempts"] == 3
+
+
+def test_aget_respects_the_deadline(app):
+    client = make_client(app)
+
+    async def run(session, url):
+        return await client.aget(session, url, deadline=0)
+
+    with pytest.raises(resilience.UpstreamTimeout):
+        asyncio.run(serve([], run))
+    assert client.counters["deadline_exceeded"] == 1
+
+
+class FakeSession:
+    """Stands in for requests.Session: answers with `outcomes` in turn (status codes or exceptions)."""
+
+    def __init__(self, outcomes, clock=None, step=0.0):
+        self.outcomes = outcomes
+        self.timeouts = []
+        self.clock, self.step = clock, step
+
+    def get(self, url, params=None, timeout=None):
+        self.timeouts.append(timeout)
+        if self.clock is not None:
+            self.clock[0] += self.step
+        outcome = self.outcomes.pop(0) if self.outcomes else 200
+        if isinstance(outcome, Exception):
+            raise outcome
+        resp = requests.Response()
+        resp.status_code, retry_after = outcome if isinstance(outcome, tuple) else (outcome, None)
+        if retry_after:
+            resp.headers["Retry-After"] = retry_after
+        return resp
+
+
+@pytest.fixture
+def pauses(app, monkeypatch):
+    """The jitter ranges drawn and the sleeps taken between attempts."""
+    drawn, slept = [], []
+    monkeypatch.setattr(app.random, "uniform", lambda low, high: drawn.append((low, high)) or high / 2)
+    monkeypatch.setattr(app.time, "sleep", slept.append)
+    return drawn, slept
+
+
+def test_get_retries_5xx_with_jittered_backoff(app, pauses):
+    drawn, slept = pauses
+    client = app.UpstreamClient(4, 2, retries=3, backoff=0.5, backoff_max=1.5)
+    client.session = FakeSession([503, requests.ConnectionError("reset"), 502])
+
+    assert client.get("https://api.example.invalid/resource").status_code == 200
+    # full jitter: uniform(0, min(backoff_max, backoff * 2 ** attempt)) before each retry
+    assert drawn == [(0, 1.0), (0, 1.5), (0, 1.5)]
+    assert slept == [0.5, 0.75, 0.75]
+    assert client.counters["retries"] == 3 and client.counters["attempts"] == 4
+    assert client.in_flight == 0
+
+
+def test_get_honours_retry_after_up_to_the_cap(app, pauses):
+    _, slept = pauses
+    client = app.UpstreamClient(4, 2, retries=2, backoff=0.1, backoff_max=2.0)
+    client.session = FakeSession([(429, "1"), (429, "120")])
+
+    assert client.get("https://api.example.invalid/resource").status_code == 200
+    assert slept == [1.0, 2.0]
+
+
+def test_get_does_not_retry_client_errors(app, pauses):
+    client = app.UpstreamClient(4, 2, retries=3, backoff=0.1, backoff_max=1.0)
+    client.session = FakeSession([404, 200])
+
+    assert client.get("https://api.example.invalid/resource").status_code == 404
+    assert client.counters["attempts"] == 1 and pauses[1] == []
+
+
+def test_get_stops_at_its_deadline(app, monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(app.time, "sleep", lambda seconds: clock.__setitem__(0, clock[0] + seconds))
+    client = app.UpstreamClient(4, 2, retries=10, backoff=0.5, backoff_max=0.5)
+    client.session = FakeSession([requests.Timeout("slow")] * 10, clock=clock, step=1.0)
+
+    with pytest.raises(resilience.UpstreamTimeout):
+        client.get("https://api.example.invalid/resource", deadline=3)
+    # each attempt only gets the time that is left of the overall deadline
+    assert client.session.timeouts[0] == 3 and all(t <= 3 for t in client.session.timeouts)
+    assert client.session.timeouts == sorted(client.session.timeouts, reverse=True)
+    assert client.counters["deadline_exceeded"] == 1 and client.counters["attempts"] < 10